@@ -0,0 +1,135 @@
+"""
+Configuración común de las pruebas (pytest)
+Las pruebas no usan MariaDB: ConexionFalsa registra las sentencias y responde con lo que
+devuelva `responder(sql, parametros)`.
+"""
+
+import os
+import tempfile
+
+# Antes de importar infotaxi_api: sin conexiones al cargar ni hilos de mantenimiento
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='infotaxi_cache_'))
+os.environ.setdefault('ESTADOS_BACKEND', 'memoria')
+os.environ.setdefault('MANTENIMIENTO_ACTIVO', 'false')
+os.environ.setdefault('VERIFICAR_ESQUEMA_AL_INICIAR', 'false')
+os.environ.setdefault('MIGRAR_AL_INICIAR', 'false')
+
+from contextlib import contextmanager
+
+import pytest
+
+# Scripts viejos que prueban contra un servidor corriendo (requests), no son pruebas de pytest
+collect_ignore = ['archived_unneeded']
+
+
+def _sql(sentencia):
+    return ' '.join(sentencia.split())
+
+
+class CursorFalso:
+    def __init__(self, conexion, dictionary=False):
+        self.conexion = conexion
+        self.dictionary = dictionary
+        self.filas = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, sentencia, parametros=()):
+        sentencia = _sql(sentencia)
+        self.conexion.sentencias.append((sentencia, parametros))
+        resultado = self.conexion.responder(sentencia, parametros)
+        if isinstance(resultado, Exception):
+            raise resultado
+        if isinstance(resultado, int):
+            self.filas, self.rowcount = [], resultado
+        else:
+            self.filas = list(resultado or [])
+            self.rowcount = len(self.filas)
+        self.conexion.in_transaction = True
+
+    def executemany(self, sentencia, lista):
+        lista = list(lista)
+        sentencia = _sql(sentencia)
+        self.conexion.sentencias.append((sentencia, lista))
+        resultado = self.conexion.responder_lote(sentencia, lista)
+        if isinstance(resultado, Exception):
+            raise resultado
+        self.rowcount = len(lista)
+        self.conexion.in_transaction = True
+
+    def fetchone(self):
+        return self.filas.pop(0) if self.filas else None
+
+    def fetchall(self):
+        filas, self.filas = self.filas, []
+        return filas
+
+    def close(self):
+        pass
+
+
+class ConexionFalsa:
+    """Conexión MySQL de mentira: `sentencias` guarda (sql normalizado, parámetros), y commit/rollback
+    como ('<commit>', None) y ('<rollback>', None)"""
+
+    def __init__(self, responder=None, responder_lote=None):
+        self.sentencias = []
+        self.responder = responder or (lambda sentencia, parametros: [])
+        self.responder_lote = responder_lote or (lambda sentencia, lista: None)
+        self.in_transaction = False
+        self.commits = 0
+        self.rollbacks = 0
+        self.cierres = 0
+
+    def cursor(self, dictionary=False, **kwargs):
+        return CursorFalso(self, dictionary)
+
+    def commit(self):
+        self.commits += 1
+        self.in_transaction = False
+        self.sentencias.append(('<commit>', None))
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+        self.sentencias.append(('<rollback>', None))
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self.cierres += 1
+
+    def ejecutadas(self, fragmento):
+        """Sentencias que contienen `fragmento`"""
+        return [(s, p) for s, p in self.sentencias if fragmento in s]
+
+
+@pytest.fixture
+def conexion():
+    return ConexionFalsa()
+
+
+@pytest.fixture
+def conexion_bd(conexion):
+    """Mismo contrato que infotaxi_api.conexion_bd, sobre la conexión falsa"""
+    @contextmanager
+    def prestar():
+        yield conexion
+    return prestar
+
+
+@pytest.fixture
+def api(monkeypatch, conexion):
+    """Módulo infotaxi_api con todas las conexiones apuntando a `conexion` y cachés vacías"""
+    import infotaxi_api
+    monkeypatch.setattr(infotaxi_api, 'get_db_connection', lambda: conexion)
+    infotaxi_api.usuarios_cache._datos.clear()
+    infotaxi_api.personas_cache._datos.clear()
+    infotaxi_api.app.config['TESTING'] = True
+    return infotaxi_api
+
+
+def usuario_bd(rol='usuario', id_user=7):
+    """Fila de users como la lee verificar_usuario"""
+    return {'id_user': id_user, 'username': 'conductor@infotaxi.co', 'nombres': 'Juan', 'rol': rol}
@@ -0,0 +1,200 @@
+"""
+Registro de consultas por cédula para InfoTaxi
+- Contador por usuario: cada incremento es un upsert atómico sobre consultas (una fila por usuario,
+  índice único en user_id). Los usuarios que consultan varias veces dentro de un intervalo acumulan
+  en memoria y se escriben en bloque.
+- Historial: cada consulta se encola en memoria y un hilo la guarda por lotes en consultas_historial,
+  fuera del camino de la petición.
+"""
+
+import os
+import time
+from collections import deque
+from datetime import datetime
+from mysql.connector import Error
+from escritura_diferida import EscrituraDiferida
+
+# Segundos entre escrituras en bloque de los incrementos acumulados y del historial
+SEGUNDOS_FLUSH = float(os.getenv('CONSULTAS_FLUSH_SEGUNDOS', 5))
+# Eventos de historial en memoria por worker; si la BD no da abasto se descartan los nuevos
+MAX_EVENTOS_HISTORIAL = int(os.getenv('HISTORIAL_MAX_EVENTOS', 10000))
+# Filas por INSERT del historial
+LOTE_HISTORIAL = int(os.getenv('HISTORIAL_LOTE', 500))
+
+# Upsert de un usuario; LAST_INSERT_ID(expr) devuelve el total nuevo en el mismo viaje
+UPSERT_UNO = """
+    INSERT INTO consultas (user_id, count) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE count = LAST_INSERT_ID(count + VALUES(count))
+"""
+
+
+class ContadorConsultas(EscrituraDiferida):
+    """
+    La primera consulta de un usuario en cada intervalo se escribe en la petición y devuelve el total real.
+    Las siguientes del mismo intervalo solo suman en memoria (total conocido + pendientes) y un hilo
+    las escribe todas juntas con un solo INSERT ... ON DUPLICATE KEY UPDATE.
+    """
+
+    nombre_hilo = 'flush_consultas'
+
+    def __init__(self, conexion_bd, intervalo=SEGUNDOS_FLUSH):
+        super().__init__(conexion_bd, intervalo)
+        self._totales = {}      # id_user -> (total leído de la BD, monotonic de la lectura)
+        self._pendientes = {}   # id_user -> incrementos aún no escritos
+        self._metricas = {'directas': 0, 'en_memoria': 0, 'flushes': 0, 'filas_flush': 0, 'errores_flush': 0}
+
+    def registrar(self, cursor, id_user, cantidad=1):
+        """Sumar `cantidad` consultas de `id_user` y retornar su total. Si escribe, no hace commit."""
+        ahora = time.monotonic()
+        with self._lock:
+            self._iniciar_hilo()
+            conocido = self._totales.get(id_user)
+            if conocido and ahora - conocido[1] < self.intervalo:
+                self._pendientes[id_user] = self._pendientes.get(id_user, 0) + cantidad
+                self._metricas['en_memoria'] += 1
+                return conocido[0] + self._pendientes[id_user]
+
+        cursor.execute(UPSERT_UNO, (id_user, cantidad))
+        # rowcount 1 = fila nueva (total = cantidad); 2 = fila existente actualizada
+        total = cantidad if cursor.rowcount == 1 else cursor.lastrowid
+        with self._lock:
+            self._totales[id_user] = (total, ahora)
+            self._metricas['directas'] += 1
+            # Incrementos de un intervalo anterior que el hilo aún no escribió
+            return total + self._pendientes.get(id_user, 0)
+
+    def _flush(self):
+        """Escribir los incrementos acumulados y refrescar los totales conocidos"""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+            # Los usuarios sin actividad reciente dejan de ocupar memoria
+            limite = time.monotonic() - self.intervalo
+            for id_user in [u for u, (_, leido) in self._totales.items() if leido < limite and u not in pendientes]:
+                del self._totales[id_user]
+        if not pendientes:
+            return 0
+
+        with self._conexion_bd() as conn:
+            try:
+                if not conn:
+                    raise Error(msg='Error de conexión a la base de datos')
+                cursor = conn.cursor()
+                try:
+                    ids = list(pendientes)
+                    cursor.execute(
+                        "INSERT INTO consultas (user_id, count) VALUES "
+                        + ', '.join(['(%s, %s)'] * len(ids))
+                        + " ON DUPLICATE KEY UPDATE count = count + VALUES(count)",
+                        [valor for id_user in ids for valor in (id_user, pendientes[id_user])]
+                    )
+                    cursor.execute(
+                        f"SELECT user_id, count FROM consultas WHERE user_id IN ({', '.join(['%s'] * len(ids))})",
+                        ids
+                    )
+                    leidos = cursor.fetchall()
+                    conn.commit()
+                finally:
+                    cursor.close()
+            except Error as e:
+                print(f"[ERROR] No se pudieron guardar {sum(pendientes.values())} consultas: {e}")
+                with self._lock:
+                    for id_user, cantidad in pendientes.items():
+                        self._pendientes[id_user] = self._pendientes.get(id_user, 0) + cantidad
+                    self._metricas['errores_flush'] += 1
+                return 0
+
+        ahora = time.monotonic()
+        with self._lock:
+            for id_user, total in leidos:
+                self._totales[id_user] = (total, ahora)
+            self._metricas['flushes'] += 1
+            self._metricas['filas_flush'] += len(pendientes)
+        return len(pendientes)
+
+    def metricas(self):
+        with self._lock:
+            return dict(
+                self._metricas,
+                intervalo=self.intervalo,
+                usuarios_en_memoria=len(self._totales),
+                pendientes=sum(self._pendientes.values())
+            )
+
+
+class HistorialConsultas(EscrituraDiferida):
+    """
+    Cola acotada de eventos "usuario X consultó la cédula Y". La petición solo agrega a la cola;
+    el hilo escribe en lotes de `tamano_lote` cada `intervalo` o antes si se llena un lote.
+    """
+
+    nombre_hilo = 'flush_historial'
+
+    def __init__(self, conexion_bd, intervalo=SEGUNDOS_FLUSH, capacidad=MAX_EVENTOS_HISTORIAL,
+                 tamano_lote=LOTE_HISTORIAL):
+        super().__init__(conexion_bd, intervalo)
+        self.capacidad = capacidad
+        self.tamano_lote = tamano_lote
+        self._eventos = deque()
+        self._metricas = {'encolados': 0, 'descartados': 0, 'escritos': 0, 'lotes': 0, 'errores_flush': 0}
+
+    def registrar(self, id_user, cedula, reportes):
+        """Encolar la consulta; retorna False si la cola está llena y el evento se descartó"""
+        with self._lock:
+            self._iniciar_hilo()
+            if len(self._eventos) >= self.capacidad:
+                self._metricas['descartados'] += 1
+                return False
+            self._eventos.append((id_user, str(cedula)[:20], reportes, datetime.now()))
+            self._metricas['encolados'] += 1
+            if len(self._eventos) >= self.tamano_lote:
+                self._despertar.set()
+        return True
+
+    def _flush(self):
+        """Escribir toda la cola por lotes; si la BD falla, el lote vuelve al frente de la cola"""
+        escritos = 0
+        while True:
+            with self._lock:
+                lote = [self._eventos.popleft() for _ in range(min(self.tamano_lote, len(self._eventos)))]
+            if not lote:
+                return escritos
+
+            try:
+                self._escribir(lote)
+            except Error as e:
+                print(f"[ERROR] No se pudo guardar el historial de consultas ({len(lote)} eventos): {e}")
+                with self._lock:
+                    self._eventos.extendleft(reversed(lote))
+                    while len(self._eventos) > self.capacidad:
+                        self._eventos.pop()
+                        self._metricas['descartados'] += 1
+                    self._metricas['errores_flush'] += 1
+                return escritos
+
+            escritos += len(lote)
+            with self._lock:
+                self._metricas['escritos'] += len(lote)
+                self._metricas['lotes'] += 1
+
+    def _escribir(self, lote):
+        with self._conexion_bd() as conn:
+            if not conn:
+                raise Error(msg='Error de conexión a la base de datos')
+            cursor = conn.cursor()
+            try:
+                cursor.executemany("""
+                    INSERT INTO consultas_historial (user_id, cedula, reportes, consultado_en)
+                    VALUES (%s, %s, %s, %s)
+                """, lote)
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def metricas(self):
+        with self._lock:
+            return dict(
+                self._metricas,
+                intervalo=self.intervalo,
+                capacidad=self.capacidad,
+                en_cola=len(self._eventos)
+            )
@@ -0,0 +1,248 @@
+"""
+Conversión en línea de tablas MyISAM a InnoDB para InfoTaxi
+
+Por cada tabla:
+  1. Crea una copia vacía <tabla>__innodb con ENGINE=InnoDB
+  2. Copia las filas por lotes de llave primaria (la tabla original sigue atendiendo lecturas y escrituras)
+  3. Re-sincroniza los lotes que cambiaron durante la copia comparando checksums
+  4. Bloquea ambas tablas, aplica los últimos cambios, verifica conteo y checksum e intercambia los nombres
+La tabla original queda como <tabla>__myisam para poder revertir; borrarla a mano tras verificar.
+
+Uso: python convertir_innodb.py [tabla ...] [--lote N] [--solo-verificar]
+"""
+
+import argparse
+import sys
+from mysql.connector import Error
+
+TABLAS_MYISAM = ['personas', 'consultas', 'descripcion_reporte', 'estados']
+TAMANO_LOTE = 5000
+SUFIJO_COPIA = '__innodb'
+SUFIJO_RESPALDO = '__myisam'
+
+
+def _motor(cursor, tabla):
+    cursor.execute("""
+        SELECT ENGINE, AUTO_INCREMENT FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, (tabla,))
+    return cursor.fetchone()
+
+
+def _llave_primaria(cursor, tabla):
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_NAME = 'PRIMARY'
+    """, (tabla,))
+    columnas = [fila[0] for fila in cursor.fetchall()]
+    if len(columnas) != 1:
+        raise Error(msg=f'{tabla}: se requiere una llave primaria de una sola columna')
+    return columnas[0]
+
+
+def _expresion_checksum(cursor, tabla):
+    """COUNT y BIT_XOR(CRC32) de todas las columnas; no depende del orden ni del motor"""
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY ORDINAL_POSITION
+    """, (tabla,))
+    columnas = ', '.join(f"IFNULL(`{fila[0]}`, '\\\\N')" for fila in cursor.fetchall())
+    return f"COUNT(*), COALESCE(BIT_XOR(CRC32(CONCAT_WS('#', {columnas}))), 0)"
+
+
+def _triggers(cursor, tabla):
+    cursor.execute("""
+        SELECT TRIGGER_NAME, ACTION_TIMING, EVENT_MANIPULATION, ACTION_STATEMENT
+        FROM information_schema.TRIGGERS
+        WHERE TRIGGER_SCHEMA = DATABASE() AND EVENT_OBJECT_TABLE = %s
+    """, (tabla,))
+    return cursor.fetchall()
+
+
+def _crear_trigger(cursor, nombre, momento, evento, tabla, sentencia):
+    cursor.execute(f"CREATE TRIGGER `{nombre}` {momento} {evento} ON `{tabla}` FOR EACH ROW {sentencia}")
+
+
+class ConversorInnoDB:
+    """Convierte una tabla MyISAM a InnoDB copiándola por lotes de llave primaria"""
+
+    def __init__(self, conn, tabla, lote=TAMANO_LOTE):
+        self.conn = conn
+        self.tabla = tabla
+        self.copia = tabla + SUFIJO_COPIA
+        self.respaldo = tabla + SUFIJO_RESPALDO
+        self.lote = lote
+        self.cursor = conn.cursor()
+        self.pk = _llave_primaria(self.cursor, tabla)
+        self.checksum = _expresion_checksum(self.cursor, tabla)
+
+    def _log(self, mensaje):
+        print(f"[INNODB] {self.tabla}: {mensaje}")
+
+    def _limites(self):
+        """Rangos (desde, hasta] de llave primaria con `lote` filas cada uno, según la tabla original"""
+        desde = None
+        while True:
+            if desde is None:
+                self.cursor.execute(
+                    f"SELECT `{self.pk}` FROM `{self.tabla}` ORDER BY `{self.pk}` LIMIT 1 OFFSET %s",
+                    (self.lote - 1,)
+                )
+            else:
+                self.cursor.execute(
+                    f"SELECT `{self.pk}` FROM `{self.tabla}` WHERE `{self.pk}` > %s "
+                    f"ORDER BY `{self.pk}` LIMIT 1 OFFSET %s",
+                    (desde, self.lote - 1)
+                )
+            fila = self.cursor.fetchone()
+            if fila is None:
+                yield desde, None
+                return
+            yield desde, fila[0]
+            desde = fila[0]
+
+    def _rango(self, desde, hasta):
+        condiciones, parametros = [], []
+        if desde is not None:
+            condiciones.append(f"`{self.pk}` > %s")
+            parametros.append(desde)
+        if hasta is not None:
+            condiciones.append(f"`{self.pk}` <= %s")
+            parametros.append(hasta)
+        return (' AND '.join(condiciones) or '1 = 1'), tuple(parametros)
+
+    def _checksum_rango(self, tabla, desde, hasta):
+        where, parametros = self._rango(desde, hasta)
+        self.cursor.execute(f"SELECT {self.checksum} FROM `{tabla}` WHERE {where}", parametros)
+        return tuple(self.cursor.fetchone())
+
+    def _copiar_rango(self, desde, hasta, reemplazar=False):
+        where, parametros = self._rango(desde, hasta)
+        if reemplazar:
+            self.cursor.execute(f"DELETE FROM `{self.copia}` WHERE {where}", parametros)
+        self.cursor.execute(
+            f"INSERT INTO `{self.copia}` SELECT * FROM `{self.tabla}` WHERE {where}",
+            parametros
+        )
+        return self.cursor.rowcount
+
+    def preparar(self):
+        self.cursor.execute(f"DROP TABLE IF EXISTS `{self.copia}`")
+        self.cursor.execute(f"CREATE TABLE `{self.copia}` LIKE `{self.tabla}`")
+        self.cursor.execute(f"ALTER TABLE `{self.copia}` ENGINE=InnoDB")
+
+    def copiar(self):
+        self.cursor.execute(f"SELECT COUNT(*) FROM `{self.tabla}`")
+        total = self.cursor.fetchone()[0]
+        copiadas = 0
+        for desde, hasta in self._limites():
+            copiadas += self._copiar_rango(desde, hasta)
+            self.conn.commit()
+            porcentaje = 100.0 * copiadas / total if total else 100.0
+            self._log(f"{copiadas}/{total} filas copiadas ({porcentaje:.1f}%)")
+
+    def resincronizar(self):
+        """Volver a copiar los lotes cuyo checksum cambió desde la copia. Retorna lotes corregidos"""
+        corregidos = 0
+        for desde, hasta in self._limites():
+            if self._checksum_rango(self.tabla, desde, hasta) != self._checksum_rango(self.copia, desde, hasta):
+                self._copiar_rango(desde, hasta, reemplazar=True)
+                corregidos += 1
+        self.conn.commit()
+        return corregidos
+
+    def verificar(self, tabla_a, tabla_b):
+        a = self._checksum_rango(tabla_a, None, None)
+        b = self._checksum_rango(tabla_b, None, None)
+        self._log(f"verificación {tabla_a}: {a[0]} filas, checksum {a[1]} | {tabla_b}: {b[0]} filas, checksum {b[1]}")
+        return a == b
+
+    def intercambiar(self):
+        """Último ajuste con ambas tablas bloqueadas y cambio de nombres"""
+        triggers = _triggers(self.cursor, self.tabla)
+        # Triggers temporales en la copia para no perder su efecto durante el intercambio
+        for nombre, momento, evento, sentencia in triggers:
+            _crear_trigger(self.cursor, f'{nombre}__tmp', momento, evento, self.copia, sentencia)
+
+        self.cursor.execute(f"LOCK TABLES `{self.tabla}` WRITE, `{self.copia}` WRITE")
+        try:
+            corregidos = self.resincronizar()
+            self._log(f"ajuste final con tablas bloqueadas: {corregidos} lotes")
+            if not self.verificar(self.tabla, self.copia):
+                raise Error(msg=f'{self.tabla}: conteo o checksum no coinciden, no se intercambian las tablas')
+
+            auto_increment = _motor(self.cursor, self.tabla)[1]
+            if auto_increment:
+                self.cursor.execute(f"ALTER TABLE `{self.copia}` AUTO_INCREMENT = {int(auto_increment)}")
+            self.cursor.execute(f"ALTER TABLE `{self.tabla}` RENAME TO `{self.respaldo}`")
+            self.cursor.execute(f"ALTER TABLE `{self.copia}` RENAME TO `{self.tabla}`")
+            self.conn.commit()
+        finally:
+            self.cursor.execute("UNLOCK TABLES")
+
+        # Restaurar los triggers con su nombre original sobre la tabla nueva
+        for nombre, momento, evento, sentencia in triggers:
+            self.cursor.execute(f"DROP TRIGGER IF EXISTS `{nombre}`")
+            _crear_trigger(self.cursor, nombre, momento, evento, self.tabla, sentencia)
+            self.cursor.execute(f"DROP TRIGGER IF EXISTS `{nombre}__tmp`")
+
+    def convertir(self):
+        info = _motor(self.cursor, self.tabla)
+        if info is None:
+            self._log("no existe, se omite")
+            return False
+        if info[0].lower() == 'innodb':
+            self._log("ya es InnoDB, se omite")
+            return False
+
+        self._log(f"convirtiendo {info[0]} -> InnoDB (lotes de {self.lote})")
+        self.preparar()
+        self.copiar()
+        self._log(f"re-sincronización en línea: {self.resincronizar()} lotes")
+        self.intercambiar()
+        self._log(f"listo. Respaldo en {self.respaldo} (DROP TABLE `{self.respaldo}` tras validar)")
+        return True
+
+    def cerrar(self):
+        self.cursor.close()
+
+
+def main():
+    from infotaxi_api import conexion_bd
+
+    parser = argparse.ArgumentParser(description='Convertir tablas MyISAM de InfoTaxi a InnoDB')
+    parser.add_argument('tablas', nargs='*', default=TABLAS_MYISAM)
+    parser.add_argument('--lote', type=int, default=TAMANO_LOTE, help='filas por lote de copia')
+    parser.add_argument('--solo-verificar', action='store_true',
+                        help='solo comparar conteo y checksum contra el respaldo <tabla>__myisam')
+    args = parser.parse_args()
+
+    with conexion_bd() as conn:
+        if not conn:
+            print("[INNODB] Error de conexión a la base de datos")
+            return 1
+
+        fallos = 0
+        for tabla in args.tablas:
+            conversor = None
+            try:
+                conversor = ConversorInnoDB(conn, tabla, args.lote)
+                if args.solo_verificar:
+                    if not conversor.verificar(conversor.respaldo, tabla):
+                        fallos += 1
+                else:
+                    conversor.convertir()
+            except Error as e:
+                conn.rollback()
+                print(f"[INNODB ERROR] {tabla}: {e}")
+                fallos += 1
+            finally:
+                if conversor:
+                    conversor.cerrar()
+
+        return 1 if fallos else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""
+Escritura diferida (write-behind) para InfoTaxi
+Base de los registros que acumulan cambios en memoria y los escriben en la BD desde un hilo propio,
+cada `intervalo` segundos, cuando se les despierta, y una última vez al terminar el proceso.
+"""
+
+import atexit
+import os
+import threading
+from abc import ABC, abstractmethod
+
+
+class EscrituraDiferida(ABC):
+    """Las subclases implementan _flush(); registrar/guardar llaman _iniciar_hilo() con self._lock tomado"""
+
+    nombre_hilo = 'escritura_diferida'
+
+    def __init__(self, conexion_bd, intervalo):
+        self._conexion_bd = conexion_bd
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._lock_flush = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo_pid = None
+        atexit.register(self.flush)
+
+    def _iniciar_hilo(self):
+        # Un hilo por proceso (los hilos no sobreviven al fork de gunicorn)
+        pid = os.getpid()
+        if self._hilo_pid == pid:
+            return
+        self._hilo_pid = pid
+        threading.Thread(target=self._bucle, name=self.nombre_hilo, daemon=True).start()
+
+    def _bucle(self):
+        while True:
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[ERROR] {self.nombre_hilo}: {e}")
+
+    def flush(self):
+        with self._lock_flush:
+            return self._flush()
+
+    @abstractmethod
+    def _flush(self):
+        """Escribir lo pendiente en la BD (se llama con self._lock_flush tomado)"""
@@ -0,0 +1,455 @@
+"""
+Estado de conversación del bot (tabla user_state) para InfoTaxi
+Las lecturas salen de un almacén local y los cambios se escriben en user_state desde un hilo (write-behind).
+Almacenes (ESTADOS_BACKEND):
+- sqlite: archivo SQLite compartido por todos los workers del contenedor (por defecto)
+- memoria: dict del proceso; solo para pruebas o un único worker
+- bd: sin almacén local, cada operación va directo a user_state (comportamiento anterior)
+"""
+
+import fcntl
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from mysql.connector import Error
+from escritura_diferida import EscrituraDiferida
+
+BACKEND = os.getenv('ESTADOS_BACKEND', 'sqlite')
+RUTA_SQLITE = os.getenv('ESTADOS_SQLITE', os.path.join(tempfile.gettempdir(), 'infotaxi_estados.sqlite'))
+# Un estado sin cambios durante este tiempo se considera abandonado (0 = no expira)
+TTL_SEGUNDOS = int(os.getenv('ESTADOS_TTL_SEGUNDOS', 86400))
+SEGUNDOS_FLUSH = float(os.getenv('ESTADOS_FLUSH_SEGUNDOS', 2))
+# Filas de user_state por escritura
+LOTE_FLUSH = 500
+
+# El almacén no sabe nada del celular: hay que leer user_state
+DESCONOCIDO = object()
+# Transición sin condición sobre el estado actual
+CUALQUIERA = object()
+
+
+def _fila(celular, estado, opcion, updated_at):
+    """Estado como lo devuelve la API; None si el celular no tiene estado"""
+    if estado is None:
+        return None
+    return {
+        'celular': celular,
+        'estado': estado,
+        'opcion': opcion,
+        'updated_at': datetime.fromtimestamp(updated_at)
+    }
+
+
+class AlmacenMemoria:
+    """
+    Estados en un dict del proceso. Cada worker de gunicorn tendría el suyo, así que solo sirve
+    para pruebas o para correr con un único worker.
+    Cada entrada: celular -> [estado (None = sin estado), opcion, updated_at (epoch), sucio, version]
+    """
+
+    def __init__(self):
+        self._filas = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, celular):
+        with self._lock:
+            fila = self._filas.get(celular)
+            if fila is None:
+                return DESCONOCIDO
+            return _fila(celular, fila[0], fila[1], fila[2])
+
+    def escribir(self, celular, estado, opcion, updated_at):
+        """Cambio hecho por la API: queda pendiente de escribir en user_state"""
+        with self._lock:
+            anterior = self._filas.get(celular)
+            version = anterior[4] + 1 if anterior else 1
+            self._filas[celular] = [estado, opcion, updated_at, True, version]
+
+    def cargar(self, celular, estado, opcion, updated_at):
+        """Lo leído de user_state; no pisa un cambio local que aún no se escribió"""
+        with self._lock:
+            self._filas.setdefault(celular, [estado, opcion, updated_at, False, 0])
+
+    def cambiar_si(self, celular, esperado, estado, opcion, updated_at, vencido_antes):
+        """
+        escribir() solo si el estado vigente es `esperado`: un estado vencido no coincide con ningún
+        `esperado` y cuenta como sin estado (None). Un celular que no está (p. ej. purgado por vencido)
+        también cuenta como sin estado. Retorna si se aplicó.
+        """
+        with self._lock:
+            fila = self._filas.get(celular) or [None, None, updated_at, False, 0]
+            vencido = fila[2] < vencido_antes
+            actual = None if vencido else fila[0]
+            if actual != esperado:
+                return False
+            self._filas[celular] = [estado, opcion, updated_at, True, fila[4] + 1]
+            return True
+
+    def pendientes(self, limite):
+        with self._lock:
+            return [
+                (celular, fila[0], fila[1], fila[2], fila[4])
+                for celular, fila in self._filas.items() if fila[3]
+            ][:limite]
+
+    def confirmar(self, escritos):
+        """Marcar como escritas las (celular, version) que no cambiaron mientras se escribían"""
+        with self._lock:
+            for celular, version in escritos:
+                fila = self._filas.get(celular)
+                if fila and fila[4] == version:
+                    fila[3] = False
+
+    def purgar(self, antes_de):
+        with self._lock:
+            for celular in [c for c, f in self._filas.items() if not f[3] and f[2] < antes_de]:
+                del self._filas[celular]
+
+    @contextmanager
+    def exclusivo(self):
+        # Un solo proceso: basta con el lock de flush del gestor
+        yield True
+
+    def total(self):
+        with self._lock:
+            return len(self._filas)
+
+
+class AlmacenSqlite:
+    """
+    Estados en un archivo SQLite (WAL) compartido por los workers del mismo contenedor.
+    Misma interfaz que AlmacenMemoria; una conexión por hilo.
+    """
+
+    def __init__(self, ruta=RUTA_SQLITE):
+        self.ruta = ruta
+        self._local = threading.local()
+        conn = self._conexion()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS estados (
+                celular TEXT PRIMARY KEY,
+                estado TEXT,
+                opcion INTEGER,
+                updated_at REAL NOT NULL,
+                sucio INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_estados_sucio ON estados (sucio) WHERE sucio = 1")
+
+    def _conexion(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def obtener(self, celular):
+        fila = self._conexion().execute(
+            "SELECT estado, opcion, updated_at FROM estados WHERE celular = ?", (celular,)
+        ).fetchone()
+        if fila is None:
+            return DESCONOCIDO
+        return _fila(celular, *fila)
+
+    def escribir(self, celular, estado, opcion, updated_at):
+        self._conexion().execute("""
+            INSERT INTO estados (celular, estado, opcion, updated_at, sucio, version)
+            VALUES (?, ?, ?, ?, 1, 1)
+            ON CONFLICT (celular) DO UPDATE SET
+                estado = excluded.estado,
+                opcion = excluded.opcion,
+                updated_at = excluded.updated_at,
+                sucio = 1,
+                version = estados.version + 1
+        """, (celular, estado, opcion, updated_at))
+
+    def cargar(self, celular, estado, opcion, updated_at):
+        self._conexion().execute("""
+            INSERT OR IGNORE INTO estados (celular, estado, opcion, updated_at)
+            VALUES (?, ?, ?, ?)
+        """, (celular, estado, opcion, updated_at))
+
+    def cambiar_si(self, celular, esperado, estado, opcion, updated_at, vencido_antes):
+        # Un solo UPDATE: SQLite lo aplica atómicamente aunque otro worker escriba a la vez.
+        # Un estado vencido no coincide con ningún `esperado` y cuenta como sin estado.
+        cursor = self._conexion().execute("""
+            UPDATE estados
+            SET estado = ?, opcion = ?, updated_at = ?, sucio = 1, version = version + 1
+            WHERE celular = ? AND (
+                (estado IS ? AND updated_at >= ?) OR (? IS NULL AND updated_at < ?)
+            )
+        """, (estado, opcion, updated_at, celular, esperado, vencido_antes, esperado, vencido_antes))
+        if cursor.rowcount == 0 and esperado is None:
+            # El celular no está (purgado por vencido): equivale a no tener estado
+            cursor = self._conexion().execute("""
+                INSERT OR IGNORE INTO estados (celular, estado, opcion, updated_at, sucio, version)
+                VALUES (?, ?, ?, ?, 1, 1)
+            """, (celular, estado, opcion, updated_at))
+        return cursor.rowcount == 1
+
+    def pendientes(self, limite):
+        return self._conexion().execute(
+            "SELECT celular, estado, opcion, updated_at, version FROM estados WHERE sucio = 1 LIMIT ?",
+            (limite,)
+        ).fetchall()
+
+    def confirmar(self, escritos):
+        self._conexion().executemany(
+            "UPDATE estados SET sucio = 0 WHERE celular = ? AND version = ?", escritos
+        )
+
+    def purgar(self, antes_de):
+        self._conexion().execute("DELETE FROM estados WHERE sucio = 0 AND updated_at < ?", (antes_de,))
+
+    @contextmanager
+    def exclusivo(self):
+        """Solo un worker escribe en user_state a la vez; los demás se saltan la ronda"""
+        with open(self.ruta + '.lock', 'a') as archivo:
+            try:
+                fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(archivo, fcntl.LOCK_UN)
+
+    def total(self):
+        return self._conexion().execute("SELECT COUNT(*) FROM estados").fetchone()[0]
+
+
+def crear_almacen(backend=BACKEND):
+    """Almacén local según ESTADOS_BACKEND; None para 'bd'"""
+    if backend == 'sqlite':
+        return AlmacenSqlite()
+    if backend == 'memoria':
+        return AlmacenMemoria()
+    if backend == 'bd':
+        return None
+    raise ValueError(f"ESTADOS_BACKEND no válido: {backend} (sqlite, memoria o bd)")
+
+
+class EstadosConversacion(EscrituraDiferida):
+    """
+    Lecturas: almacén local; si no conoce el celular, se lee user_state una vez y se guarda
+    (también la ausencia, para no volver a la BD en cada mensaje).
+    Escrituras: al almacén en la petición y a user_state desde el hilo de flush.
+    """
+
+    nombre_hilo = 'flush_estados'
+
+    def __init__(self, conexion_bd, almacen, ttl=TTL_SEGUNDOS, intervalo=SEGUNDOS_FLUSH):
+        super().__init__(conexion_bd, intervalo)
+        self.almacen = almacen
+        self.ttl = ttl
+        self._metricas = {'lecturas_locales': 0, 'lecturas_bd': 0, 'escrituras': 0, 'filas_flush': 0,
+                          'errores_flush': 0}
+
+    def _vigente(self, fila):
+        if fila and self.ttl and fila['updated_at'].timestamp() < time.time() - self.ttl:
+            return None
+        return fila
+
+    def _contar(self, metrica):
+        with self._lock:
+            self._metricas[metrica] += 1
+
+    def _leer_bd(self, celular):
+        with self._conexion_bd() as conn:
+            if not conn:
+                raise Error(msg='Error conectando a la base de datos')
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("""
+                    SELECT celular, estado, opcion, updated_at
+                    FROM user_state
+                    WHERE celular = %s
+                """, (celular,))
+                return cursor.fetchone()
+            finally:
+                cursor.close()
+
+    def obtener(self, celular):
+        """{celular, estado, opcion, updated_at} o None si no tiene estado (o expiró)"""
+        if self.almacen is not None:
+            fila = self.almacen.obtener(celular)
+            if fila is not DESCONOCIDO:
+                self._contar('lecturas_locales')
+                return self._vigente(fila)
+
+        fila = self._leer_bd(celular)
+        self._contar('lecturas_bd')
+        if self.almacen is None:
+            return self._vigente(fila)
+
+        updated_at = fila['updated_at'].timestamp() if fila and fila['updated_at'] else time.time()
+        self.almacen.cargar(celular, fila['estado'] if fila else None, fila['opcion'] if fila else None, updated_at)
+        return self._vigente(self.almacen.obtener(celular))
+
+    def _escribir_bd(self, celular, estado, opcion):
+        with self._conexion_bd() as conn:
+            if not conn:
+                raise Error(msg='Error conectando a la base de datos')
+            cursor = conn.cursor()
+            try:
+                if estado is None:
+                    cursor.execute("DELETE FROM user_state WHERE celular = %s", (celular,))
+                else:
+                    cursor.execute("""
+                        INSERT INTO user_state (celular, estado, opcion, updated_at)
+                        VALUES (%s, %s, %s, NOW())
+                        ON DUPLICATE KEY UPDATE
+                            estado = VALUES(estado),
+                            opcion = VALUES(opcion),
+                            updated_at = NOW()
+                    """, (celular, estado, opcion))
+                conn.commit()
+            except Error:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def guardar(self, celular, estado, opcion=None):
+        self._contar('escrituras')
+        if self.almacen is None:
+            self._escribir_bd(celular, estado, opcion)
+            return
+        self.almacen.escribir(celular, estado, opcion, time.time())
+        with self._lock:
+            self._iniciar_hilo()
+
+    def eliminar(self, celular):
+        self.guardar(celular, None)
+
+    def transicion(self, celular, estado, opcion=None, esperado=CUALQUIERA):
+        """
+        Cambiar el estado (None = eliminarlo) de forma atómica; con `esperado`, solo si el estado
+        vigente es ese (None = sin estado). Retorna (se aplicó, estado vigente después).
+        """
+        if esperado is CUALQUIERA:
+            self.guardar(celular, estado, opcion)
+            return True, self.obtener(celular)
+
+        if self.almacen is None:
+            return self._transicion_bd(celular, estado, opcion, esperado)
+
+        self.obtener(celular)  # deja el celular cargado en el almacén con lo que haya en user_state
+        vencido_antes = time.time() - self.ttl if self.ttl else float('-inf')
+        aplicada = self.almacen.cambiar_si(celular, esperado, estado, opcion, time.time(), vencido_antes)
+        if aplicada:
+            self._contar('escrituras')
+            with self._lock:
+                self._iniciar_hilo()
+        return aplicada, self.obtener(celular)
+
+    def _transicion_bd(self, celular, estado, opcion, esperado):
+        with self._conexion_bd() as conn:
+            if not conn:
+                raise Error(msg='Error conectando a la base de datos')
+            cursor = conn.cursor(dictionary=True)
+            try:
+                # Sin autocommit el FOR UPDATE abre la transacción (y lee la última versión confirmada)
+                cursor.execute("""
+                    SELECT celular, estado, opcion, updated_at
+                    FROM user_state
+                    WHERE celular = %s
+                    FOR UPDATE
+                """, (celular,))
+                actual = self._vigente(cursor.fetchone())
+                if (actual['estado'] if actual else None) != esperado:
+                    conn.rollback()
+                    return False, actual
+                if estado is None:
+                    cursor.execute("DELETE FROM user_state WHERE celular = %s", (celular,))
+                else:
+                    cursor.execute("""
+                        INSERT INTO user_state (celular, estado, opcion, updated_at)
+                        VALUES (%s, %s, %s, NOW())
+                        ON DUPLICATE KEY UPDATE
+                            estado = VALUES(estado),
+                            opcion = VALUES(opcion),
+                            updated_at = NOW()
+                    """, (celular, estado, opcion))
+                conn.commit()
+            except Error:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        self._contar('escrituras')
+        return True, self.obtener(celular)
+
+    def _flush(self):
+        """Escribir en user_state los cambios pendientes del almacén"""
+        if self.almacen is None:
+            return 0
+        escritos = 0
+        with self.almacen.exclusivo() as propio:
+            if not propio:
+                return 0
+            while True:
+                filas = self.almacen.pendientes(LOTE_FLUSH)
+                if not filas:
+                    break
+                try:
+                    self._escribir_lote(filas)
+                except Error as e:
+                    print(f"[ERROR] No se pudieron guardar {len(filas)} estados en user_state: {e}")
+                    self._contar('errores_flush')
+                    break
+                self.almacen.confirmar([(fila[0], fila[4]) for fila in filas])
+                escritos += len(filas)
+                with self._lock:
+                    self._metricas['filas_flush'] += len(filas)
+            if self.ttl:
+                self.almacen.purgar(time.time() - self.ttl)
+        return escritos
+
+    def _escribir_lote(self, filas):
+        guardados = [
+            (celular, estado, opcion, datetime.fromtimestamp(updated_at))
+            for celular, estado, opcion, updated_at, _ in filas if estado is not None
+        ]
+        eliminados = [celular for celular, estado, _, _, _ in filas if estado is None]
+        with self._conexion_bd() as conn:
+            if not conn:
+                raise Error(msg='Error conectando a la base de datos')
+            cursor = conn.cursor()
+            try:
+                if guardados:
+                    cursor.executemany("""
+                        INSERT INTO user_state (celular, estado, opcion, updated_at)
+                        VALUES (%s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            estado = VALUES(estado),
+                            opcion = VALUES(opcion),
+                            updated_at = VALUES(updated_at)
+                    """, guardados)
+                if eliminados:
+                    cursor.execute(
+                        f"DELETE FROM user_state WHERE celular IN ({', '.join(['%s'] * len(eliminados))})",
+                        eliminados
+                    )
+                conn.commit()
+            except Error:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def metricas(self):
+        with self._lock:
+            metricas = dict(self._metricas, ttl=self.ttl, intervalo=self.intervalo)
+        metricas['backend'] = type(self.almacen).__name__ if self.almacen is not None else 'bd'
+        metricas['en_almacen'] = self.almacen.total() if self.almacen is not None else None
+        return metricas
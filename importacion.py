@@ -0,0 +1,722 @@
+"""
+Importación masiva de reportes (tabla personas) para InfoTaxi
+Esquemas declarativos por plantilla (alias, tipos, valores por defecto y validación),
+lectura por bloques (.xlsx, .xls, CSV, Parquet) e inserción en lotes multi-fila
+"""
+
+import csv
+import os
+import time
+from datetime import datetime
+import pandas as pd
+from openpyxl import load_workbook
+from mysql.connector import Error
+
+# Filas por INSERT multi-fila (configurable por despliegue y por petición)
+TAMANO_LOTE = int(os.getenv('IMPORTAR_TAMANO_LOTE', 500))
+TAMANO_LOTE_MAX = 5000
+
+# Límites por archivo (configurables por despliegue)
+MAX_FILAS = int(os.getenv('IMPORTAR_MAX_FILAS', 100000))
+MAX_BYTES = int(os.getenv('IMPORTAR_MAX_BYTES', 20 * 1024 * 1024))
+
+# Qué hacer con un reporte que ya existe (misma cédula, placa, fecha y reportante):
+# 'omitir' no lo inserta, 'actualizar' sobrescribe el existente, 'fallar' lo reporta como error de fila
+MODOS_DUPLICADOS = ('omitir', 'actualizar', 'fallar')
+MODO_DUPLICADOS = os.getenv('IMPORTAR_MODO_DUPLICADOS', 'omitir')
+CLAVE_DUPLICADOS = ('Numero_Documento', 'Placa', 'Fecha_Reporte', 'id_reportante')
+# Plantilla de carga masiva: Fecha_Reporte es siempre el día de la carga, así que no distingue reportes
+# (con ella, el mismo archivo subido otro día no se detectaría como repetido)
+CLAVE_DUPLICADOS_SIN_FECHA = ('Numero_Documento', 'Placa', 'id_reportante')
+# Columnas de texto de la clave: se comparan como la collation de la BD
+_CLAVE_TEXTO = ('Numero_Documento', 'Placa')
+
+
+class ErrorImportacion(Exception):
+    """Archivo que no se puede importar (columnas faltantes, formato inválido)"""
+
+
+_SIN_VALOR = object()
+
+
+def _normalizar(nombre):
+    """Nombre de columna comparable: sin espacios extra, minúsculas y '_' como espacio"""
+    return ' '.join(str(nombre).replace('_', ' ').lower().split())
+
+
+# Límite de Int64 (BIGINT): un número fuera de [-2**63, 2**63) no se puede convertir
+_LIMITE_ENTERO = 2.0 ** 63
+
+
+def _fuera_de_rango(numero):
+    """Máscara de los números que no caben en Int64 (NA queda en False)"""
+    return ((numero >= _LIMITE_ENTERO) | (numero < -_LIMITE_ENTERO)).fillna(False).astype(bool)
+
+
+def _texto(serie):
+    """
+    (columna como texto sin espacios, máscara de números fuera de rango). Vacíos y fuera de rango
+    quedan como NA. 1234.0 leído por pandas vuelve a '1234'.
+    """
+    fuera = pd.Series(False, index=serie.index)
+    if pd.api.types.is_float_dtype(serie):
+        fuera = _fuera_de_rango(serie)
+        serie = serie.mask(fuera)
+        no_nulos = serie.dropna()
+        if (no_nulos % 1 == 0).all():
+            serie = serie.astype('Int64')
+    texto = serie.astype('string').str.strip()
+    return texto.mask(texto == ''), fuera
+
+
+def _valores(serie):
+    """Columna lista para el conector: objetos Python y None en lugar de NA"""
+    return serie.astype(object).where(serie.notna(), None)
+
+
+class Campo:
+    """
+    Columna destino en personas y cómo se obtiene del archivo.
+    - columna / alias: encabezados aceptados (se comparan sin mayúsculas, espacios ni '_')
+    - tipo: 'texto', 'fecha' o 'numero' (entero redondeado); un valor que no convierte es error de fila
+    - obligatorio: la celda no puede estar vacía
+    - columna_requerida: el encabezado debe existir en el archivo
+    - defecto: valor para celdas vacías
+    - fijo: valor que se usa siempre, sin leer el archivo
+    defecto y fijo pueden ser funciones que reciben el contexto {'id_user', 'hoy'}.
+    """
+
+    def __init__(self, destino, columna=None, alias=(), tipo='texto', obligatorio=False,
+                 columna_requerida=False, defecto=None, fijo=_SIN_VALOR, mayusculas=False):
+        self.destino = destino
+        self.columna = columna
+        self.alias = [columna, *alias] if columna else []
+        self.tipo = tipo
+        self.obligatorio = obligatorio
+        self.columna_requerida = columna_requerida
+        self.defecto = defecto
+        self.fijo = fijo
+        self.mayusculas = mayusculas
+
+    def convertir(self, original):
+        """(valores convertidos, [(máscara de celdas con valor que no se pudo convertir, mensaje)])"""
+        if self.tipo == 'fecha':
+            fecha = pd.to_datetime(original, errors='coerce')
+            return fecha.dt.date.where(fecha.notna()), [
+                (fecha.isna() & original.notna(), f'{self.columna} no es una fecha válida')
+            ]
+        if self.tipo == 'numero':
+            numero = pd.to_numeric(original, errors='coerce')
+            fuera = _fuera_de_rango(numero)
+            numero = numero.mask(fuera)
+            return numero.round().astype('Int64'), [
+                (fuera, f'{self.columna} está fuera de rango'),
+                (numero.isna() & original.notna() & ~fuera, f'{self.columna} no es numérico')
+            ]
+        texto, fuera = _texto(original)
+        if self.mayusculas:
+            texto = texto.str.upper()
+        return texto, [(fuera, f'{self.columna} es un número fuera de rango')]
+
+
+def _resolver(valor, contexto):
+    return valor(contexto) if callable(valor) else valor
+
+
+class Esquema:
+    """Plantilla de importación: lista ordenada de campos que produce las filas del INSERT en personas"""
+
+    def __init__(self, nombre, campos, clave=CLAVE_DUPLICADOS):
+        self.nombre = nombre
+        self.campos = campos
+        self.clave = clave
+        self.destinos = [campo.destino for campo in campos]
+        marcadores = ', '.join(['%s'] * len(campos))
+        self.sql = f"INSERT INTO personas ({', '.join(self.destinos)}) VALUES ({marcadores})"
+        # Modo 'actualizar': se reescriben las columnas que no forman la clave de duplicados
+        self.actualizables = [
+            i for i, destino in enumerate(self.destinos)
+            if destino not in CLAVE_DUPLICADOS and destino != 'Reportante_Nombres'
+        ]
+        asignaciones = ', '.join(f'{self.destinos[i]} = %s' for i in self.actualizables)
+        self.sql_actualizar = f"UPDATE personas SET {asignaciones} WHERE id = %s"
+        self.indices_clave = [self.destinos.index(destino) for destino in clave]
+        self._obligatorios = ', '.join(campo.columna for campo in campos if campo.obligatorio)
+
+    def resolver_columnas(self, columnas):
+        """
+        Asociar cada campo con el encabezado del archivo que le corresponde.
+        Retorna {destino: encabezado}; falla si falta una columna requerida.
+        """
+        por_nombre = {}
+        for columna in columnas:
+            por_nombre.setdefault(_normalizar(columna), columna)
+
+        encontradas, faltantes = {}, []
+        for campo in self.campos:
+            if campo.fijo is not _SIN_VALOR:
+                continue
+            columna = next((por_nombre[_normalizar(a)] for a in campo.alias if _normalizar(a) in por_nombre), None)
+            if columna is not None:
+                encontradas[campo.destino] = columna
+            elif campo.columna_requerida:
+                faltantes.append(campo.columna)
+        if faltantes:
+            raise ErrorImportacion(
+                f'Columnas faltantes: {", ".join(faltantes)}. '
+                f'Columnas encontradas: {", ".join(map(str, columnas))}'
+            )
+        return encontradas
+
+    def preparar(self, df, columnas, id_user):
+        """
+        Validar y normalizar un bloque columna por columna.
+        `columnas` es el resultado de resolver_columnas. Retorna (filas, errores): filas es una lista
+        de (numero_fila, valores) lista para self.sql y errores una lista de (numero_fila, mensaje).
+        """
+        # Fila 1 del archivo es el encabezado
+        numeros_fila = pd.Series(df.index + 2, index=df.index)
+        contexto = {'id_user': id_user, 'hoy': datetime.now().date()}
+
+        valores = {}
+        vacios = pd.Series(False, index=df.index)
+        invalidos = []
+        for campo in self.campos:
+            if campo.fijo is not _SIN_VALOR:
+                valores[campo.destino] = _resolver(campo.fijo, contexto)
+                continue
+
+            if campo.destino in columnas:
+                original = df[columnas[campo.destino]]
+            else:
+                original = pd.Series(pd.NA, index=df.index, dtype='object')
+            convertido, invalidos_campo = campo.convertir(original)
+            if campo.obligatorio:
+                vacios |= convertido.isna()
+            invalidos.extend(invalidos_campo)
+
+            serie = _valores(convertido)
+            defecto = _resolver(campo.defecto, contexto)
+            valores[campo.destino] = serie.where(serie.notna(), defecto) if defecto is not None else serie
+
+        # Un valor inválido se reporta antes que el vacío en que se convirtió
+        motivos = pd.Series('', index=df.index, dtype='object')
+        for invalido, mensaje in invalidos:
+            motivos = motivos.mask((motivos == '') & invalido, mensaje)
+        motivos = motivos.mask((motivos == '') & vacios, f'Campos obligatorios vacíos ({self._obligatorios})')
+        validas = motivos == ''
+
+        normalizado = pd.DataFrame(valores, index=df.index)[validas]
+        filas = list(zip(numeros_fila[validas].tolist(), normalizado.itertuples(index=False, name=None)))
+        errores = list(zip(numeros_fila[~validas].tolist(), motivos[~validas].tolist()))
+        return filas, errores
+
+
+def _hoy(contexto):
+    return contexto['hoy']
+
+
+def _usuario(contexto):
+    return contexto['id_user']
+
+
+# Cada plantilla acepta también los encabezados de la otra como alias
+ESQUEMAS = {
+    # /api/importar-excel (plantilla de /api/plantilla-excel)
+    'excel': Esquema('excel', [
+        Campo('Fecha_Reporte', 'Fecha_Reporte', ['Fecha Inicio Reporte'], tipo='fecha', defecto=_hoy),
+        Campo('Numero_Documento', 'Numero_Documento', ['Documento Conductor'],
+              obligatorio=True, columna_requerida=True),
+        Campo('Nombres', 'Nombres', ['Nombre Conductor'], obligatorio=True, columna_requerida=True),
+        Campo('Apellidos', 'Apellidos', ['Apellidos Conductor'], obligatorio=True, columna_requerida=True),
+        Campo('Fecha_cierre', 'Fecha_cierre', defecto=''),
+        Campo('Placa', 'Placa', ['Placa Vehiculo'], obligatorio=True, columna_requerida=True),
+        Campo('Valor_Reporte', 'Valor_Reporte', ['Valor del Reporte'], tipo='numero', defecto=0),
+        Campo('Descripcion_Reporte', 'Descripcion_Reporte', ['Descripcion del Reporte'], defecto=''),
+        Campo('Vehiculo_afiliado', 'Vehiculo_afiliado', ['Vehiculo Afiliado'], defecto='ADMICARS'),
+        Campo('Estado', 'Estado', defecto='ACTIVA'),
+        Campo('Reportante_Nombres', fijo=_usuario),
+        Campo('id_reportante', fijo=_usuario),
+    ]),
+    # /api/importar-excel-token/<token> (plantilla de la página de carga masiva)
+    'token': Esquema('token', [
+        Campo('Fecha_Reporte', fijo=_hoy),
+        Campo('Numero_Documento', 'Documento Conductor', ['Numero_Documento'],
+              obligatorio=True, columna_requerida=True),
+        Campo('Nombres', 'Nombre Conductor', ['Nombres'], obligatorio=True, columna_requerida=True),
+        Campo('Apellidos', 'Apellidos Conductor', ['Apellidos'], obligatorio=True, columna_requerida=True),
+        Campo('Fecha_cierre', fijo=None),
+        Campo('Placa', 'Placa Vehiculo', ['Placa'], columna_requerida=True, defecto=''),
+        Campo('Valor_Reporte', 'Valor del Reporte', ['Valor_Reporte'], tipo='numero',
+              columna_requerida=True, defecto=0),
+        Campo('Descripcion_Reporte', 'Descripcion del Reporte', ['Descripcion_Reporte'],
+              columna_requerida=True, defecto=''),
+        Campo('Vehiculo_afiliado', 'Vehiculo Afiliado', ['Vehiculo_afiliado'], mayusculas=True, defecto='No'),
+        Campo('Estado', fijo='Activo'),
+        Campo('Reportante_Nombres', fijo=_usuario),
+        Campo('id_reportante', fijo=_usuario),
+    ], clave=CLAVE_DUPLICADOS_SIN_FECHA),
+}
+
+INSERT_PERSONAS = ESQUEMAS['excel'].sql
+
+
+def _clave(columnas, valores):
+    """Clave de duplicados comparable con la BD (collation latin1_swedish_ci: sin mayúsculas ni espacios finales)"""
+    return tuple(
+        str(valor or '').strip().upper() if columna in _CLAVE_TEXTO else valor
+        for columna, valor in zip(columnas, valores)
+    )
+
+
+class DetectorDuplicados:
+    """
+    Detecta reportes repetidos durante una importación sin una consulta por fila:
+    por cada bloque se cargan de una vez los reportes existentes de sus cédulas, y las
+    claves ya vistas en el archivo se guardan en memoria.
+    """
+
+    def __init__(self, esquema, modo=MODO_DUPLICADOS):
+        self.esquema = esquema
+        self.modo = modo
+        self.vistas = set()
+        self.omitidos = 0
+        self.actualizados = 0
+        self.rechazados = 0
+
+    def _existentes(self, conn, filas):
+        """{clave: [ids]} de los reportes ya guardados para las cédulas y reportantes de `filas`"""
+        i_documento = self.esquema.destinos.index('Numero_Documento')
+        i_reportante = self.esquema.destinos.index('id_reportante')
+        documentos = sorted({valores[i_documento] for _, valores in filas})
+        reportantes = sorted({valores[i_reportante] for _, valores in filas})
+        if not documentos:
+            return {}
+
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"""
+                SELECT id, {', '.join(self.esquema.clave)}
+                FROM personas
+                WHERE Numero_Documento IN ({', '.join(['%s'] * len(documentos))})
+                AND id_reportante IN ({', '.join(['%s'] * len(reportantes))})
+            """, (*documentos, *reportantes))
+            existentes = {}
+            for id_persona, *clave in cursor.fetchall():
+                existentes.setdefault(_clave(self.esquema.clave, clave), []).append(id_persona)
+            return existentes
+        finally:
+            cursor.close()
+
+    def filtrar(self, conn, filas):
+        """
+        Separar las filas de un bloque según el modo.
+        Retorna (filas a insertar, actualizaciones [(numero_fila, id, valores)], errores [(numero_fila, mensaje)]).
+        """
+        existentes = self._existentes(conn, filas)
+        nuevas, actualizaciones, errores = [], [], []
+        for numero_fila, valores in filas:
+            clave = _clave(self.esquema.clave, [valores[i] for i in self.esquema.indices_clave])
+            ids = existentes.get(clave)
+            repetida = clave in self.vistas
+
+            if not ids and not repetida:
+                self.vistas.add(clave)
+                nuevas.append((numero_fila, valores))
+            elif self.modo == 'fallar':
+                self.rechazados += 1
+                origen = 'ya existe en la base de datos' if ids else 'repetido en el archivo'
+                errores.append((numero_fila, f'Reporte duplicado ({origen})'))
+            elif self.modo == 'actualizar' and ids:
+                for id_persona in ids:
+                    actualizaciones.append((numero_fila, id_persona, valores))
+            else:
+                # Repetido dentro del archivo: se conserva la primera aparición
+                self.omitidos += 1
+        return nuevas, actualizaciones, errores
+
+    def actualizar(self, conn, actualizaciones):
+        """Sobrescribir los reportes existentes. Retorna errores [(numero_fila, mensaje)]"""
+        if not actualizaciones:
+            return []
+        cursor = conn.cursor()
+        errores = []
+        try:
+            for numero_fila, id_persona, valores in actualizaciones:
+                try:
+                    cursor.execute(
+                        self.esquema.sql_actualizar,
+                        (*(valores[i] for i in self.esquema.actualizables), id_persona)
+                    )
+                    self.actualizados += 1
+                except Error as e:
+                    errores.append((numero_fila, str(e)))
+        finally:
+            cursor.close()
+        return errores
+
+    def resumen(self):
+        return {
+            'modo': self.modo,
+            'omitidos': self.omitidos,
+            'actualizados': self.actualizados,
+            'rechazados': self.rechazados
+        }
+
+
+def modo_duplicados_solicitado(valor, defecto=MODO_DUPLICADOS):
+    """Modo de duplicados pedido por el cliente; None si no es válido"""
+    if valor in (None, ''):
+        return defecto
+    valor = str(valor).strip().lower()
+    return valor if valor in MODOS_DUPLICADOS else None
+
+
+def resumen_errores(errores, limite=100):
+    """
+    Reporte compacto: solo filas fallidas (hasta `limite`) y conteo por motivo,
+    para que un archivo grande no genere una respuesta con una entrada por fila.
+    """
+    errores = sorted(errores)
+    por_motivo = {}
+    for _, mensaje in errores:
+        por_motivo[mensaje] = por_motivo.get(mensaje, 0) + 1
+    return {
+        'detalles': [
+            {'fila': fila, 'status': 'error', 'mensaje': mensaje}
+            for fila, mensaje in errores[:limite]
+        ],
+        'detalles_truncados': len(errores) > limite,
+        'errores_por_motivo': por_motivo
+    }
+
+
+def tabla_transaccional(conn, tabla='personas'):
+    """
+    True si `tabla` es InnoDB. En MyISAM un INSERT multi-fila que falla deja escritas las filas
+    anteriores a la que falló, así que no se puede reintentar el lote completo fila por fila.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT ENGINE FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """, (tabla,))
+        fila = cursor.fetchone()
+    finally:
+        cursor.close()
+    return bool(fila) and str(fila[0]).lower() == 'innodb'
+
+
+def insertar_por_lotes(conn, filas, tamano_lote=TAMANO_LOTE, sql=INSERT_PERSONAS, transaccional=True):
+    """
+    Insertar `filas` [(numero_fila, valores)] con un INSERT multi-fila por lote.
+    Si un lote falla se reintenta fila por fila solo ese lote, para reportar qué filas fallaron.
+    Con `transaccional=False` (tabla MyISAM, ver tabla_transaccional) se inserta fila por fila desde
+    el principio: el reintento duplicaría las filas que el INSERT fallido alcanzó a escribir.
+    La transacción queda abierta: el llamador decide commit o rollback.
+    Retorna (insertados, errores [(numero_fila, mensaje)], lotes [métricas por lote]).
+    """
+    cursor = conn.cursor()
+    insertados = 0
+    errores = []
+    lotes = []
+
+    def fila_a_fila(lote):
+        insertados_lote = 0
+        for numero_fila, valores in lote:
+            try:
+                cursor.execute(sql, valores)
+                insertados_lote += 1
+            except Error as e:
+                errores.append((numero_fila, str(e)))
+        return insertados_lote
+
+    try:
+        for inicio in range(0, len(filas), tamano_lote):
+            lote = filas[inicio:inicio + tamano_lote]
+            t0 = time.perf_counter()
+            modo = 'multi_fila' if transaccional else 'fila_a_fila'
+            if transaccional:
+                try:
+                    # executemany del conector reescribe INSERT ... VALUES como un solo INSERT multi-fila
+                    cursor.executemany(sql, [valores for _, valores in lote])
+                    insertados_lote = len(lote)
+                except Error:
+                    # InnoDB deshace la sentencia completa: ninguna fila del lote quedó escrita
+                    modo = 'fila_a_fila'
+                    insertados_lote = fila_a_fila(lote)
+            else:
+                insertados_lote = fila_a_fila(lote)
+            errores_lote = len(lote) - insertados_lote
+            insertados += insertados_lote
+            lotes.append({
+                'lote': len(lotes) + 1,
+                'filas': len(lote),
+                'insertados': insertados_lote,
+                'errores': errores_lote,
+                'modo': modo,
+                'ms': round((time.perf_counter() - t0) * 1000, 1)
+            })
+    finally:
+        cursor.close()
+    return insertados, errores, lotes
+
+
+def tamano_lote_solicitado(valor, defecto=TAMANO_LOTE):
+    """Tamaño de lote pedido por el cliente, acotado a [1, TAMANO_LOTE_MAX]"""
+    try:
+        return max(1, min(int(valor), TAMANO_LOTE_MAX))
+    except (TypeError, ValueError):
+        return defecto
+
+
+class LectorXlsx:
+    """
+    Primera hoja de un .xlsx leída con openpyxl en modo solo lectura, sin cargar el libro completo.
+    Al iterar entrega DataFrames de hasta `tamano_bloque` filas; el índice es la fila de la hoja
+    menos 2, igual que con pd.read_excel, para que los números de fila de los errores coincidan.
+    """
+
+    def __init__(self, ruta, tamano_bloque):
+        self.tamano_bloque = tamano_bloque
+        # Se pasa el archivo abierto: openpyxl valida la extensión de las rutas y el temporal no tiene
+        self._archivo = open(ruta, 'rb')
+        self._libro = load_workbook(self._archivo, read_only=True, data_only=True)
+        hoja = self._libro.active
+        self._filas = hoja.iter_rows(values_only=True)
+        encabezado = next(self._filas, None)
+        if encabezado is None:
+            self.cerrar()
+            raise ErrorImportacion('El archivo está vacío')
+        self.columnas = [str(col) if col is not None else f'Unnamed: {i}' for i, col in enumerate(encabezado)]
+        # La dimensión declarada en la hoja es una estimación (puede incluir filas vacías con formato):
+        # sirve para progreso, el máximo de filas se controla con las filas leídas
+        self.filas_estimadas = hoja.max_row - 1 if hoja.max_row else None
+        self.filas_conocidas = False
+
+    def __iter__(self):
+        bloque, indices = [], []
+        for indice, fila in enumerate(self._filas):
+            if all(valor is None for valor in fila):
+                continue
+            bloque.append(fila[:len(self.columnas)])
+            indices.append(indice)
+            if len(bloque) >= self.tamano_bloque:
+                yield pd.DataFrame.from_records(bloque, columns=self.columnas, index=indices)
+                bloque, indices = [], []
+        if bloque:
+            yield pd.DataFrame.from_records(bloque, columns=self.columnas, index=indices)
+
+    def cerrar(self):
+        self._libro.close()
+        self._archivo.close()
+
+
+class LectorDataFrame:
+    """Mismo contrato que LectorXlsx para formatos que pandas carga completos (.xls antiguos)"""
+
+    def __init__(self, df, tamano_bloque):
+        self.tamano_bloque = tamano_bloque
+        self._df = df
+        self.columnas = [str(col) for col in df.columns]
+        self.filas_estimadas = len(df)
+        self.filas_conocidas = True
+
+    def __iter__(self):
+        for inicio in range(0, len(self._df), self.tamano_bloque):
+            yield self._df.iloc[inicio:inicio + self.tamano_bloque]
+
+    def cerrar(self):
+        self._df = None
+
+
+class LectorCsv:
+    """
+    CSV leído con pd.read_csv por bloques. Separador (, ; tab |) y codificación (UTF-8 o Latin-1)
+    se detectan con una muestra del inicio. Todo se lee como texto para no perder ceros a la izquierda.
+    """
+
+    def __init__(self, ruta, tamano_bloque, muestra):
+        self.tamano_bloque = tamano_bloque
+        self._ruta = ruta
+        self.encoding = _codificacion(muestra)
+        texto = muestra.decode(self.encoding, errors='ignore')
+        try:
+            self.separador = csv.Sniffer().sniff('\n'.join(texto.splitlines()[:20]), delimiters=',;\t|').delimiter
+        except csv.Error:
+            self.separador = ','
+        encabezado = pd.read_csv(ruta, sep=self.separador, encoding=self.encoding, nrows=0)
+        self.columnas = [str(col) for col in encabezado.columns]
+        # Estimación por tamaño promedio de línea de la muestra, solo para progreso y ETA
+        lineas = texto.count('\n')
+        tamano = os.path.getsize(ruta)
+        self.filas_estimadas = max(1, int(tamano / (len(muestra) / lineas)) - 1) if lineas > 1 else None
+        self.filas_conocidas = False
+        self._lector = None
+
+    def __iter__(self):
+        self._lector = pd.read_csv(
+            self._ruta, sep=self.separador, encoding=self.encoding,
+            dtype=str, chunksize=self.tamano_bloque
+        )
+        yield from self._lector
+
+    def cerrar(self):
+        if self._lector is not None:
+            self._lector.close()
+
+
+class LectorParquet:
+    """Parquet leído por grupos de registros con pyarrow; el número de filas viene en los metadatos"""
+
+    def __init__(self, ruta, tamano_bloque):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ErrorImportacion('El servidor no tiene soporte para Parquet (instalar pyarrow)')
+        self.tamano_bloque = tamano_bloque
+        self._archivo = pq.ParquetFile(ruta)
+        self.columnas = [str(col) for col in self._archivo.schema_arrow.names]
+        self.filas_estimadas = self._archivo.metadata.num_rows
+        self.filas_conocidas = True
+
+    def __iter__(self):
+        inicio = 0
+        for lote in self._archivo.iter_batches(batch_size=self.tamano_bloque):
+            df = lote.to_pandas()
+            df.index = range(inicio, inicio + len(df))
+            inicio += len(df)
+            yield df
+
+    def cerrar(self):
+        self._archivo.close()
+
+
+def _codificacion(muestra):
+    """utf-8-sig si la muestra es UTF-8 válido (tolerando un carácter cortado al final), si no latin-1"""
+    try:
+        muestra.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if e.start < len(muestra) - 3:
+            return 'latin-1'
+    return 'utf-8-sig'
+
+
+def detectar_formato(ruta):
+    """Formato del archivo según su contenido: 'xlsx', 'xls', 'parquet' o 'csv'"""
+    with open(ruta, 'rb') as archivo:
+        inicio = archivo.read(64 * 1024)
+    if inicio.startswith(b'PK\x03\x04'):
+        return 'xlsx'
+    if inicio.startswith(b'\xd0\xcf\x11\xe0'):
+        return 'xls'
+    if inicio.startswith(b'PAR1'):
+        return 'parquet'
+    if inicio and b'\x00' not in inicio:
+        return 'csv'
+    raise ErrorImportacion('Formato no reconocido. Use .xlsx, .xls, .csv o .parquet')
+
+
+def abrir_lector(ruta, tamano_bloque, formato=None):
+    """
+    Lector por bloques del archivo subido según su contenido. .xlsx, CSV y Parquet se leen
+    en streaming; los .xls antiguos no tienen lector en streaming y se cargan con pandas.
+    """
+    formato = formato or detectar_formato(ruta)
+    if formato == 'xlsx':
+        return LectorXlsx(ruta, tamano_bloque)
+    if formato == 'parquet':
+        return LectorParquet(ruta, tamano_bloque)
+    if formato == 'csv':
+        with open(ruta, 'rb') as archivo:
+            return LectorCsv(ruta, tamano_bloque, archivo.read(64 * 1024))
+    return LectorDataFrame(pd.read_excel(ruta), tamano_bloque)
+
+
+def _importar_bloques(conn, trabajo, lector, tipo, id_user, tamano_lote, detector, al_avanzar):
+    esquema = ESQUEMAS[tipo]
+    columnas = esquema.resolver_columnas(lector.columnas)
+    if lector.filas_conocidas and lector.filas_estimadas > MAX_FILAS:
+        raise ErrorImportacion(f'El archivo tiene {lector.filas_estimadas} filas; el máximo es {MAX_FILAS}')
+
+    trabajo.total_filas = lector.filas_estimadas
+    transaccional = tabla_transaccional(conn)
+    if not transaccional:
+        print("[IMPORTACION] personas no es InnoDB: inserción fila por fila (ver convertir_innodb.py)")
+    lotes = []
+    for df in lector:
+        if trabajo.procesadas + len(df) > MAX_FILAS:
+            raise ErrorImportacion(
+                f'El archivo supera el máximo de {MAX_FILAS} filas; '
+                f'se importaron las primeras {trabajo.procesadas}'
+            )
+        df.columns = lector.columnas
+
+        filas, errores = esquema.preparar(df, columnas, id_user)
+        filas, actualizaciones, errores_duplicados = detector.filtrar(conn, filas)
+        insertados, errores_insercion, lotes_bloque = insertar_por_lotes(
+            conn, filas, tamano_lote, esquema.sql, transaccional
+        )
+        errores_actualizacion = detector.actualizar(conn, actualizaciones)
+        conn.commit()
+
+        for lote in lotes_bloque:
+            lote['lote'] = len(lotes) + 1
+            lotes.append(lote)
+        trabajo.procesadas += len(df)
+        trabajo.insertados += insertados
+        trabajo.errores.extend(errores + errores_duplicados + errores_insercion + errores_actualizacion)
+        if trabajo.total_filas is None or trabajo.procesadas > trabajo.total_filas:
+            trabajo.total_filas = trabajo.procesadas
+        if al_avanzar:
+            al_avanzar(conn, trabajo)
+            conn.commit()
+
+    # La estimación de la hoja pudo incluir filas vacías
+    trabajo.total_filas = trabajo.procesadas
+    return lotes
+
+
+def importar_archivo(conn, trabajo, ruta, tipo, id_user, tamano_lote=TAMANO_LOTE,
+                     modo_duplicados=MODO_DUPLICADOS, al_avanzar=None):
+    """
+    Importar el archivo en `ruta` (.xlsx, .xls, CSV o Parquet) para `trabajo` (ver trabajos.GestorTrabajos).
+    `tipo` es el esquema: 'excel' (plantilla de /api/importar-excel) o 'token' (plantilla de carga masiva).
+    El archivo se lee y se inserta por bloques de `tamano_lote` filas, con commit por bloque:
+    la memoria no crece con el tamaño del archivo y las primeras filas llegan a la BD antes
+    de terminar de leerlo. Los reportes repetidos se tratan según `modo_duplicados`
+    (ver MODOS_DUPLICADOS). `al_avanzar(conn, trabajo)` persiste el progreso.
+    """
+    tamano_archivo = os.path.getsize(ruta)
+    if tamano_archivo > MAX_BYTES:
+        raise ErrorImportacion(f'El archivo supera el máximo de {MAX_BYTES // (1024 * 1024)} MB')
+
+    formato = detectar_formato(ruta)
+    inicio = time.perf_counter()
+    lector = abrir_lector(ruta, tamano_lote, formato)
+    detector = DetectorDuplicados(ESQUEMAS[tipo], modo_duplicados)
+    try:
+        lotes = _importar_bloques(conn, trabajo, lector, tipo, id_user, tamano_lote, detector, al_avanzar)
+    finally:
+        lector.cerrar()
+    segundos = time.perf_counter() - inicio
+
+    trabajo.resultado = {
+        'total_filas': trabajo.total_filas,
+        'insertados': trabajo.insertados,
+        'errores': len(trabajo.errores),
+        **resumen_errores(trabajo.errores),
+        'tamano_lote': tamano_lote,
+        'lotes': lotes,
+        'duplicados': detector.resumen(),
+        # Rendimiento de la carga completa (lectura + validación + inserción) por formato
+        'formato': formato,
+        'bytes': tamano_archivo,
+        'segundos': round(segundos, 3),
+        'filas_por_segundo': round(trabajo.procesadas / segundos, 1) if segundos else None
+    }
+    trabajo.mensaje = (
+        f'{trabajo.insertados} registros importados, {detector.actualizados} actualizados, '
+        f'{detector.omitidos} duplicados omitidos, {len(trabajo.errores)} filas con error'
+    )
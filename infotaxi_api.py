@@ -3,20 +3,34 @@ API REST para Sistema InfoTaxi con Swagger UI
 Servicios de gestión de usuarios y reportes
 """
 
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, request, jsonify, send_file, render_template_string, g, has_request_context
 from flask_cors import CORS
 from flasgger import Swagger, swag_from
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.errors import PoolError
+import base64
+import fcntl
 import hashlib
+import hmac
+import json
 from datetime import datetime, timedelta
-import pandas as pd
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-import io
 import os
 import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from functools import wraps
+import consultas
+import estados
+import importacion
+import mantenimiento
+import migraciones
+import plantillas
+import tokens_carga
+import trabajos
 
 app = Flask(__name__)
 
@@ -28,7 +42,7 @@ CORS(app,
          r"/*": {
              "origins": "*",
              "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-             "allow_headers": ["Content-Type", "X-User-Celular", "Authorization", "Accept"],
+             "allow_headers": ["Content-Type", "X-User-Celular", "Authorization", "Accept", "Idempotency-Key"],
              "supports_credentials": False,
              "max_age": 3600
          }
@@ -206,7 +220,7 @@ def handle_preflight():
     if request.method == "OPTIONS":
         response = jsonify({'status': 'ok'})
         response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add('Access-Control-Allow-Headers', "Content-Type,X-User-Celular,Authorization,Accept")
+        response.headers.add('Access-Control-Allow-Headers', "Content-Type,X-User-Celular,Authorization,Accept,Idempotency-Key")
         response.headers.add('Access-Control-Allow-Methods', "GET,PUT,POST,DELETE,OPTIONS")
         response.headers.add('Access-Control-Max-Age', "3600")
         return response
@@ -215,7 +229,7 @@ def handle_preflight():
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,X-User-Celular,Authorization,Accept')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,X-User-Celular,Authorization,Accept,Idempotency-Key')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     response.headers.add('Access-Control-Max-Age', '3600')
     return response
@@ -253,15 +267,631 @@ DB_CONFIG = {
     'password': '9204a8246f7ed4fe49e6'
 }
 
+# ==================== POOL DE CONEXIONES ====================
+# Gunicorn corre 4 workers x 2 hilos (ver Dockerfile). Cada worker es un proceso
+# con su propio pool, así que el tamaño por worker se limita a sus hilos (más los
+# hilos de importación y de escritura en segundo plano) y al presupuesto total de
+# conexiones contra MariaDB repartido entre los workers.
+WEB_WORKERS = int(os.getenv('WEB_CONCURRENCY', 4))
+WEB_THREADS = int(os.getenv('GUNICORN_THREADS', 2))
+# Hilos por worker que también toman conexiones del pool: escritura diferida del contador
+# y del historial de consultas, de los estados de conversación, y el mantenimiento
+HILOS_SEGUNDO_PLANO = 4
+DB_MAX_CONEXIONES = int(os.getenv('DB_MAX_CONEXIONES', 20))
+
+DB_POOL_CONFIG = {
+    # Conexiones máximas por worker (0 = calcular desde hilos y presupuesto)
+    'tamano': int(os.getenv('DB_POOL_SIZE', 0)),
+    # Segundos que una petición espera por una conexión libre
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    # Conexiones inactivas por más de estos segundos se validan con ping
+    'validar_tras': float(os.getenv('DB_POOL_VALIDAR_TRAS', 30)),
+    # Conexiones inactivas por más de estos segundos se reciclan
+    'max_inactivo': float(os.getenv('DB_POOL_MAX_INACTIVO', 300)),
+    # Vida máxima de una conexión antes de reciclarla
+    'max_vida': float(os.getenv('DB_POOL_MAX_VIDA', 3600))
+}
+
+
+class PoolConexiones:
+    """Pool de conexiones MySQL por proceso, seguro entre hilos"""
+    
+    def __init__(self, config, tamano, timeout, validar_tras, max_inactivo, max_vida):
+        self.config = config
+        self.tamano = tamano
+        self.timeout = timeout
+        self.validar_tras = validar_tras
+        self.max_inactivo = max_inactivo
+        self.max_vida = max_vida
+        self._libres = deque()  # (conexion, creada_en, ultimo_uso)
+        self._en_uso = 0
+        self._cond = threading.Condition()
+        self._metricas = {
+            'checkouts': 0,
+            'esperas': 0,
+            'timeouts': 0,
+            'creadas': 0,
+            'recicladas': 0,
+            'validaciones_fallidas': 0,
+            'errores_conexion': 0
+        }
+    
+    def _crear(self):
+        conexion = mysql.connector.connect(**self.config)
+        with self._cond:
+            self._metricas['creadas'] += 1
+        return conexion, time.monotonic()
+    
+    def _descartar(self, conexion):
+        try:
+            conexion.close()
+        except Error:
+            pass
+    
+    def obtener(self):
+        """Tomar una conexión del pool, esperando hasta `timeout` si está agotado"""
+        limite = time.monotonic() + self.timeout
+        with self._cond:
+            self._metricas['checkouts'] += 1
+            espero = False
+            while not self._libres and self._en_uso >= self.tamano:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self._metricas['timeouts'] += 1
+                    raise PoolError(f'Pool agotado: {self.tamano} conexiones en uso')
+                if not espero:
+                    self._metricas['esperas'] += 1
+                    espero = True
+                self._cond.wait(restante)
+            entrada = self._libres.pop() if self._libres else None
+            self._en_uso += 1
+        
+        try:
+            if entrada is None:
+                return self._crear()
+            return self._validar(*entrada)
+        except Error:
+            with self._cond:
+                self._en_uso -= 1
+                self._metricas['errores_conexion'] += 1
+                self._cond.notify()
+            raise
+    
+    def _validar(self, conexion, creada_en, ultimo_uso):
+        """Reciclar conexiones viejas o inactivas y hacer ping a las sospechosas"""
+        ahora = time.monotonic()
+        inactiva = ahora - ultimo_uso
+        if ahora - creada_en > self.max_vida or inactiva > self.max_inactivo:
+            with self._cond:
+                self._metricas['recicladas'] += 1
+            self._descartar(conexion)
+            return self._crear()
+        if inactiva > self.validar_tras:
+            try:
+                conexion.ping(reconnect=False)
+            except Error:
+                with self._cond:
+                    self._metricas['validaciones_fallidas'] += 1
+                self._descartar(conexion)
+                return self._crear()
+        return conexion, creada_en
+    
+    def devolver(self, conexion, creada_en):
+        """Devolver una conexión al pool descartando cualquier transacción abierta"""
+        try:
+            if conexion.in_transaction:
+                conexion.rollback()
+            reutilizable = conexion.is_connected()
+        except Error:
+            reutilizable = False
+        
+        if not reutilizable:
+            self._descartar(conexion)
+        with self._cond:
+            self._en_uso -= 1
+            if reutilizable:
+                self._libres.append((conexion, creada_en, time.monotonic()))
+            self._cond.notify()
+    
+    def metricas(self):
+        with self._cond:
+            return dict(
+                self._metricas,
+                tamano=self.tamano,
+                en_uso=self._en_uso,
+                libres=len(self._libres)
+            )
+
+
+class ConexionPool:
+    """Conexión prestada por el pool; close() la devuelve en lugar de cerrarla"""
+    
+    def __init__(self, pool, conexion, creada_en):
+        self._pool = pool
+        self._conexion = conexion
+        self._creada_en = creada_en
+    
+    def __getattr__(self, nombre):
+        return getattr(self._conexion, nombre)
+    
+    def close(self):
+        if self._conexion is not None:
+            conexion, self._conexion = self._conexion, None
+            self._pool.devolver(conexion, self._creada_en)
+    
+    def is_connected(self):
+        return self._conexion is not None and self._conexion.is_connected()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Pool del proceso actual (se recrea tras el fork de cada worker de gunicorn)"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                por_worker = max(1, DB_MAX_CONEXIONES // max(1, WEB_WORKERS))
+                tamano = min(
+                    DB_POOL_CONFIG['tamano'] or WEB_THREADS + trabajos.HILOS_IMPORTACION + HILOS_SEGUNDO_PLANO,
+                    por_worker
+                )
+                _pool = PoolConexiones(
+                    DB_CONFIG,
+                    tamano,
+                    DB_POOL_CONFIG['timeout'],
+                    DB_POOL_CONFIG['validar_tras'],
+                    DB_POOL_CONFIG['max_inactivo'],
+                    DB_POOL_CONFIG['max_vida']
+                )
+                _pool_pid = pid
+    return _pool
+
 def get_db_connection():
-    """Crear conexión a la base de datos"""
+    """Tomar una conexión del pool (devolverla con close() o usar conexion_bd())"""
+    pool = get_pool()
     try:
-        connection = mysql.connector.connect(**DB_CONFIG)
-        return connection
+        conexion, creada_en = pool.obtener()
+        return ConexionPool(pool, conexion, creada_en)
     except Error as e:
         print(f"Error conectando a MySQL: {e}")
         return None
 
+def sesion_bd():
+    """Conexión de la petición actual: autenticación y handler comparten una
+    conexión y una transacción, que se devuelve al pool en teardown_request"""
+    if 'conexion_bd' not in g:
+        g.conexion_bd = get_db_connection()
+    return g.conexion_bd
+
+@app.teardown_request
+def liberar_sesion_bd(exc):
+    """Devolver al pool la conexión de la petición (con rollback si quedó abierta)"""
+    conn = g.pop('conexion_bd', None)
+    if conn:
+        conn.close()
+
+@contextmanager
+def conexion_bd():
+    """Prestar una conexión del pool durante el bloque `with` (None si no hay conexión).
+    Si la petición ya tiene sesión abierta (ver sesion_bd) se reutiliza esa."""
+    if has_request_context() and g.get('conexion_bd'):
+        yield g.conexion_bd
+        return
+    
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        if conn:
+            conn.close()
+
+# ==================== CACHÉ EN MEMORIA ====================
+# Directorio donde los workers publican invalidaciones entre procesos
+CACHE_DIR = os.getenv('CACHE_DIR', tempfile.gettempdir())
+
+
+class CacheTTL:
+    """Caché LRU acotada con expiración por entrada, segura entre hilos.
+    
+    Cada worker de gunicorn tiene su propia copia. Para que invalidar() tenga
+    efecto inmediato en todos los workers, cada invalidación incrementa el contador
+    de un archivo de generación compartido; los demás workers lo comparan en cada
+    lectura y vacían su copia si cambió. guardar() descarta el valor si hubo una
+    invalidación desde el fallo de obtener() que llevó a leerlo de la BD.
+    """
+    
+    def __init__(self, nombre, tamano, ttl):
+        self.nombre = nombre
+        self.tamano = tamano
+        self.ttl = ttl
+        self._datos = OrderedDict()  # clave -> (valor, expira_en)
+        self._lock = threading.Lock()
+        # Generación vista por cada hilo en su último fallo de obtener()
+        self._local = threading.local()
+        self._archivo_generacion = os.path.join(CACHE_DIR, f'infotaxi_cache_{nombre}.gen')
+        self._generacion = self._leer_generacion()
+        self._metricas = {
+            'hits': 0,
+            'misses': 0,
+            'expirados': 0,
+            'desalojados': 0,
+            'invalidaciones': 0,
+            'invalidaciones_externas': 0,
+            'descartados': 0
+        }
+    
+    def _leer_generacion(self):
+        """Contador del archivo de generación; None si se está reescribiendo (cuenta como cambio)"""
+        try:
+            with open(self._archivo_generacion) as archivo:
+                return int(archivo.read() or 0)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError):
+            return None
+    
+    def _publicar_generacion(self):
+        """Incrementar el contador compartido (con flock para no perder incrementos concurrentes)"""
+        with open(self._archivo_generacion, 'a+') as archivo:
+            fcntl.flock(archivo, fcntl.LOCK_EX)
+            try:
+                archivo.seek(0)
+                try:
+                    generacion = int(archivo.read() or 0) + 1
+                except ValueError:
+                    generacion = time.time_ns()
+                archivo.seek(0)
+                archivo.truncate()
+                archivo.write(str(generacion))
+                archivo.flush()
+            finally:
+                fcntl.flock(archivo, fcntl.LOCK_UN)
+        return generacion
+    
+    def _sincronizar(self):
+        """True si otro worker invalidó desde la última lectura (y se vació la copia local)"""
+        generacion = self._leer_generacion()
+        if generacion is None or generacion != self._generacion:
+            self._datos.clear()
+            self._generacion = generacion
+            self._metricas['invalidaciones_externas'] += 1
+            return True
+        return False
+    
+    def obtener(self, clave):
+        """Valor vigente para `clave` o None"""
+        with self._lock:
+            self._sincronizar()
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self._metricas['misses'] += 1
+                self._local.generacion = self._generacion
+                return None
+            valor, expira_en = entrada
+            if expira_en < time.monotonic():
+                del self._datos[clave]
+                self._metricas['expirados'] += 1
+                self._metricas['misses'] += 1
+                self._local.generacion = self._generacion
+                return None
+            self._datos.move_to_end(clave)
+            self._metricas['hits'] += 1
+            return valor
+    
+    def guardar(self, clave, valor):
+        """Guardar `valor` salvo que se haya invalidado algo desde el último fallo de obtener() de este hilo"""
+        with self._lock:
+            self._sincronizar()
+            visto = getattr(self._local, 'generacion', self._generacion)
+            self._local.generacion = None
+            if self._generacion is None or (visto is not None and visto != self._generacion):
+                self._metricas['descartados'] += 1
+                return
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.tamano:
+                self._datos.popitem(last=False)
+                self._metricas['desalojados'] += 1
+    
+    def invalidar(self, clave):
+        """Eliminar `clave` en este worker y avisar a los demás"""
+        with self._lock:
+            self._datos.pop(clave, None)
+            self._metricas['invalidaciones'] += 1
+            try:
+                anterior, self._generacion = self._generacion, self._publicar_generacion()
+                # Si el contador avanzó más de uno, otro worker también invalidó algo
+                if anterior is None or self._generacion != anterior + 1:
+                    self._datos.clear()
+            except OSError as e:
+                print(f"[CACHE] No se pudo publicar invalidación de {self.nombre}: {e}")
+    
+    def vaciar(self):
+        """Invalidar todas las claves (cambios masivos, p. ej. importaciones)"""
+        with self._lock:
+            self._datos.clear()
+        self.invalidar(None)
+    
+    def metricas(self):
+        with self._lock:
+            return dict(self._metricas, tamano=self.tamano, ttl=self.ttl, entradas=len(self._datos))
+
+
+# Usuarios activos resueltos por X-User-Celular (solo se cachean aciertos)
+usuarios_cache = CacheTTL(
+    'usuarios',
+    int(os.getenv('USUARIOS_CACHE_TAMANO', 1000)),
+    float(os.getenv('USUARIOS_CACHE_TTL', 60))
+)
+
+# Reportes ya formateados por cédula (también las cédulas sin reportes, como lista vacía)
+personas_cache = CacheTTL(
+    'personas',
+    int(os.getenv('PERSONAS_CACHE_TAMANO', 5000)),
+    float(os.getenv('PERSONAS_CACHE_TTL', 300))
+)
+
+# ==================== REGISTRO DE CONSULTAS ====================
+# Incrementos atómicos; los usuarios muy activos se escriben en bloque cada CONSULTAS_FLUSH_SEGUNDOS
+contador_consultas = consultas.ContadorConsultas(conexion_bd)
+# Historial por cédula: se encola en memoria y se escribe por lotes desde un hilo
+historial_consultas = consultas.HistorialConsultas(conexion_bd)
+
+# ==================== ESTADO DE CONVERSACIÓN ====================
+# Lecturas desde el almacén local (ESTADOS_BACKEND) y escritura diferida a user_state
+estados_conversacion = estados.EstadosConversacion(conexion_bd, estados.crear_almacen())
+
+# ==================== TRABAJOS DE IMPORTACIÓN ====================
+# Los archivos subidos se guardan aquí hasta que el trabajo termina
+IMPORTAR_DIR = os.getenv('IMPORTAR_DIR', tempfile.gettempdir())
+
+trabajos_importacion = trabajos.GestorTrabajos(conexion_bd)
+
+
+def _procesar_importacion(conn, trabajo, ruta, tipo, id_user, tamano_lote, modo_duplicados):
+    try:
+        importacion.importar_archivo(
+            conn, trabajo, ruta, tipo, id_user, tamano_lote, modo_duplicados,
+            al_avanzar=trabajos_importacion.persistir
+        )
+    finally:
+        # Los bloques ya confirmados son visibles aunque el trabajo falle después
+        personas_cache.vaciar()
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+
+def iniciar_importacion(conn, archivo, tipo, id_user, tamano_lote, modo_duplicados, esperar=False):
+    """
+    Guardar el archivo subido (.xlsx, .xls, CSV o Parquet) y procesarlo en segundo plano.
+    Con `esperar` se procesa en la misma petición (clientes que necesitan el resultado en la respuesta).
+    Si el mismo usuario ya subió el mismo archivo (SHA-256) se devuelve ese trabajo.
+    """
+    # Se guarda y se calcula el SHA-256 en la misma pasada
+    descriptor, ruta = tempfile.mkstemp(prefix='infotaxi_importacion_', dir=IMPORTAR_DIR)
+    huella = hashlib.sha256()
+    with os.fdopen(descriptor, 'wb') as destino:
+        for bloque in iter(lambda: archivo.stream.read(1024 * 1024), b''):
+            huella.update(bloque)
+            destino.write(bloque)
+    hash_archivo = huella.hexdigest()
+
+    # Reintento del mismo archivo por el mismo usuario: se devuelve el trabajo anterior sin reprocesar
+    previo = trabajos_importacion.buscar_repetido(conn, tipo, id_user, hash_archivo)
+    if previo:
+        os.remove(ruta)
+        previo.reutilizado = True
+        print(f"[IMPORTACION] Archivo repetido de usuario {id_user}, se reutiliza el trabajo {previo.id}")
+        return previo
+
+    # El formato se detecta por contenido, no por la extensión; si no se reconoce se rechaza de inmediato
+    try:
+        importacion.detectar_formato(ruta)
+    except importacion.ErrorImportacion:
+        os.remove(ruta)
+        raise
+
+    args = (ruta, tipo, id_user, tamano_lote, modo_duplicados)
+    if esperar:
+        return trabajos_importacion.ejecutar_ahora(
+            tipo, id_user, _procesar_importacion, *args, hash_archivo=hash_archivo
+        )
+    try:
+        return trabajos_importacion.encolar(
+            conn, tipo, id_user, _procesar_importacion, *args, hash_archivo=hash_archivo
+        )
+    except Exception:
+        os.remove(ruta)
+        raise
+
+
+def respuesta_trabajo_encolado(trabajo):
+    return jsonify({
+        'success': True,
+        'message': (
+            'Este archivo ya se importó o se está importando' if trabajo.reutilizado
+            else 'Archivo recibido, la importación se procesa en segundo plano'
+        ),
+        'trabajo_id': trabajo.id,
+        'estado': trabajo.estado,
+        'estado_url': f'/api/importaciones/{trabajo.id}',
+        'reutilizado': trabajo.reutilizado
+    }), 202
+
+
+def solicita_esperar():
+    return str(request.values.get('esperar', '')).lower() in ('1', 'true', 'si', 'sí')
+
+# ==================== IDEMPOTENCIA ====================
+# Respuestas guardadas por Idempotency-Key en la BD (compartidas entre workers)
+IDEMPOTENCIA_HORAS = int(os.getenv('IDEMPOTENCIA_HORAS', 24))
+# Una clave reservada sin respuesta por más de estos segundos se da por abandonada (worker caído o
+# timeout de gunicorn) y el siguiente reintento la toma; debe superar el timeout de gunicorn (120 s)
+IDEMPOTENCIA_RESERVA_SEGUNDOS = int(os.getenv('IDEMPOTENCIA_RESERVA_SEGUNDOS', 300))
+
+
+def _descartar_pendiente(conn):
+    """Lo que el endpoint dejó sin confirmar en la conexión compartida se descarta (como en teardown)
+    para que el commit de la clave no lo confirme"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except Error as e:
+        print(f"[ERROR] No se pudo descartar la transacción del endpoint: {str(e)}")
+
+
+def _liberar_idempotencia(conn, ambito, clave):
+    _descartar_pendiente(conn)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM idempotencia WHERE ambito = %s AND clave = %s", (ambito, clave))
+        conn.commit()
+    except Error as e:
+        print(f"[ERROR] No se pudo liberar la Idempotency-Key: {str(e)}")
+    finally:
+        cursor.close()
+
+
+def idempotente(f):
+    """
+    Si un POST trae Idempotency-Key, la primera respuesta (que no sea 5xx) se guarda y los reintentos
+    con la misma clave la reciben sin ejecutar de nuevo el endpoint.
+    Misma clave con otro cuerpo -> 422; misma clave mientras la primera sigue en curso -> 409.
+    Una reserva sin respuesta más antigua que IDEMPOTENCIA_RESERVA_SEGUNDOS la toma el reintento.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        clave = request.headers.get('Idempotency-Key', '').strip()
+        if request.method != 'POST' or not clave:
+            return f(*args, **kwargs)
+
+        if len(clave) > 100:
+            return jsonify({'success': False, 'message': 'Idempotency-Key admite máximo 100 caracteres'}), 400
+
+        ambito = f"{request.endpoint}:{request.headers.get('X-User-Celular', '')}"[:150]
+        huella = hashlib.sha256(request.get_data()).hexdigest()
+
+        # Misma conexión de la petición que usa el endpoint (ver sesion_bd): no se toma una segunda del pool
+        conn = sesion_bd()
+        if not conn:
+            return f(*args, **kwargs)
+
+        # Reservar la clave; si ya existe, leer la respuesta guardada
+        cursor = conn.cursor(dictionary=True)
+        try:
+            ahora = datetime.now()
+            cursor.execute(
+                "DELETE FROM idempotencia WHERE ambito = %s AND clave = %s AND creado_en < %s",
+                (ambito, clave, ahora - timedelta(hours=IDEMPOTENCIA_HORAS))
+            )
+            cursor.execute("""
+                INSERT IGNORE INTO idempotencia (ambito, clave, huella, creado_en)
+                VALUES (%s, %s, %s, %s)
+            """, (ambito, clave, huella, ahora))
+            previa = None
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    "SELECT huella, codigo, cuerpo, creado_en FROM idempotencia WHERE ambito = %s AND clave = %s",
+                    (ambito, clave)
+                )
+                previa = cursor.fetchone()
+                if previa and previa['codigo'] is None and previa['huella'] == huella \
+                        and previa['creado_en'] < ahora - timedelta(seconds=IDEMPOTENCIA_RESERVA_SEGUNDOS):
+                    # Reserva abandonada: la toma este reintento. La condición sobre creado_en deja
+                    # que solo uno de varios reintentos simultáneos la gane; los demás reciben 409.
+                    cursor.execute("""
+                        UPDATE idempotencia SET creado_en = %s
+                        WHERE ambito = %s AND clave = %s AND codigo IS NULL AND creado_en = %s
+                    """, (ahora, ambito, clave, previa['creado_en']))
+                    if cursor.rowcount == 1:
+                        print(f"[DEBUG] Idempotency-Key abandonada en {request.endpoint}, se procesa de nuevo")
+                        previa = None
+            conn.commit()
+        except Error as e:
+            print(f"[ERROR] Idempotencia no disponible: {str(e)}")
+            conn.rollback()
+            return f(*args, **kwargs)
+        finally:
+            cursor.close()
+
+        if previa:
+            if previa['huella'] != huella:
+                return jsonify({
+                    'success': False,
+                    'message': 'Idempotency-Key ya usada con un cuerpo diferente'
+                }), 422
+            if previa['codigo'] is None:
+                return jsonify({
+                    'success': False,
+                    'message': 'Hay una petición con la misma Idempotency-Key en curso'
+                }), 409
+            print(f"[DEBUG] Idempotency-Key repetida en {request.endpoint}, se devuelve la respuesta guardada")
+            respuesta = app.response_class(previa['cuerpo'], status=previa['codigo'], mimetype='application/json')
+            respuesta.headers['Idempotent-Replayed'] = 'true'
+            return respuesta
+
+        try:
+            respuesta = app.make_response(f(*args, **kwargs))
+        except Exception:
+            _liberar_idempotencia(conn, ambito, clave)
+            raise
+
+        if respuesta.status_code >= 500:
+            # Error del servidor: se libera la clave para que el reintento se procese
+            _liberar_idempotencia(conn, ambito, clave)
+            return respuesta
+
+        _descartar_pendiente(conn)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "UPDATE idempotencia SET codigo = %s, cuerpo = %s WHERE ambito = %s AND clave = %s",
+                (respuesta.status_code, respuesta.get_data(as_text=True), ambito, clave)
+            )
+            conn.commit()
+        except Error as e:
+            print(f"[ERROR] No se pudo guardar la respuesta idempotente: {str(e)}")
+        finally:
+            cursor.close()
+        return respuesta
+
+    return decorated_function
+
+# ==================== MANTENIMIENTO ====================
+# Borrado periódico (fuera de las peticiones) de filas vencidas
+def _antes_de(**delta):
+    return lambda: (datetime.now() - timedelta(**delta),)
+
+
+tareas_mantenimiento = [
+    mantenimiento.Tarea('token_carga', "DELETE FROM token_carga WHERE expiracion < NOW() LIMIT %s"),
+    mantenimiento.Tarea(
+        'idempotencia', "DELETE FROM idempotencia WHERE creado_en < %s LIMIT %s",
+        _antes_de(hours=IDEMPOTENCIA_HORAS)
+    ),
+]
+# Conversaciones abandonadas: las que ya no se devuelven por vencidas (ESTADOS_TTL_SEGUNDOS)
+if estados.TTL_SEGUNDOS:
+    tareas_mantenimiento.append(mantenimiento.Tarea(
+        'user_state', "DELETE FROM user_state WHERE updated_at < %s LIMIT %s",
+        _antes_de(seconds=estados.TTL_SEGUNDOS)
+    ))
+
+barredor = mantenimiento.Barredor(conexion_bd, tareas_mantenimiento)
+
+
+@app.before_request
+def iniciar_mantenimiento():
+    # El hilo se crea en el worker (después del fork de gunicorn), con la primera petición
+    if os.getenv('MANTENIMIENTO_ACTIVO', 'true').lower() == 'true':
+        barredor.iniciar()
+
 # ==================== DECORADOR DE AUTENTICACIÓN ====================
 def verificar_usuario(f):
     """Decorador para verificar que el usuario existe por número de celular"""
@@ -275,7 +905,13 @@ def verificar_usuario(f):
                 'message': 'Número de celular requerido en headers (X-User-Celular)'
             }), 401
         
-        conn = get_db_connection()
+        usuario = usuarios_cache.obtener(celular)
+        if usuario:
+            request.usuario = dict(usuario)
+            return f(*args, **kwargs)
+        
+        # La conexión queda en la sesión de la petición para que el handler la reutilice
+        conn = sesion_bd()
         if not conn:
             return jsonify({'success': False, 'message': 'Error de conexión a BD'}), 500
         
@@ -293,14 +929,13 @@ def verificar_usuario(f):
                     'message': 'Usuario no encontrado o inactivo'
                 }), 403
             
-            request.usuario = usuario
+            usuarios_cache.guardar(celular, usuario)
+            request.usuario = dict(usuario)
             
         except Error as e:
             return jsonify({'success': False, 'message': str(e)}), 500
         finally:
-            if conn.is_connected():
-                cursor.close()
-                conn.close()
+            cursor.close()
         
         return f(*args, **kwargs)
     
@@ -377,48 +1012,47 @@ def verificar_usuario_existe():
             'message': 'Número de celular requerido'
         }), 400
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
-    
-    try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT id_user, username, nombres, Celular, rol, isactive 
-            FROM users 
-            WHERE Celular = %s
-        """, (celular,))
-        
-        usuario = cursor.fetchone()
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        if usuario:
-            return jsonify({
-                'success': True,
-                'exists': True,
-                'usuario': {
-                    'id': usuario['id_user'],
-                    'nombre': usuario['nombres'],
-                    'email': usuario['username'],
-                    'rol': usuario['rol'],
-                    'activo': bool(usuario['isactive'])
-                }
-            }), 200
-        else:
-            return jsonify({
-                'success': True,
-                'exists': False,
-                'message': 'Usuario no encontrado'
-            }), 200
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute("""
+                SELECT id_user, username, nombres, Celular, rol, isactive 
+                FROM users 
+                WHERE Celular = %s
+            """, (celular,))
             
-    except Error as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
+            usuario = cursor.fetchone()
+            
+            if usuario:
+                return jsonify({
+                    'success': True,
+                    'exists': True,
+                    'usuario': {
+                        'id': usuario['id_user'],
+                        'nombre': usuario['nombres'],
+                        'email': usuario['username'],
+                        'rol': usuario['rol'],
+                        'activo': bool(usuario['isactive'])
+                    }
+                }), 200
+            else:
+                return jsonify({
+                    'success': True,
+                    'exists': False,
+                    'message': 'Usuario no encontrado'
+                }), 200
+                
+        except Error as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
             cursor.close()
-            conn.close()
 
 # ==================== SERVICIO 2: CREAR USUARIO ====================
 @app.route('/api/usuarios', methods=['POST', 'OPTIONS'])
+@idempotente
 def crear_usuario():
     """
     Crear nuevo usuario con rol 'usuario'
@@ -426,6 +1060,11 @@ def crear_usuario():
     tags:
       - Usuarios
     parameters:
+      - name: Idempotency-Key
+        in: header
+        type: string
+        required: false
+        description: Clave única del cliente; un reintento con la misma clave recibe la respuesta original
       - name: body
         in: body
         required: true
@@ -480,7 +1119,7 @@ def crear_usuario():
         if request.method == 'OPTIONS':
             response = jsonify({'status': 'ok'})
             response.headers.add("Access-Control-Allow-Origin", "*")
-            response.headers.add('Access-Control-Allow-Headers', "Content-Type,X-User-Celular,Authorization")
+            response.headers.add('Access-Control-Allow-Headers', "Content-Type,X-User-Celular,Authorization,Idempotency-Key")
             response.headers.add('Access-Control-Allow-Methods', "GET,PUT,POST,DELETE,OPTIONS")
             return response
         
@@ -521,106 +1160,104 @@ def crear_usuario():
             return response, 400
         
         print(f"[DEBUG] Conectando a la base de datos...")
-        conn = get_db_connection()
-        if not conn:
-            print("[ERROR] No se pudo conectar a la base de datos")
-            response = jsonify({'success': False, 'message': 'Error de conexión a la base de datos'})
-            response.headers.add('Access-Control-Allow-Origin', '*')
-            return response, 500
-        
-        print(f"[DEBUG] Conexión a BD exitosa")
-        
-        try:
-            print(f"[DEBUG] Creando cursor...")
-            cursor = conn.cursor()
+        with conexion_bd() as conn:
+            if not conn:
+                print("[ERROR] No se pudo conectar a la base de datos")
+                response = jsonify({'success': False, 'message': 'Error de conexión a la base de datos'})
+                response.headers.add('Access-Control-Allow-Origin', '*')
+                return response, 500
             
-            # Verificar si el usuario ya existe
-            print(f"[DEBUG] Verificando si el usuario ya existe...")
-            cursor.execute("SELECT id_user FROM users WHERE Celular = %s OR username = %s",
-                          (data['celular'], data['username']))
-            existing = cursor.fetchone()
-            if existing:
-                print(f"[WARN] Usuario ya existe: {existing}")
+            print(f"[DEBUG] Conexión a BD exitosa")
+            
+            try:
+                print(f"[DEBUG] Creando cursor...")
+                cursor = conn.cursor()
+                
+                # Verificar si el usuario ya existe
+                print(f"[DEBUG] Verificando si el usuario ya existe...")
+                cursor.execute("SELECT id_user FROM users WHERE Celular = %s OR username = %s",
+                              (data['celular'], data['username']))
+                existing = cursor.fetchone()
+                if existing:
+                    print(f"[WARN] Usuario ya existe: {existing}")
+                    response = jsonify({
+                        'success': False,
+                        'message': 'Ya existe un usuario con ese celular o email'
+                    })
+                    response.headers.add('Access-Control-Allow-Origin', '*')
+                    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,X-User-Celular,Authorization,Accept')
+                    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+                    return response, 409
+                
+                # Validar que los campos no estén vacíos
+                if not data['username'] or not data['nombres'] or not data['celular'] or not data['password']:
+                    print(f"[ERROR] Campos vacíos detectados")
+                    response = jsonify({
+                        'success': False,
+                        'message': 'Todos los campos son requeridos y no pueden estar vacíos'
+                    })
+                    response.headers.add('Access-Control-Allow-Origin', '*')
+                    return response, 400
+                
+                # Hash de la contraseña
+                print(f"[DEBUG] Generando hash de contraseña...")
+                password_hash = hashlib.sha1(data['password'].encode()).hexdigest()
+                
+                # Insertar nuevo usuario
+                print(f"[DEBUG] Insertando nuevo usuario...")
+                query = """
+                    INSERT INTO users (username, nombres, Celular, rol, password, isactive, ultima_cone, ip, token)
+                    VALUES (%s, %s, %s, 'usuario', %s, 1, NOW(), '0.0.0.0', '')
+                """
+                cursor.execute(query, (
+                    data['username'],
+                    data['nombres'],
+                    data['celular'],
+                    password_hash
+                ))
+                conn.commit()
+                usuarios_cache.invalidar(data['celular'])
+                
+                user_id = cursor.lastrowid
+                print(f"[SUCCESS] Usuario creado exitosamente con ID: {user_id}")
+                
                 response = jsonify({
-                    'success': False,
-                    'message': 'Ya existe un usuario con ese celular o email'
+                    'success': True,
+                    'message': 'Usuario creado exitosamente',
+                    'id_user': user_id
                 })
                 response.headers.add('Access-Control-Allow-Origin', '*')
                 response.headers.add('Access-Control-Allow-Headers', 'Content-Type,X-User-Celular,Authorization,Accept')
                 response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-                return response, 409
-            
-            # Validar que los campos no estén vacíos
-            if not data['username'] or not data['nombres'] or not data['celular'] or not data['password']:
-                print(f"[ERROR] Campos vacíos detectados")
+                response.headers.add('Access-Control-Max-Age', '3600')
+                return response, 201
+                
+            except Error as e:
+                print(f"[ERROR] Error de base de datos: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                if conn and conn.is_connected():
+                    conn.rollback()
                 response = jsonify({
                     'success': False,
-                    'message': 'Todos los campos son requeridos y no pueden estar vacíos'
+                    'message': f'Error de base de datos: {str(e)}'
                 })
                 response.headers.add('Access-Control-Allow-Origin', '*')
-                return response, 400
-            
-            # Hash de la contraseña
-            print(f"[DEBUG] Generando hash de contraseña...")
-            password_hash = hashlib.sha1(data['password'].encode()).hexdigest()
-            
-            # Insertar nuevo usuario
-            print(f"[DEBUG] Insertando nuevo usuario...")
-            query = """
-                INSERT INTO users (username, nombres, Celular, rol, password, isactive, ultima_cone, ip, token)
-                VALUES (%s, %s, %s, 'usuario', %s, 1, NOW(), '0.0.0.0', '')
-            """
-            cursor.execute(query, (
-                data['username'],
-                data['nombres'],
-                data['celular'],
-                password_hash
-            ))
-            conn.commit()
-            
-            user_id = cursor.lastrowid
-            print(f"[SUCCESS] Usuario creado exitosamente con ID: {user_id}")
-            
-            response = jsonify({
-                'success': True,
-                'message': 'Usuario creado exitosamente',
-                'id_user': user_id
-            })
-            response.headers.add('Access-Control-Allow-Origin', '*')
-            response.headers.add('Access-Control-Allow-Headers', 'Content-Type,X-User-Celular,Authorization,Accept')
-            response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-            response.headers.add('Access-Control-Max-Age', '3600')
-            return response, 201
-            
-        except Error as e:
-            print(f"[ERROR] Error de base de datos: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            if conn and conn.is_connected():
-                conn.rollback()
-            response = jsonify({
-                'success': False,
-                'message': f'Error de base de datos: {str(e)}'
-            })
-            response.headers.add('Access-Control-Allow-Origin', '*')
-            return response, 500
-        except Exception as e:
-            print(f"[ERROR] Error inesperado: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            if conn and conn.is_connected():
-                conn.rollback()
-            response = jsonify({
-                'success': False,
-                'message': f'Error inesperado: {str(e)}'
-            })
-            response.headers.add('Access-Control-Allow-Origin', '*')
-            return response, 500
-        finally:
-            if conn and conn.is_connected():
+                return response, 500
+            except Exception as e:
+                print(f"[ERROR] Error inesperado: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                if conn and conn.is_connected():
+                    conn.rollback()
+                response = jsonify({
+                    'success': False,
+                    'message': f'Error inesperado: {str(e)}'
+                })
+                response.headers.add('Access-Control-Allow-Origin', '*')
+                return response, 500
+            finally:
                 cursor.close()
-                conn.close()
-                print(f"[DEBUG] Conexión cerrada")
                 
     except Exception as e:
         # Capturar cualquier error no manejado
@@ -636,15 +1273,175 @@ def crear_usuario():
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
         return response, 500
 
-# ==================== SERVICIO 3A: CONSULTAR MIS REPORTES POR CÉDULA ====================
-@app.route('/api/mis-reportes/<cedula>', methods=['GET'])
-@verificar_usuario
-def consultar_mis_reportes(cedula):
-    """
-    Consultar reportes propios por número de cédula
-    ---
-    tags:
-      - Reportes
+# ==================== PAGINACIÓN DE REPORTES ====================
+# Orden de los listados: Fecha_Reporte DESC, id DESC (sin fecha al final). El cursor es la última
+# (fecha, id) entregada, así la página siguiente no depende de OFFSET ni de reportes nuevos.
+# Paginar es opcional: sin ?limite= ni ?cursor= la respuesta trae todos los reportes, como antes
+# (los flujos de n8n esperan la lista completa). REPORTES_POR_PAGINA es el tamaño de página cuando
+# llega un cursor sin ?limite=.
+REPORTES_POR_PAGINA = int(os.getenv('REPORTES_POR_PAGINA', 50))
+REPORTES_POR_PAGINA_MAX = int(os.getenv('REPORTES_POR_PAGINA_MAX', 200))
+
+# Campos que cada listado acepta en ?fields=
+CAMPOS_REPORTE = (
+    'id', 'fecha_reporte', 'numero_documento', 'nombres', 'apellidos', 'placa',
+    'valor_reporte', 'descripcion', 'estado', 'reportante_nombres'
+)
+CAMPOS_PERSONA = CAMPOS_REPORTE + ('fecha_cierre', 'vehiculo_afiliado')
+
+
+def codificar_cursor(fecha, id_reporte):
+    datos = json.dumps([fecha, id_reporte], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(datos).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(valor):
+    """(fecha ISO o None, id) del cursor; ValueError si no es un cursor emitido por la API"""
+    try:
+        fecha, id_reporte = json.loads(base64.urlsafe_b64decode(valor + '=' * (-len(valor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('cursor inválido')
+    if not isinstance(id_reporte, int) or not (fecha is None or isinstance(fecha, str)):
+        raise ValueError('cursor inválido')
+    return fecha, id_reporte
+
+
+def pagina_solicitada(campos_validos):
+    """
+    (limite, despues, campos) de ?limite=&cursor=&fields=; limite es None (sin paginar) si no
+    llegan ni ?limite= ni ?cursor=.
+    ValueError con el mensaje para el cliente si el cursor o algún campo no son válidos.
+    """
+    cursor = request.args.get('cursor')
+    despues = decodificar_cursor(cursor) if cursor else None
+
+    try:
+        limite = max(1, min(int(request.args.get('limite')), REPORTES_POR_PAGINA_MAX))
+    except (TypeError, ValueError):
+        limite = REPORTES_POR_PAGINA if despues is not None else None
+
+    return limite, despues, campos_solicitados(campos_validos)
+
+
+def campos_solicitados(campos_validos):
+    """Lista de ?fields= (None = todos); ValueError si alguno no está en `campos_validos`"""
+    campos = [c.strip() for c in request.args.get('fields', '').split(',') if c.strip()] or None
+    if campos:
+        desconocidos = [c for c in campos if c not in campos_validos]
+        if desconocidos:
+            raise ValueError(
+                f'Campos no válidos: {", ".join(desconocidos)}. Disponibles: {", ".join(campos_validos)}'
+            )
+    return campos
+
+
+def filtro_cursor(despues):
+    """Condición SQL (y parámetros) para las filas que van después de `despues` en el orden del listado"""
+    if despues is None:
+        return '', ()
+    fecha, id_reporte = despues
+    if fecha is None:
+        return " AND p.Fecha_Reporte IS NULL AND p.id < %s", (id_reporte,)
+    return (
+        " AND (p.Fecha_Reporte < %s OR (p.Fecha_Reporte = %s AND p.id < %s) OR p.Fecha_Reporte IS NULL)",
+        (fecha, fecha, id_reporte)
+    )
+
+
+def paginar_en_memoria(reportes, limite, despues):
+    """Mismo corte que filtro_cursor sobre una lista ya ordenada y formateada; limite None = todo"""
+    if despues is not None:
+        fecha, id_reporte = despues
+        if fecha is None:
+            reportes = [r for r in reportes if r['fecha_reporte'] is None and r['id'] < id_reporte]
+        else:
+            reportes = [
+                r for r in reportes
+                if r['fecha_reporte'] is None or r['fecha_reporte'] < fecha
+                or (r['fecha_reporte'] == fecha and r['id'] < id_reporte)
+            ]
+    if limite is None:
+        return reportes, None
+    pagina = reportes[:limite]
+    siguiente = None
+    if len(reportes) > limite:
+        siguiente = codificar_cursor(pagina[-1]['fecha_reporte'], pagina[-1]['id'])
+    return pagina, siguiente
+
+
+def elegir_campos(reportes, campos):
+    if not campos:
+        return reportes
+    return [{campo: r[campo] for campo in campos} for r in reportes]
+
+
+def listar_reportes(cursor, cedula, limite, despues, id_reportante=None):
+    """
+    Página de reportes de la cédula (opcionalmente solo los de `id_reportante`); limite None = todos.
+    Retorna (reportes formateados, siguiente_cursor, total de reportes de la cédula).
+    """
+    condicion = "p.Numero_Documento = %s"
+    parametros = [cedula]
+    if id_reportante is not None:
+        condicion += " AND p.id_reportante = %s"
+        parametros.append(id_reportante)
+
+    filtro, parametros_cursor = filtro_cursor(despues)
+    tope, parametros_tope = ('LIMIT %s', (limite + 1,)) if limite is not None else ('', ())
+    cursor.execute(f"""
+        SELECT p.id, p.Fecha_Reporte, p.Numero_Documento, p.Nombres, p.Apellidos,
+               p.Placa, p.Valor_Reporte, p.Descripcion_Reporte,
+               p.Estado, u.nombres as Reportante_Nombres
+        FROM personas p
+        INNER JOIN users u ON p.id_reportante = u.id_user
+        WHERE {condicion}{filtro}
+        ORDER BY p.Fecha_Reporte DESC, p.id DESC
+        {tope}
+    """, (*parametros, *parametros_cursor, *parametros_tope))
+    filas = cursor.fetchall()
+
+    siguiente = None
+    if limite is not None and len(filas) > limite:
+        filas = filas[:limite]
+        ultima = filas[-1]
+        fecha = ultima['Fecha_Reporte'].isoformat() if ultima['Fecha_Reporte'] else None
+        siguiente = codificar_cursor(fecha, ultima['id'])
+
+    # Solo se cuenta aparte si la respuesta no trae ya todos los reportes
+    if despues is None and siguiente is None:
+        total = len(filas)
+    else:
+        cursor.execute(f"""
+            SELECT COUNT(*) AS total
+            FROM personas p
+            INNER JOIN users u ON p.id_reportante = u.id_user
+            WHERE {condicion}
+        """, parametros)
+        total = cursor.fetchone()['total']
+
+    reportes = [{
+        'id': r['id'],
+        'fecha_reporte': r['Fecha_Reporte'].strftime('%Y-%m-%d %H:%M') if r['Fecha_Reporte'] else None,
+        'numero_documento': r['Numero_Documento'],
+        'nombres': r['Nombres'],
+        'apellidos': r['Apellidos'],
+        'placa': r['Placa'],
+        'valor_reporte': r['Valor_Reporte'],
+        'descripcion': r['Descripcion_Reporte'],
+        'estado': r['Estado'],
+        'reportante_nombres': r['Reportante_Nombres']
+    } for r in filas]
+    return reportes, siguiente, total
+
+# ==================== SERVICIO 3A: CONSULTAR MIS REPORTES POR CÉDULA ====================
+@app.route('/api/mis-reportes/<cedula>', methods=['GET'])
+@verificar_usuario
+def consultar_mis_reportes(cedula):
+    """
+    Consultar reportes propios por número de cédula
+    ---
+    tags:
+      - Reportes
     security:
       - CelularAuth: []
     parameters:
@@ -660,71 +1457,68 @@ def consultar_mis_reportes(cedula):
         required: true
         description: Número de celular del usuario autenticado
         example: "3007471199"
+      - name: limite
+        in: query
+        type: integer
+        required: false
+        description: Reportes por página (opcional; sin limite ni cursor se devuelven todos)
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: Valor de siguiente_cursor de la página anterior
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Campos a devolver separados por coma (ej. fecha_reporte,placa,valor_reporte)
     responses:
       200:
         description: Resultados de la búsqueda
+      400:
+        description: cursor o fields no válidos
       401:
         description: No autorizado
       500:
         description: Error del servidor
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
-    
     try:
-        cursor = conn.cursor(dictionary=True)
-        
-        # Buscar solo reportes creados por este usuario
-        cursor.execute("""
-            SELECT p.id, p.Fecha_Reporte, p.Numero_Documento, p.Nombres, p.Apellidos,
-                   p.Fecha_cierre, p.Placa, p.Valor_Reporte, p.Descripcion_Reporte,
-                   p.Vehiculo_afiliado, p.Estado, u.nombres as Reportante_Nombres
-            FROM personas p
-            INNER JOIN users u ON p.Reportante_Nombres = u.id_user
-            WHERE p.Numero_Documento = %s AND p.Reportante_Nombres = %s
-            ORDER BY p.Fecha_Reporte DESC
-        """, (cedula, request.usuario['id_user']))
-        
-        reportes = cursor.fetchall()
+        limite, despues, campos = pagina_solicitada(CAMPOS_REPORTE)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        if not reportes:
+        try:
+            cursor = conn.cursor(dictionary=True)
+            
+            # Buscar solo reportes creados por este usuario
+            reportes, siguiente, total = listar_reportes(
+                cursor, cedula, limite, despues, id_reportante=request.usuario['id_user']
+            )
+            
+            if not total:
+                return jsonify({
+                    'success': True,
+                    'found': False,
+                    'message': 'No tienes reportes creados para esta cédula',
+                    'reportes': []
+                }), 200
+            
             return jsonify({
                 'success': True,
-                'found': False,
-                'message': 'No tienes reportes creados para esta cédula',
-                'reportes': []
+                'found': True,
+                'total_reportes': total,
+                'reportes': elegir_campos(reportes, campos),
+                'siguiente_cursor': siguiente
             }), 200
-        
-        # Formatear respuesta
-        reportes_formateados = []
-        for r in reportes:
-            reportes_formateados.append({
-                'id': r['id'],
-                'fecha_reporte': r['Fecha_Reporte'].strftime('%Y-%m-%d %H:%M') if r['Fecha_Reporte'] else None,
-                'numero_documento': r['Numero_Documento'],
-                'nombres': r['Nombres'],
-                'apellidos': r['Apellidos'],
-                'placa': r['Placa'],
-                'valor_reporte': r['Valor_Reporte'],
-                'descripcion': r['Descripcion_Reporte'],
-                'estado': r['Estado'],
-                'reportante_nombres': r['Reportante_Nombres']
-            })
-        
-        return jsonify({
-            'success': True,
-            'found': True,
-            'total_reportes': len(reportes),
-            'reportes': reportes_formateados
-        }), 200
-        
-    except Error as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
+            
+        except Error as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
             cursor.close()
-            conn.close()
 
 # ==================== SERVICIO 3B: CONSULTAR TODOS LOS REPORTES POR CÉDULA ====================
 @app.route('/api/reportes-por-cedula/<cedula>', methods=['GET'])
@@ -750,73 +1544,109 @@ def consultar_todos_reportes(cedula):
         required: true
         description: Número de celular del usuario autenticado
         example: "3007471199"
+      - name: limite
+        in: query
+        type: integer
+        required: false
+        description: Reportes por página (opcional; sin limite ni cursor se devuelven todos)
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: Valor de siguiente_cursor de la página anterior
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Campos a devolver separados por coma (ej. fecha_reporte,placa,valor_reporte)
     responses:
       200:
         description: Resultados de la búsqueda
+      400:
+        description: cursor o fields no válidos
       401:
         description: No autorizado
       500:
         description: Error del servidor
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
-    
     try:
-        cursor = conn.cursor(dictionary=True)
-        
-        # Buscar TODOS los reportes de esta cédula (sin filtrar por reportante)
-        cursor.execute("""
-            SELECT p.id, p.Fecha_Reporte, p.Numero_Documento, p.Nombres, p.Apellidos,
-                   p.Fecha_cierre, p.Placa, p.Valor_Reporte, p.Descripcion_Reporte,
-                   p.Vehiculo_afiliado, p.Estado, u.nombres as Reportante_Nombres
-            FROM personas p
-            inner join users u on p.Reportante_Nombres = u.id_user
-            WHERE p.Numero_Documento = %s
-            ORDER BY p.Fecha_Reporte DESC
-        """, (cedula,))
-        
-        reportes = cursor.fetchall()
+        limite, despues, campos = pagina_solicitada(CAMPOS_REPORTE)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        if not reportes:
+        try:
+            cursor = conn.cursor(dictionary=True)
+            
+            # Buscar TODOS los reportes de esta cédula (sin filtrar por reportante)
+            reportes, siguiente, total = listar_reportes(cursor, cedula, limite, despues)
+            
+            if not total:
+                return jsonify({
+                    'success': True,
+                    'found': False,
+                    'message': 'No se encontraron reportes para esta cédula',
+                    'reportes': []
+                }), 200
+            
             return jsonify({
                 'success': True,
-                'found': False,
-                'message': 'No se encontraron reportes para esta cédula',
-                'reportes': []
+                'found': True,
+                'total_reportes': total,
+                'reportes': elegir_campos(reportes, campos),
+                'siguiente_cursor': siguiente
             }), 200
-        
-        # Formatear respuesta
-        reportes_formateados = []
-        for r in reportes:
-            reportes_formateados.append({
-                'id': r['id'],
-                'fecha_reporte': r['Fecha_Reporte'].strftime('%Y-%m-%d %H:%M') if r['Fecha_Reporte'] else None,
-                'numero_documento': r['Numero_Documento'],
-                'nombres': r['Nombres'],
-                'apellidos': r['Apellidos'],
-                'placa': r['Placa'],
-                'valor_reporte': r['Valor_Reporte'],
-                'descripcion': r['Descripcion_Reporte'],
-                'estado': r['Estado'],
-                'reportante_nombres': r['Reportante_Nombres']
-            })
-        
-        return jsonify({
-            'success': True,
-            'found': True,
-            'total_reportes': len(reportes),
-            'reportes': reportes_formateados
-        }), 200
-        
-    except Error as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
+            
+        except Error as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
             cursor.close()
-            conn.close()
 
 # ==================== SERVICIO 3: CONSULTAR PERSONA POR CÉDULA ====================
+def buscar_reportes_persona(cursor, cedula):
+    """Reportes de la cédula ya formateados para la respuesta, del más reciente al más antiguo"""
+    return buscar_reportes_personas(cursor, [cedula])[cedula]
+
+
+def buscar_reportes_personas(cursor, cedulas):
+    """{cédula: reportes formateados} con una sola consulta IN; las cédulas sin reportes quedan con []"""
+    resultado = {cedula: [] for cedula in cedulas}
+    cursor.execute(f"""
+        SELECT p.id, p.Fecha_Reporte, p.Numero_Documento, p.Nombres, p.Apellidos,
+               p.Fecha_cierre, p.Placa, p.Valor_Reporte, p.Descripcion_Reporte,
+               p.Vehiculo_afiliado, p.Estado, u.nombres as Reportante_Nombres
+        FROM personas p
+        INNER JOIN users u ON p.id_reportante = u.id_user
+        WHERE p.Numero_Documento IN ({', '.join(['%s'] * len(resultado))})
+        ORDER BY p.Fecha_Reporte DESC, p.id DESC
+    """, list(resultado))
+    
+    for r in cursor.fetchall():
+        if r['Numero_Documento'] in resultado:
+            resultado[r['Numero_Documento']].append(formatear_reporte_persona(r))
+    return resultado
+
+
+def formatear_reporte_persona(r):
+    return {
+        'id': r['id'],
+        'fecha_reporte': r['Fecha_Reporte'].strftime('%Y-%m-%d') if r['Fecha_Reporte'] else None,
+        'numero_documento': r['Numero_Documento'],
+        'nombres': r['Nombres'],
+        'apellidos': r['Apellidos'],
+        'fecha_cierre': r['Fecha_cierre'],
+        'placa': r['Placa'],
+        'valor_reporte': r['Valor_Reporte'],
+        'descripcion': r['Descripcion_Reporte'],
+        'vehiculo_afiliado': r['Vehiculo_afiliado'],
+        'estado': r['Estado'],
+        'reportante_nombres': r['Reportante_Nombres']
+    }
+
+
 @app.route('/api/personas/<cedula>', methods=['GET'])
 @verificar_usuario
 def consultar_persona(cedula):
@@ -840,6 +1670,21 @@ def consultar_persona(cedula):
         required: true
         description: Número de celular del usuario autenticado
         example: "3007471199"
+      - name: limite
+        in: query
+        type: integer
+        required: false
+        description: Reportes por página (opcional; sin limite ni cursor se devuelven todos)
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: Valor de siguiente_cursor de la página anterior
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Campos a devolver separados por coma (ej. fecha_reporte,placa,valor_reporte)
     responses:
       200:
         description: Resultados de la búsqueda
@@ -855,6 +1700,9 @@ def consultar_persona(cedula):
             total_consultas:
               type: integer
               description: Total de consultas realizadas por el usuario
+            siguiente_cursor:
+              type: string
+              description: Cursor para pedir la página siguiente (null si no hay más)
             reportes:
               type: array
               items:
@@ -885,92 +1733,225 @@ def consultar_persona(cedula):
       500:
         description: Error del servidor
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
-    
     try:
-        cursor = conn.cursor(dictionary=True)
-        
-        # Buscar persona
-        cursor.execute("""
-            SELECT p.id, p.Fecha_Reporte, p.Numero_Documento, p.Nombres, p.Apellidos,
-                   p.Fecha_cierre, p.Placa, p.Valor_Reporte, p.Descripcion_Reporte,
-                   p.Vehiculo_afiliado, p.Estado, u.nombres as Reportante_Nombres
-            FROM personas p
-            INNER JOIN users u ON p.Reportante_Nombres = u.id_user
-            WHERE p.Numero_Documento = %s
-            ORDER BY p.Fecha_Reporte DESC
-        """, (cedula,))
-        
-        reportes = cursor.fetchall()
+        limite, despues, campos = pagina_solicitada(CAMPOS_PERSONA)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        if not reportes:
+        try:
+            cursor = conn.cursor(dictionary=True)
+            
+            reportes = personas_cache.obtener(cedula)
+            if reportes is None:
+                reportes = buscar_reportes_persona(cursor, cedula)
+                personas_cache.guardar(cedula, reportes)
+            
+            historial_consultas.registrar(request.usuario['id_user'], cedula, len(reportes))
+            
+            if not reportes:
+                return jsonify({
+                    'success': True,
+                    'found': False,
+                    'message': 'No se encontraron reportes para esta cédula',
+                    'total_consultas': 0
+                }), 200
+            
+            # Registrar consulta (sumar +1 al contador), también cuando el resultado viene de caché
+            total_consultas = contador_consultas.registrar(cursor, request.usuario['id_user'])
+            conn.commit()
+            
+            # La caché guarda la lista completa; la página se corta en memoria
+            pagina, siguiente = paginar_en_memoria(reportes, limite, despues)
+            
             return jsonify({
                 'success': True,
-                'found': False,
-                'message': 'No se encontraron reportes para esta cédula',
-                'total_consultas': 0
+                'found': True,
+                'total_reportes': len(reportes),
+                'total_consultas': total_consultas,
+                'reportes': elegir_campos(pagina, campos),
+                'siguiente_cursor': siguiente
             }), 200
-        
-        # Registrar consulta (sumar +1 al contador)
-        cursor.execute("""
-            SELECT id, count FROM consultas 
-            WHERE user_id = %s
-            ORDER BY id DESC LIMIT 1
-        """, (request.usuario['id_user'],))
-        
-        consulta_existente = cursor.fetchone()
-        
-        if consulta_existente:
-            nuevo_count = consulta_existente['count'] + 1
-            cursor.execute("""
-                UPDATE consultas 
-                SET count = %s 
-                WHERE id = %s
-            """, (nuevo_count, consulta_existente['id']))
-            total_consultas = nuevo_count
-        else:
-            cursor.execute("""
-                INSERT INTO consultas (user_id, count)
-                VALUES (%s, 1)
-            """, (request.usuario['id_user'],))
-            total_consultas = 1
-        
-        conn.commit()
-        
-        # Formatear respuesta
-        reportes_formateados = []
-        for r in reportes:
-            reportes_formateados.append({
-                'id': r['id'],
-                'fecha_reporte': r['Fecha_Reporte'].strftime('%Y-%m-%d') if r['Fecha_Reporte'] else None,
-                'numero_documento': r['Numero_Documento'],
-                'nombres': r['Nombres'],
-                'apellidos': r['Apellidos'],
-                'fecha_cierre': r['Fecha_cierre'],
-                'placa': r['Placa'],
-                'valor_reporte': r['Valor_Reporte'],
-                'descripcion': r['Descripcion_Reporte'],
-                'vehiculo_afiliado': r['Vehiculo_afiliado'],
-                'estado': r['Estado'],
-                'reportante_nombres': r['Reportante_Nombres']
-            })
-        
+            
+        except Error as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
+            cursor.close()
+
+# ==================== SERVICIO 3C: CONSULTAR VARIAS CÉDULAS ====================
+# Máximo de cédulas por petición y desde cuántas la respuesta se envía por partes
+CEDULAS_POR_LOTE_MAX = int(os.getenv('CEDULAS_POR_LOTE_MAX', 500))
+CEDULAS_STREAMING_DESDE = int(os.getenv('CEDULAS_STREAMING_DESDE', 100))
+
+
+def _json_por_partes(encabezado, resultados):
+    """Mismo JSON que jsonify({**encabezado, 'resultados': dict(resultados)}) pero generado cédula por cédula"""
+    yield app.json.dumps(encabezado)[:-1] + ', "resultados": {'
+    for i, (cedula, resultado) in enumerate(resultados):
+        yield (', ' if i else '') + app.json.dumps(cedula) + ': ' + app.json.dumps(resultado)
+    yield '}}'
+
+
+@app.route('/api/personas/lote', methods=['POST'])
+@verificar_usuario
+def consultar_personas_lote():
+    """
+    Consultar varias cédulas en una sola petición
+    ---
+    tags:
+      - Reportes
+    security:
+      - CelularAuth: []
+    parameters:
+      - name: X-User-Celular
+        in: header
+        type: string
+        required: true
+        description: Número de celular del usuario autenticado
+        example: "3007471199"
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Campos de cada reporte separados por coma (ej. fecha_reporte,placa,valor_reporte)
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - cedulas
+          properties:
+            cedulas:
+              type: array
+              items:
+                type: string
+              example: ["8497643", "1234567890"]
+              description: Cédulas a consultar (máximo CEDULAS_POR_LOTE_MAX)
+    responses:
+      200:
+        description: Reportes agrupados por cédula
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            total_cedulas:
+              type: integer
+            encontradas:
+              type: integer
+            total_consultas:
+              type: integer
+              description: Total de consultas realizadas por el usuario
+            resultados:
+              type: object
+              description: "{cedula: {found, total_reportes, reportes}}"
+      400:
+        description: Parámetros incorrectos
+      401:
+        description: No autorizado
+      500:
+        description: Error del servidor
+    """
+    try:
+        data = request.get_json(force=True) or {}
+    except Exception as e:
         return jsonify({
-            'success': True,
-            'found': True,
-            'total_reportes': len(reportes),
-            'total_consultas': total_consultas,
-            'reportes': reportes_formateados
-        }), 200
-        
-    except Error as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
+            'success': False,
+            'message': 'Error al procesar JSON: ' + str(e)
+        }), 400
+
+    try:
+        campos = campos_solicitados(CAMPOS_PERSONA)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    cedulas = data.get('cedulas')
+    if not isinstance(cedulas, list) or not cedulas:
+        return jsonify({'success': False, 'message': 'cedulas debe ser una lista no vacía'}), 400
+
+    # Sin repetidas y en el orden recibido
+    cedulas = list(dict.fromkeys(str(c).strip() for c in cedulas if str(c).strip()))
+    if len(cedulas) > CEDULAS_POR_LOTE_MAX:
+        return jsonify({
+            'success': False,
+            'message': f'Máximo {CEDULAS_POR_LOTE_MAX} cédulas por petición'
+        }), 400
+
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
+
+        try:
+            cursor = conn.cursor(dictionary=True)
+
+            # Lo que no está en caché se resuelve con un solo IN
+            reportes = {cedula: personas_cache.obtener(cedula) for cedula in cedulas}
+            faltantes = [cedula for cedula, lista in reportes.items() if lista is None]
+            if faltantes:
+                for cedula, lista in buscar_reportes_personas(cursor, faltantes).items():
+                    personas_cache.guardar(cedula, lista)
+                    reportes[cedula] = lista
+
+            for cedula, lista in reportes.items():
+                historial_consultas.registrar(request.usuario['id_user'], cedula, len(lista))
+
+            # Igual que la consulta individual: cuenta una consulta por cada cédula con reportes
+            encontradas = sum(1 for lista in reportes.values() if lista)
+            total_consultas = 0
+            if encontradas:
+                total_consultas = contador_consultas.registrar(cursor, request.usuario['id_user'], encontradas)
+                conn.commit()
+
+        except Error as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
             cursor.close()
-            conn.close()
+
+    encabezado = {
+        'success': True,
+        'total_cedulas': len(cedulas),
+        'encontradas': encontradas,
+        'total_consultas': total_consultas
+    }
+    resultados = (
+        (cedula, {
+            'found': bool(lista),
+            'total_reportes': len(lista),
+            'reportes': elegir_campos(lista, campos)
+        })
+        for cedula, lista in reportes.items()
+    )
+
+    if len(cedulas) < CEDULAS_STREAMING_DESDE:
+        return jsonify({**encabezado, 'resultados': dict(resultados)}), 200
+    return app.response_class(_json_por_partes(encabezado, resultados), mimetype='application/json')
+
+# ==================== PLANTILLAS EXCEL ====================
+# Las plantillas se generan una vez por worker; cada descarga solo envía bytes ya listos
+plantillas.precargar()
+
+
+def enviar_plantilla(nombre, download_name):
+    """
+    Plantilla desde memoria con ETag débil y Last-Modified; responde 304 si el cliente ya la tiene.
+    Sin Range: cada worker genera bytes distintos y un cliente podría unir partes de dos archivos.
+    """
+    plantilla = plantillas.obtener(nombre)
+    response = send_file(
+        plantilla.archivo(),
+        mimetype=plantillas.MIMETYPE_XLSX,
+        as_attachment=True,
+        download_name=download_name,
+        etag=False,
+        last_modified=plantilla.modificada,
+        conditional=False
+    )
+    response.set_etag(plantilla.etag, weak=True)
+    return response.make_conditional(request, accept_ranges=False)
 
 # ==================== SERVICIO 4: DESCARGAR PLANTILLA EXCEL ====================
 @app.route('/api/plantilla-excel', methods=['GET'])
@@ -993,62 +1974,27 @@ def descargar_plantilla():
     responses:
       200:
         description: Archivo Excel
+        headers:
+          ETag:
+            type: string
+          Last-Modified:
+            type: string
         content:
           application/vnd.openxmlformats-officedocument.spreadsheetml.sheet:
             schema:
               type: string
               format: binary
+      304:
+        description: La plantilla no cambió (If-None-Match / If-Modified-Since)
       401:
         description: No autorizado
       500:
         description: Error del servidor
     """
     try:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Plantilla Reportes"
-        
-        headers = [
-            'Fecha_Reporte', 'Numero_Documento', 'Nombres', 'Apellidos',
-            'Fecha_cierre', 'Placa', 'Valor_Reporte', 'Descripcion_Reporte',
-            'Vehiculo_afiliado', 'Estado'
-        ]
-        
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(color='FFFFFF', bold=True)
-        
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        ejemplo = [
-            '2024-01-15', '1234567890', 'JUAN', 'PEREZ GOMEZ',
-            '', 'ABC123', '50000', 'REPORTE NEGATIVO POR TARIFAS',
-            'ADMICARS', 'ACTIVA'
-        ]
-        
-        for col, valor in enumerate(ejemplo, 1):
-            ws.cell(row=2, column=col, value=valor)
-        
-        for col in ws.columns:
-            max_length = 0
-            column = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            ws.column_dimensions[column].width = max_length + 2
-        
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'plantilla_reportes_{datetime.now().strftime("%Y%m%d")}.xlsx'
+        return enviar_plantilla(
+            'reportes',
+            f'plantilla_reportes_{datetime.now().strftime("%Y%m%d")}.xlsx'
         )
         
     except Exception as e:
@@ -1059,7 +2005,7 @@ def descargar_plantilla():
 @verificar_usuario
 def importar_excel():
     """
-    Importar datos masivos desde archivo Excel
+    Importar datos masivos desde archivo Excel, CSV o Parquet
     ---
     tags:
       - Reportes
@@ -1078,10 +2024,39 @@ def importar_excel():
         in: formData
         type: file
         required: true
-        description: Archivo Excel (.xlsx o .xls) con los datos a importar
+        description: Archivo .xlsx, .xls, .csv o .parquet (el formato se detecta por contenido; límites IMPORTAR_MAX_BYTES e IMPORTAR_MAX_FILAS)
+      - name: tamano_lote
+        in: formData
+        type: integer
+        required: false
+        description: Filas por INSERT multi-fila (por defecto 500, máximo 5000)
+      - name: duplicados
+        in: formData
+        type: string
+        enum: [omitir, actualizar, fallar]
+        required: false
+        description: Qué hacer con reportes ya existentes (misma cédula, placa, fecha y reportante). Por defecto omitir
+      - name: esperar
+        in: formData
+        type: boolean
+        required: false
+        description: Procesar dentro de la petición y responder con el resultado (por defecto se encola)
     responses:
+      202:
+        description: Archivo recibido; consultar el progreso en /api/importaciones/{trabajo_id}
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            trabajo_id:
+              type: string
+            estado:
+              type: string
+            estado_url:
+              type: string
       200:
-        description: Importación completada
+        description: Importación completada (solo con esperar=true)
         schema:
           type: object
           properties:
@@ -1097,10 +2072,22 @@ def importar_excel():
               type: array
               items:
                 type: string
+            tamano_lote:
+              type: integer
+            lotes:
+              type: array
+              description: Filas, insertados, errores, modo y milisegundos de cada lote
+              items:
+                type: object
+            duplicados:
+              type: object
+              description: Modo aplicado y conteo de omitidos, actualizados y rechazados
       400:
         description: Archivo no válido
       401:
         description: No autorizado
+      413:
+        description: El archivo supera IMPORTAR_MAX_BYTES
       500:
         description: Error del servidor
     """
@@ -1118,81 +2105,61 @@ def importar_excel():
             'message': 'Archivo vacío'
         }), 400
     
-    if not file.filename.endswith(('.xlsx', '.xls')):
+    if request.content_length and request.content_length > importacion.MAX_BYTES:
         return jsonify({
             'success': False,
-            'message': 'Formato no válido. Use .xlsx o .xls'
-        }), 400
+            'message': f'El archivo supera el máximo de {importacion.MAX_BYTES // (1024 * 1024)} MB'
+        }), 413
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
+    tamano_lote = importacion.tamano_lote_solicitado(request.form.get('tamano_lote'))
+    modo_duplicados = importacion.modo_duplicados_solicitado(request.form.get('duplicados'))
+    if not modo_duplicados:
+        return jsonify({
+            'success': False,
+            'message': f'duplicados debe ser uno de: {", ".join(importacion.MODOS_DUPLICADOS)}'
+        }), 400
     
-    try:
-        df = pd.read_excel(file)
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        required_cols = ['Numero_Documento', 'Nombres', 'Apellidos', 'Placa']
-        if not all(col in df.columns for col in required_cols):
+        try:
+            trabajo = iniciar_importacion(
+                conn, file, 'excel', request.usuario['id_user'], tamano_lote, modo_duplicados,
+                esperar=solicita_esperar()
+            )
+            if trabajo.estado not in (trabajos.COMPLETADO, trabajos.FALLIDO):
+                return respuesta_trabajo_encolado(trabajo)
+            
+            if trabajo.estado == trabajos.FALLIDO:
+                codigo = 400 if isinstance(trabajo.excepcion, importacion.ErrorImportacion) else 500
+                return jsonify({'success': False, 'message': trabajo.mensaje}), codigo
+            
+            # Se arma desde `resultado`: un trabajo reutilizado solo trae lo guardado en la BD
+            resultado = trabajo.resultado
             return jsonify({
-                'success': False,
-                'message': f'Columnas requeridas: {", ".join(required_cols)}'
-            }), 400
-        
-        cursor = conn.cursor()
-        insertados = 0
-        errores = []
-        
-        for idx, row in df.iterrows():
-            try:
-                query = """
-                    INSERT INTO personas (
-                        Fecha_Reporte, Numero_Documento, Nombres, Apellidos,
-                        Fecha_cierre, Placa, Valor_Reporte, Descripcion_Reporte,
-                        Vehiculo_afiliado, Estado, Reportante_Nombres
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """
-                
-                valores = (
-                    row.get('Fecha_Reporte', datetime.now().date()),
-                    row['Numero_Documento'],
-                    row['Nombres'],
-                    row['Apellidos'],
-                    row.get('Fecha_cierre', ''),
-                    row['Placa'],
-                    row.get('Valor_Reporte', 0),
-                    row.get('Descripcion_Reporte', ''),
-                    row.get('Vehiculo_afiliado', 'ADMICARS'),
-                    row.get('Estado', 'ACTIVA'),
-                    request.usuario['id_user']
-                )
-                
-                cursor.execute(query, valores)
-                insertados += 1
-                
-            except Exception as e:
-                errores.append(f"Fila {idx + 2}: {str(e)}")
-        
-        conn.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': f'Importación completada',
-            'insertados': insertados,
-            'errores': len(errores),
-            'detalle_errores': errores[:10]
-        }), 200
-        
-    except Exception as e:
-        conn.rollback()
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+                'success': True,
+                'message': 'Archivo ya importado anteriormente' if trabajo.reutilizado else 'Importación completada',
+                'trabajo_id': trabajo.id,
+                'reutilizado': trabajo.reutilizado,
+                'insertados': trabajo.insertados,
+                'errores': resultado['errores'],
+                'detalle_errores': [f"Fila {det['fila']}: {det['mensaje']}" for det in resultado['detalles'][:10]],
+                'tamano_lote': resultado['tamano_lote'],
+                'lotes': resultado['lotes'],
+                'duplicados': resultado['duplicados']
+            }), 200
+            
+        except importacion.ErrorImportacion as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        except Exception as e:
+            conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 500
 
 # ==================== SERVICIO 6: CREAR REPORTE INDIVIDUAL ====================
 @app.route('/api/personas', methods=['POST'])
 @verificar_usuario
+@idempotente
 def crear_persona():
     """
     Crear un reporte individual
@@ -1208,6 +2175,11 @@ def crear_persona():
         required: true
         description: Número de celular del usuario autenticado
         example: "3007471199"
+      - name: Idempotency-Key
+        in: header
+        type: string
+        required: false
+        description: Clave única del cliente; un reintento con la misma clave recibe la respuesta original
       - name: body
         in: body
         required: true
@@ -1274,48 +2246,48 @@ def crear_persona():
             'message': 'Campos requeridos: numero_documento, nombres, apellidos, placa'
         }), 400
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
-    
-    try:
-        cursor = conn.cursor()
-        
-        query = """
-            INSERT INTO personas (
-                Fecha_Reporte, Numero_Documento, Nombres, Apellidos,
-                Placa, Valor_Reporte, Descripcion_Reporte,
-                Vehiculo_afiliado, Estado, Reportante_Nombres
-            ) VALUES (NOW(), %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        
-        cursor.execute(query, (
-            data['numero_documento'],
-            data['nombres'].upper(),
-            data['apellidos'].upper(),
-            data['placa'].upper(),
-            data.get('valor_reporte', 0),
-            data.get('descripcion', ''),
-            data.get('vehiculo_afiliado', 'ADMICARS'),
-            data.get('estado', 'ACTIVA'),
-            request.usuario['id_user']
-        ))
-        
-        conn.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Reporte creado exitosamente',
-            'id': cursor.lastrowid
-        }), 201
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-    except Error as e:
-        conn.rollback()
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
+        try:
+            cursor = conn.cursor()
+            
+            query = """
+                INSERT INTO personas (
+                    Fecha_Reporte, Numero_Documento, Nombres, Apellidos,
+                    Placa, Valor_Reporte, Descripcion_Reporte,
+                    Vehiculo_afiliado, Estado, Reportante_Nombres, id_reportante
+                ) VALUES (NOW(), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """
+            
+            cursor.execute(query, (
+                data['numero_documento'],
+                data['nombres'].upper(),
+                data['apellidos'].upper(),
+                data['placa'].upper(),
+                data.get('valor_reporte', 0),
+                data.get('descripcion', ''),
+                data.get('vehiculo_afiliado', 'ADMICARS'),
+                data.get('estado', 'ACTIVA'),
+                request.usuario['id_user'],
+                request.usuario['id_user']
+            ))
+            
+            conn.commit()
+            personas_cache.invalidar(str(data['numero_documento']))
+            
+            return jsonify({
+                'success': True,
+                'message': 'Reporte creado exitosamente',
+                'id': cursor.lastrowid
+            }), 201
+            
+        except Error as e:
+            conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
             cursor.close()
-            conn.close()
 
 # ==================== SERVICIO 7: EDITAR REPORTE ====================
 @app.route('/api/personas/<int:id>', methods=['PUT'])
@@ -1382,74 +2354,73 @@ def editar_persona(id):
             'message': 'Error al procesar JSON: ' + str(e)
         }), 400
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
-    
-    try:
-        cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("""
-            SELECT Reportante_Nombres FROM personas WHERE id = %s
-        """, (id,))
-        
-        reporte = cursor.fetchone()
-        
-        if not reporte:
-            return jsonify({
-                'success': False,
-                'message': 'Reporte no encontrado'
-            }), 404
-        
-        es_admin = request.usuario['rol'] == 'admin'
-        es_creador = str(reporte['Reportante_Nombres']) == str(request.usuario['id_user'])
-        
-        if not (es_admin or es_creador):
-            return jsonify({
-                'success': False,
-                'message': 'No tiene permisos para editar este reporte'
-            }), 403
-        
-        campos_permitidos = [
-            'Nombres', 'Apellidos', 'Placa', 'Valor_Reporte',
-            'Descripcion_Reporte', 'Estado', 'Fecha_cierre'
-        ]
-        
-        campos_actualizar = []
-        valores = []
-        
-        for campo in campos_permitidos:
-            campo_lower = campo.lower().replace('_', '')
-            for key in data.keys():
-                if key.lower().replace('_', '') == campo_lower:
-                    campos_actualizar.append(f"{campo} = %s")
-                    valores.append(data[key])
-                    break
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        if not campos_actualizar:
+        try:
+            cursor = conn.cursor(dictionary=True)
+            
+            cursor.execute("""
+                SELECT id_reportante, Numero_Documento FROM personas WHERE id = %s
+            """, (id,))
+            
+            reporte = cursor.fetchone()
+            
+            if not reporte:
+                return jsonify({
+                    'success': False,
+                    'message': 'Reporte no encontrado'
+                }), 404
+            
+            es_admin = request.usuario['rol'] == 'admin'
+            es_creador = reporte['id_reportante'] == request.usuario['id_user']
+            
+            if not (es_admin or es_creador):
+                return jsonify({
+                    'success': False,
+                    'message': 'No tiene permisos para editar este reporte'
+                }), 403
+            
+            campos_permitidos = [
+                'Nombres', 'Apellidos', 'Placa', 'Valor_Reporte',
+                'Descripcion_Reporte', 'Estado', 'Fecha_cierre'
+            ]
+            
+            campos_actualizar = []
+            valores = []
+            
+            for campo in campos_permitidos:
+                campo_lower = campo.lower().replace('_', '')
+                for key in data.keys():
+                    if key.lower().replace('_', '') == campo_lower:
+                        campos_actualizar.append(f"{campo} = %s")
+                        valores.append(data[key])
+                        break
+            
+            if not campos_actualizar:
+                return jsonify({
+                    'success': False,
+                    'message': 'No hay campos para actualizar'
+                }), 400
+            
+            valores.append(id)
+            query = f"UPDATE personas SET {', '.join(campos_actualizar)} WHERE id = %s"
+            
+            cursor.execute(query, valores)
+            conn.commit()
+            personas_cache.invalidar(reporte['Numero_Documento'])
+            
             return jsonify({
-                'success': False,
-                'message': 'No hay campos para actualizar'
-            }), 400
-        
-        valores.append(id)
-        query = f"UPDATE personas SET {', '.join(campos_actualizar)} WHERE id = %s"
-        
-        cursor.execute(query, valores)
-        conn.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Reporte actualizado exitosamente'
-        }), 200
-        
-    except Error as e:
-        conn.rollback()
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
+                'success': True,
+                'message': 'Reporte actualizado exitosamente'
+            }), 200
+            
+        except Error as e:
+            conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
             cursor.close()
-            conn.close()
 
 # ==================== SERVICIO 8: OBTENER ESTADO DE CONVERSACIÓN ====================
 @app.route('/api/estado-usuario/<celular>', methods=['GET'])
@@ -1490,50 +2461,31 @@ def obtener_estado_usuario(celular):
       500:
         description: Error del servidor
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({
-            'success': False,
-            'message': 'Error conectando a la base de datos'
-        }), 500
-    
     try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT celular, estado, opcion, updated_at
-            FROM user_state
-            WHERE celular = %s
-        """, (celular,))
-        
-        estado = cursor.fetchone()
-        
-        if estado:
-            return jsonify({
-                'success': True,
-                'exists': True,
-                'estado': {
-                    'celular': estado['celular'],
-                    'estado': estado['estado'],
-                    'opcion': estado['opcion'],
-                    'updated_at': estado['updated_at'].isoformat() if estado['updated_at'] else None
-                }
-            }), 200
-        else:
-            return jsonify({
-                'success': True,
-                'exists': False,
-                'estado': None
-            }), 200
-    
+        estado = estados_conversacion.obtener(celular)
     except Error as e:
         return jsonify({
             'success': False,
             'message': f'Error consultando estado: {str(e)}'
         }), 500
-    finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+    
+    if estado:
+        return jsonify({
+            'success': True,
+            'exists': True,
+            'estado': {
+                'celular': estado['celular'],
+                'estado': estado['estado'],
+                'opcion': estado['opcion'],
+                'updated_at': estado['updated_at'].isoformat() if estado['updated_at'] else None
+            }
+        }), 200
+    else:
+        return jsonify({
+            'success': True,
+            'exists': False,
+            'estado': None
+        }), 200
 
 # ==================== SERVICIO 9: GUARDAR ESTADO DE CONVERSACIÓN ====================
 @app.route('/api/estado-usuario', methods=['POST'])
@@ -1601,43 +2553,26 @@ def guardar_estado_usuario():
             'message': 'Faltan campos requeridos: celular y estado'
         }), 400
     
-    conn = get_db_connection()
-    if not conn:
+    # user_state.opcion es INT; el almacén local debe devolver lo mismo que devolvería la BD
+    try:
+        opcion = int(opcion) if opcion not in (None, '') else None
+    except (TypeError, ValueError):
         return jsonify({
             'success': False,
-            'message': 'Error conectando a la base de datos'
-        }), 500
+            'message': 'opcion debe ser un número entero'
+        }), 400
     
     try:
-        cursor = conn.cursor()
-        
-        # Usar INSERT ... ON DUPLICATE KEY UPDATE para insertar o actualizar
-        cursor.execute("""
-            INSERT INTO user_state (celular, estado, opcion, updated_at)
-            VALUES (%s, %s, %s, NOW())
-            ON DUPLICATE KEY UPDATE
-                estado = VALUES(estado),
-                opcion = VALUES(opcion),
-                updated_at = NOW()
-        """, (celular, estado, opcion))
-        
-        conn.commit()
-        
+        estados_conversacion.guardar(celular, estado, opcion)
         return jsonify({
             'success': True,
             'message': 'Estado guardado exitosamente'
         }), 200
-    
     except Error as e:
-        conn.rollback()
         return jsonify({
             'success': False,
             'message': f'Error guardando estado: {str(e)}'
         }), 500
-    finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
 
 # ==================== SERVICIO 10: ELIMINAR ESTADO DE CONVERSACIÓN ====================
 @app.route('/api/estado-usuario/<celular>', methods=['DELETE'])
@@ -1667,37 +2602,198 @@ def eliminar_estado_usuario(celular):
       500:
         description: Error del servidor
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({
-            'success': False,
-            'message': 'Error conectando a la base de datos'
-        }), 500
-    
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            DELETE FROM user_state
-            WHERE celular = %s
-        """, (celular,))
-        
-        conn.commit()
-        
+        estados_conversacion.eliminar(celular)
         return jsonify({
             'success': True,
             'message': 'Estado eliminado exitosamente'
         }), 200
-    
     except Error as e:
-        conn.rollback()
         return jsonify({
             'success': False,
             'message': f'Error eliminando estado: {str(e)}'
         }), 500
+
+# ==================== SERVICIO 10B: CONTEXTO DEL MENSAJE ====================
+def _estado_respuesta(estado):
+    if not estado:
+        return None
+    return {
+        'celular': estado['celular'],
+        'estado': estado['estado'],
+        'opcion': estado['opcion'],
+        'updated_at': estado['updated_at'].isoformat() if estado['updated_at'] else None
+    }
+
+
+def perfil_usuario(celular):
+    """Usuario por celular (también inactivo) o None; los activos salen de usuarios_cache"""
+    usuario = usuarios_cache.obtener(celular)
+    if usuario:
+        return dict(usuario, isactive=1)
+
+    conn = sesion_bd()
+    if not conn:
+        raise Error(msg='Error de conexión a BD')
+
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT id_user, username, nombres, rol, isactive
+            FROM users
+            WHERE Celular = %s
+        """, (celular,))
+        usuario = cursor.fetchone()
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        cursor.close()
+
+    # Misma forma que guarda verificar_usuario
+    if usuario and usuario['isactive']:
+        usuarios_cache.guardar(celular, {
+            'id_user': usuario['id_user'],
+            'username': usuario['username'],
+            'nombres': usuario['nombres'],
+            'rol': usuario['rol']
+        })
+    return usuario
+
+
+@app.route('/api/contexto-usuario', methods=['POST'])
+def contexto_usuario():
+    """
+    Usuario y estado de conversación en una sola llamada (una por mensaje entrante)
+    Reemplaza /api/verificar-usuario + GET /api/estado-usuario/<celular>; opcionalmente aplica
+    una transición de estado.
+    ---
+    tags:
+      - Estado de Conversación
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - celular
+          properties:
+            celular:
+              type: string
+              example: "3007471199"
+            transicion:
+              type: object
+              description: Nuevo estado (null = eliminarlo). Con si_estado solo se aplica si el estado actual es ese (null = sin estado).
+              properties:
+                estado:
+                  type: string
+                  example: "esperando_cedula"
+                opcion:
+                  type: integer
+                  example: 1
+                si_estado:
+                  type: string
+                  example: "menu_principal"
+    responses:
+      200:
+        description: Usuario y estado actual
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            exists:
+              type: boolean
+            usuario:
+              type: object
+              properties:
+                id:
+                  type: integer
+                nombre:
+                  type: string
+                email:
+                  type: string
+                rol:
+                  type: string
+                activo:
+                  type: boolean
+            estado:
+              type: object
+              properties:
+                celular:
+                  type: string
+                estado:
+                  type: string
+                opcion:
+                  type: integer
+                updated_at:
+                  type: string
+            transicion:
+              type: object
+              properties:
+                aplicada:
+                  type: boolean
+      400:
+        description: Parámetros incorrectos
+      500:
+        description: Error del servidor
+    """
+    try:
+        data = request.get_json(force=True)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': 'Error al procesar JSON: ' + str(e)
+        }), 400
+
+    if not data or not data.get('celular'):
+        return jsonify({
+            'success': False,
+            'message': 'Número de celular requerido'
+        }), 400
+
+    celular = str(data['celular'])
+    transicion = data.get('transicion')
+    if transicion is not None:
+        if not isinstance(transicion, dict) or 'estado' not in transicion:
+            return jsonify({
+                'success': False,
+                'message': 'transicion debe incluir estado (null para eliminarlo)'
+            }), 400
+        try:
+            opcion = transicion.get('opcion')
+            opcion = int(opcion) if opcion not in (None, '') else None
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'message': 'opcion debe ser un número entero'
+            }), 400
+
+    try:
+        usuario = perfil_usuario(celular)
+
+        respuesta = {'success': True, 'exists': bool(usuario), 'usuario': None}
+        if usuario:
+            respuesta['usuario'] = {
+                'id': usuario['id_user'],
+                'nombre': usuario['nombres'],
+                'email': usuario['username'],
+                'rol': usuario['rol'],
+                'activo': bool(usuario['isactive'])
+            }
+
+        if transicion is None:
+            estado = estados_conversacion.obtener(celular)
+        else:
+            aplicada, estado = estados_conversacion.transicion(
+                celular, transicion['estado'] or None, opcion,
+                esperado=transicion['si_estado'] if 'si_estado' in transicion else estados.CUALQUIERA
+            )
+            respuesta['transicion'] = {'aplicada': aplicada}
+        respuesta['estado'] = _estado_respuesta(estado)
+
+        return jsonify(respuesta), 200
+
+    except Error as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
 
 # ==================== SERVICIO 11: BLOQUEAR/DESBLOQUEAR USUARIO ====================
 @app.route('/api/usuarios/<celular>/bloquear', methods=['PUT'])
@@ -1745,57 +2841,56 @@ def bloquear_usuario(celular):
     except Exception:
         bloquear = True
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({
-            'success': False,
-            'message': 'Error conectando a la base de datos'
-        }), 500
-    
-    try:
-        cursor = conn.cursor(dictionary=True)
-        
-        # Verificar si el usuario existe
-        cursor.execute("""
-            SELECT id_user, username, isactive 
-            FROM users 
-            WHERE Celular = %s
-        """, (celular,))
-        
-        usuario = cursor.fetchone()
-        
-        if not usuario:
+    with conexion_bd() as conn:
+        if not conn:
             return jsonify({
                 'success': False,
-                'message': f'Usuario con celular {celular} no encontrado'
-            }), 404
-        
-        # Actualizar el estado isactive
-        nuevo_estado = 0 if bloquear else 1
-        cursor.execute("""
-            UPDATE users 
-            SET isactive = %s 
-            WHERE Celular = %s
-        """, (nuevo_estado, celular))
+                'message': 'Error conectando a la base de datos'
+            }), 500
         
-        conn.commit()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            
+            # Verificar si el usuario existe
+            cursor.execute("""
+                SELECT id_user, username, isactive 
+                FROM users 
+                WHERE Celular = %s
+            """, (celular,))
+            
+            usuario = cursor.fetchone()
+            
+            if not usuario:
+                return jsonify({
+                    'success': False,
+                    'message': f'Usuario con celular {celular} no encontrado'
+                }), 404
+            
+            # Actualizar el estado isactive
+            nuevo_estado = 0 if bloquear else 1
+            cursor.execute("""
+                UPDATE users 
+                SET isactive = %s 
+                WHERE Celular = %s
+            """, (nuevo_estado, celular))
+            
+            conn.commit()
+            usuarios_cache.invalidar(celular)
+            
+            accion = 'bloqueado' if bloquear else 'desbloqueado'
+            return jsonify({
+                'success': True,
+                'message': f'Usuario {usuario["username"]} {accion} exitosamente'
+            }), 200
         
-        accion = 'bloqueado' if bloquear else 'desbloqueado'
-        return jsonify({
-            'success': True,
-            'message': f'Usuario {usuario["username"]} {accion} exitosamente'
-        }), 200
-    
-    except Error as e:
-        conn.rollback()
-        return jsonify({
-            'success': False,
-            'message': f'Error al bloquear usuario: {str(e)}'
-        }), 500
-    finally:
-        if conn.is_connected():
+        except Error as e:
+            conn.rollback()
+            return jsonify({
+                'success': False,
+                'message': f'Error al bloquear usuario: {str(e)}'
+            }), 500
+        finally:
             cursor.close()
-            conn.close()
 
 # ==================== SERVICIO EXTRA: ESTADÍSTICAS DE USUARIO ====================
 @app.route('/api/estadisticas', methods=['GET'])
@@ -1834,47 +2929,45 @@ def obtener_estadisticas():
       500:
         description: Error del servidor
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'success': False, 'message': 'Error de conexión'}), 500
-    
-    try:
-        cursor = conn.cursor(dictionary=True)
-        
-        # Total de consultas
-        cursor.execute("""
-            SELECT COALESCE(SUM(count), 0) as total
-            FROM consultas
-            WHERE user_id = %s
-        """, (request.usuario['id_user'],))
-        total_consultas = cursor.fetchone()['total']
-        
-        # Reportes creados por el usuario
-        cursor.execute("""
-            SELECT COUNT(*) as total
-            FROM personas
-            WHERE Reportante_Nombres = %s
-        """, (request.usuario['id_user'],))
-        reportes_creados = cursor.fetchone()['total']
-        
-        return jsonify({
-            'success': True,
-            'usuario': {
-                'id': request.usuario['id_user'],
-                'nombre': request.usuario['nombres'],
-                'email': request.usuario['username'],
-                'rol': request.usuario['rol']
-            },
-            'total_consultas': total_consultas,
-            'reportes_creados': reportes_creados
-        }), 200
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-    except Error as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn.is_connected():
+        try:
+            cursor = conn.cursor(dictionary=True)
+            
+            # Total de consultas
+            cursor.execute("""
+                SELECT COALESCE(SUM(count), 0) as total
+                FROM consultas
+                WHERE user_id = %s
+            """, (request.usuario['id_user'],))
+            total_consultas = cursor.fetchone()['total']
+            
+            # Reportes creados por el usuario
+            cursor.execute("""
+                SELECT COUNT(*) as total
+                FROM personas
+                WHERE id_reportante = %s
+            """, (request.usuario['id_user'],))
+            reportes_creados = cursor.fetchone()['total']
+            
+            return jsonify({
+                'success': True,
+                'usuario': {
+                    'id': request.usuario['id_user'],
+                    'nombre': request.usuario['nombres'],
+                    'email': request.usuario['username'],
+                    'rol': request.usuario['rol']
+                },
+                'total_consultas': total_consultas,
+                'reportes_creados': reportes_creados
+            }), 200
+            
+        except Error as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        finally:
             cursor.close()
-            conn.close()
 
 # ==================== RUTA DE PRUEBA ====================
 @app.route('/api/health', methods=['GET', 'OPTIONS'])
@@ -1908,10 +3001,8 @@ def health_check():
         return response
     
     try:
-        conn = get_db_connection()
-        db_status = "Conectada" if conn else "Error de conexión"
-        if conn and conn.is_connected():
-            conn.close()
+        with conexion_bd() as conn:
+            db_status = "Conectada" if conn else "Error de conexión"
         
         response = jsonify({
             'success': True,
@@ -1935,8 +3026,82 @@ def health_check():
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
         return response, 500
 
+# ==================== MÉTRICAS INTERNAS ====================
+# Token para sistemas de monitoreo (header X-Metricas-Token); sin él solo los administradores
+METRICAS_TOKEN = os.getenv('METRICAS_TOKEN', '')
+
+
+def acceso_metricas(f):
+    """Decorador: X-Metricas-Token igual a METRICAS_TOKEN, o X-User-Celular de un usuario admin"""
+    @verificar_usuario
+    def solo_admin(*args, **kwargs):
+        if request.usuario['rol'] != 'admin':
+            return jsonify({'success': False, 'message': 'Solo disponible para administradores'}), 403
+        return f(*args, **kwargs)
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = request.headers.get('X-Metricas-Token', '')
+        if METRICAS_TOKEN and token and hmac.compare_digest(token.encode('utf-8'), METRICAS_TOKEN.encode('utf-8')):
+            return f(*args, **kwargs)
+        return solo_admin(*args, **kwargs)
+
+    return decorated_function
+
+
+@app.route('/api/metricas', methods=['GET'])
+@acceso_metricas
+def obtener_metricas():
+    """
+    Métricas internas del proceso (pool de conexiones y cachés)
+    ---
+    tags:
+      - Sistema
+    parameters:
+      - name: X-User-Celular
+        in: header
+        type: string
+        required: false
+        description: Celular de un usuario admin
+      - name: X-Metricas-Token
+        in: header
+        type: string
+        required: false
+        description: Token de monitoreo (METRICAS_TOKEN)
+    responses:
+      200:
+        description: Métricas del worker que atiende la petición
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            pid:
+              type: integer
+            pool:
+              type: object
+            cache_usuarios:
+              type: object
+      401:
+        description: Sin credenciales
+      403:
+        description: Usuario no admin
+    """
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'pool': get_pool().metricas(),
+        'cache_usuarios': usuarios_cache.metricas(),
+        'cache_personas': personas_cache.metricas(),
+        'consultas': contador_consultas.metricas(),
+        'historial_consultas': historial_consultas.metricas(),
+        'estados_conversacion': estados_conversacion.metricas(),
+        'mantenimiento': barredor.metricas()
+    }), 200
+
 # ==================== ENDPOINT: GENERAR TOKEN PARA CARGA MASIVA ====================
 @app.route('/api/generar-token-carga', methods=['POST', 'OPTIONS'])
+@idempotente
 def generar_token_carga():
     """
     Genera un token temporal para carga masiva asociado a un usuario
@@ -1949,6 +3114,11 @@ def generar_token_carga():
         type: string
         required: true
         description: Celular del usuario
+      - name: Idempotency-Key
+        in: header
+        type: string
+        required: false
+        description: Clave única del cliente; un reintento con la misma clave recibe la respuesta original
     responses:
       200:
         description: Token generado exitosamente
@@ -1969,7 +3139,7 @@ def generar_token_carga():
     if request.method == 'OPTIONS':
         response = jsonify({'status': 'ok'})
         response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add('Access-Control-Allow-Headers', "Content-Type,X-User-Celular,Authorization,Accept")
+        response.headers.add('Access-Control-Allow-Headers', "Content-Type,X-User-Celular,Authorization,Accept,Idempotency-Key")
         response.headers.add('Access-Control-Allow-Methods', "POST,OPTIONS")
         return response
     
@@ -1982,100 +3152,107 @@ def generar_token_carga():
         }), 401
     
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'success': False, 'message': 'Error de conexión a BD'}), 500
-        
-        cursor = conn.cursor(dictionary=True)
-        
-        # Verificar que el usuario existe
-        cursor.execute("SELECT id_user, nombres FROM users WHERE Celular = %s AND isactive = 1", (celular,))
-        usuario = cursor.fetchone()
-        
-        if not usuario:
+        with conexion_bd() as conn:
+            if not conn:
+                return jsonify({'success': False, 'message': 'Error de conexión a BD'}), 500
+            
+            cursor = conn.cursor(dictionary=True)
+            
+            # Verificar que el usuario existe
+            cursor.execute("SELECT id_user, nombres FROM users WHERE Celular = %s AND isactive = 1", (celular,))
+            usuario = cursor.fetchone()
+            
+            if not usuario:
+                cursor.close()
+                return jsonify({
+                    'success': False,
+                    'message': 'Usuario no encontrado o inactivo'
+                }), 403
+            
+            # Fecha de expiración (TOKEN_CARGA_HORAS, 24 por defecto)
+            expiracion = datetime.now() + timedelta(hours=tokens_carga.HORAS_VIGENCIA)
+            
+            if tokens_carga.FIRMADOS:
+                # El token lleva los datos firmados: no se guarda nada
+                token = tokens_carga.firmar(celular, usuario['id_user'], expiracion)
+            else:
+                # Generar token único
+                token = secrets.token_urlsafe(32)
+                
+                # Un solo link vigente por usuario (los vencidos de todos los borra el mantenimiento)
+                cursor.execute("""
+                    DELETE FROM token_carga 
+                    WHERE celular = %s
+                """, (celular,))
+                
+                # Guardar token
+                cursor.execute("""
+                    INSERT INTO token_carga (token, celular, expiracion) 
+                    VALUES (%s, %s, %s)
+                """, (token, celular, expiracion))
+                
+                conn.commit()
             cursor.close()
-            conn.close()
-            return jsonify({
-                'success': False,
-                'message': 'Usuario no encontrado o inactivo'
-            }), 403
-        
-        # Generar token único
-        token = secrets.token_urlsafe(32)
-        
-        # Fecha de expiración (24 horas)
-        expiracion = datetime.now() + timedelta(hours=24)
-        
-        # Crear tabla si no existe
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS token_carga (
-                token VARCHAR(100) PRIMARY KEY,
-                celular VARCHAR(20) NOT NULL,
-                expiracion DATETIME NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_celular (celular),
-                INDEX idx_expiracion (expiracion)
-            )
-        """)
-        
-        # Limpiar tokens expirados del usuario
-        cursor.execute("""
-            DELETE FROM token_carga 
-            WHERE celular = %s OR expiracion < NOW()
-        """, (celular,))
-        
-        # Guardar token
-        cursor.execute("""
-            INSERT INTO token_carga (token, celular, expiracion) 
-            VALUES (%s, %s, %s)
-        """, (token, celular, expiracion))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        # Construir URL completa
-        base_url = request.host_url.rstrip('/')
-        upload_url = f"{base_url}/carga-masiva/{token}"
-        
-        response = jsonify({
-            'success': True,
-            'token': token,
-            'url': upload_url,
-            'expira_en': '24 horas',
-            'mensaje': f'Link generado para {usuario["nombres"]}'
-        })
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response, 200
-        
+            
+            # Construir URL completa
+            base_url = request.host_url.rstrip('/')
+            upload_url = f"{base_url}/carga-masiva/{token}"
+            
+            response = jsonify({
+                'success': True,
+                'token': token,
+                'url': upload_url,
+                'expira_en': f'{tokens_carga.HORAS_VIGENCIA} horas',
+                'mensaje': f'Link generado para {usuario["nombres"]}'
+            })
+            response.headers.add('Access-Control-Allow-Origin', '*')
+            return response, 200
+            
     except Exception as e:
         return jsonify({
             'success': False,
             'message': f'Error al generar token: {str(e)}'
         }), 500
 
+# ==================== VALIDACIÓN DE TOKEN DE CARGA ====================
+def validar_token_carga(token):
+    """
+    {'celular', 'id_user', 'expiracion'} del token vigente o None.
+    Los firmados se validan sin BD (ver tokens_carga.py); los demás se buscan en token_carga.
+    Lanza Error si la BD no está disponible.
+    """
+    if tokens_carga.es_firmado(token):
+        return tokens_carga.verificar(token)
+
+    with conexion_bd() as conn:
+        if not conn:
+            raise Error(msg='Error de conexión a BD')
+        
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("""
+                SELECT t.celular, t.expiracion, u.id_user
+                FROM token_carga t
+                LEFT JOIN users u ON u.Celular = t.celular
+                WHERE t.token = %s AND t.expiracion > NOW()
+            """, (token,))
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
 # ==================== PÁGINA WEB: CARGA MASIVA ====================
 @app.route('/carga-masiva/<token>', methods=['GET'])
 def pagina_carga_masiva(token):
     """Página web para descargar plantilla y subir archivo"""
     
     # Validar token
-    conn = get_db_connection()
-    if not conn:
-        return "Error de conexión a la base de datos", 500
+    try:
+        token_data = validar_token_carga(token)
+    except Exception as e:
+        return f"Error al cargar la página: {str(e)}", 500
     
     try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT celular, expiracion 
-            FROM token_carga 
-            WHERE token = %s AND expiracion > NOW()
-        """, (token,))
-        token_data = cursor.fetchone()
-        
         if not token_data:
-            cursor.close()
-            conn.close()
             return """
             <!DOCTYPE html>
             <html><head><meta charset="UTF-8"><title>Token Inválido</title></head>
@@ -2087,8 +3264,6 @@ def pagina_carga_masiva(token):
         
         fecha_expiracion = token_data['expiracion']
         celular = token_data['celular']
-        cursor.close()
-        conn.close()
         
         html = f"""
         <!DOCTYPE html>
@@ -2204,13 +3379,21 @@ def pagina_carga_masiva(token):
                 
                 <div class="section">
                     <h2><i class="fas fa-upload"></i> Paso 2: Subir Archivo Completado</h2>
-                    <p>Selecciona tu archivo Excel con los reportes:</p>
+                    <p>Selecciona tu archivo Excel (o CSV / Parquet con las mismas columnas) con los reportes:</p>
                     <form id="uploadForm" enctype="multipart/form-data">
-                        <input type="file" id="excelFile" name="file" accept=".xlsx" class="file-input" onchange="updateFileName()">
+                        <input type="file" id="excelFile" name="file" accept=".xlsx,.csv,.parquet" class="file-input" onchange="updateFileName()">
                         <label for="excelFile" class="file-label">
                             <i class="fas fa-cloud-upload-alt"></i>
-                            <span id="fileName">Click para seleccionar archivo .xlsx</span>
+                            <span id="fileName">Click para seleccionar archivo .xlsx, .csv o .parquet</span>
                         </label>
+                        <p>
+                            <label for="duplicados">Si un reporte ya existe:</label>
+                            <select id="duplicados" name="duplicados">
+                                <option value="omitir">Omitirlo</option>
+                                <option value="actualizar">Actualizarlo con los datos del archivo</option>
+                                <option value="fallar">Reportarlo como error</option>
+                            </select>
+                        </p>
                         <button type="submit" class="btn btn-upload">
                             <i class="fas fa-upload"></i> Importar Reportes
                         </button>
@@ -2218,7 +3401,7 @@ def pagina_carga_masiva(token):
                     
                     <div class="loading" id="loading">
                         <i class="fas fa-spinner"></i>
-                        <p>Procesando archivo...</p>
+                        <p id="progreso">Procesando archivo...</p>
                     </div>
                     
                     <div class="result" id="result"></div>
@@ -2250,8 +3433,10 @@ def pagina_carga_masiva(token):
                     
                     const formData = new FormData();
                     formData.append('file', file);
+                    formData.append('duplicados', document.getElementById('duplicados').value);
                     
                     document.getElementById('loading').style.display = 'block';
+                    document.getElementById('progreso').textContent = 'Subiendo archivo...';
                     document.getElementById('result').style.display = 'none';
                     
                     try {{
@@ -2262,17 +3447,28 @@ def pagina_carga_masiva(token):
                         
                         const data = await response.json();
                         
+                        if (!data.success) {{
+                            document.getElementById('loading').style.display = 'none';
+                            showResult('❌ Error: ' + (data.message || 'Error desconocido'), 'error');
+                            return;
+                        }}
+                        
+                        const trabajo = await esperarTrabajo(data.trabajo_id);
+                        
                         document.getElementById('loading').style.display = 'none';
                         
-                        if (data.success) {{
+                        if (trabajo.estado === 'completado') {{
+                            const resultado = trabajo.resultado;
                             let message = `✅ Importación completada\\n`;
-                            message += `Total: ${{data.total_filas}}\\n`;
-                            message += `Importados: ${{data.importados}}\\n`;
-                            message += `Errores: ${{data.errores}}`;
+                            message += `Total: ${{resultado.total_filas}}\\n`;
+                            message += `Importados: ${{resultado.insertados}}\\n`;
+                            message += `Duplicados omitidos: ${{resultado.duplicados.omitidos}}\\n`;
+                            message += `Actualizados: ${{resultado.duplicados.actualizados}}\\n`;
+                            message += `Errores: ${{resultado.errores}}`;
                             
-                            if (data.detalles && data.detalles.length > 0) {{
-                                message += '\\n\\nDetalles:\\n';
-                                data.detalles.slice(0, 10).forEach(det => {{
+                            if (resultado.detalles && resultado.detalles.length > 0) {{
+                                message += '\\n\\nFilas con error:\\n';
+                                resultado.detalles.slice(0, 10).forEach(det => {{
                                     const icon = det.status === 'success' ? '✅' : '❌';
                                     message += `${{icon}} Fila ${{det.fila}}: ${{det.mensaje}}\\n`;
                                 }});
@@ -2280,9 +3476,9 @@ def pagina_carga_masiva(token):
                             
                             showResult(message, 'success');
                             fileInput.value = '';
-                            document.getElementById('fileName').textContent = 'Click para seleccionar archivo .xlsx';
+                            document.getElementById('fileName').textContent = 'Click para seleccionar archivo .xlsx, .csv o .parquet';
                         }} else {{
-                            showResult('❌ Error: ' + (data.message || 'Error desconocido'), 'error');
+                            showResult('❌ Error: ' + (trabajo.mensaje || 'La importación no terminó (' + trabajo.estado + ')'), 'error');
                         }}
                     }} catch (error) {{
                         document.getElementById('loading').style.display = 'none';
@@ -2290,6 +3486,31 @@ def pagina_carga_masiva(token):
                     }}
                 }});
                 
+                async function esperarTrabajo(trabajoId) {{
+                    const progreso = document.getElementById('progreso');
+                    while (true) {{
+                        const response = await fetch(`/api/importaciones/${{trabajoId}}`);
+                        const trabajo = await response.json();
+                        if (!trabajo.success) {{
+                            return {{ estado: 'fallido', mensaje: trabajo.message }};
+                        }}
+                        if (!['en_cola', 'procesando'].includes(trabajo.estado)) {{
+                            return trabajo;
+                        }}
+                        if (trabajo.total_filas) {{
+                            let texto = `Procesadas ${{trabajo.procesadas}} de ${{trabajo.total_filas}} filas (${{trabajo.porcentaje}}%)`;
+                            texto += ` - Errores: ${{trabajo.errores}}`;
+                            if (trabajo.eta_segundos !== null) {{
+                                texto += ` - Faltan ~${{Math.ceil(trabajo.eta_segundos)}} s`;
+                            }}
+                            progreso.textContent = texto;
+                        }} else {{
+                            progreso.textContent = trabajo.estado === 'en_cola' ? 'En cola...' : 'Leyendo archivo...';
+                        }}
+                        await new Promise(resolve => setTimeout(resolve, 1500));
+                    }}
+                }}
+                
                 function showResult(message, type) {{
                     const resultDiv = document.getElementById('result');
                     resultDiv.textContent = message;
@@ -2312,88 +3533,16 @@ def descargar_plantilla_con_token(token):
     """Descarga plantilla Excel validando el token"""
     
     # Validar token
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({{'success': False, 'message': 'Error de conexión'}}), 500
+    try:
+        token_data = validar_token_carga(token)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error al generar plantilla: {str(e)}'}), 500
     
     try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT celular FROM token_carga 
-            WHERE token = %s AND expiracion > NOW()
-        """, (token,))
-        token_data = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
         if not token_data:
             return jsonify({'success': False, 'message': 'Token inválido o expirado'}), 404
         
-        # Crear plantilla Excel
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Plantilla Reportes"
-        
-        # Headers según la imagen proporcionada
-        headers = [
-            'Documento Conductor',
-            'Nombre Conductor',
-            'Apellidos Conductor',
-            'Fecha Inicio Reporte',
-            'Placa Vehiculo',
-            'Valor del Reporte',
-            'Descripcion del Reporte',
-            'Vehiculo Afiliado'
-        ]
-        
-        # Estilo para el header
-        header_fill = PatternFill(start_color="5B9BD5", end_color="5B9BD5", fill_type="solid")
-        header_font = Font(color="FFFFFF", bold=True, size=11)
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Escribir headers
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num)
-            cell.value = header
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = header_alignment
-        
-        # Ajustar anchos de columnas
-        ws.column_dimensions['A'].width = 20  # Documento Conductor
-        ws.column_dimensions['B'].width = 20  # Nombre Conductor
-        ws.column_dimensions['C'].width = 22  # Apellidos Conductor
-        ws.column_dimensions['D'].width = 20  # Fecha Inicio Reporte
-        ws.column_dimensions['E'].width = 15  # Placa Vehiculo
-        ws.column_dimensions['F'].width = 18  # Valor del Reporte
-        ws.column_dimensions['G'].width = 40  # Descripcion del Reporte
-        ws.column_dimensions['H'].width = 18  # Vehiculo Afiliado
-        
-        # Agregar fila de ejemplo
-        ws.append([
-            '123456789',
-            'Juan',
-            'Pérez',
-            '2026-01-15',
-            'ABC123',
-            '50000',
-            'Descripción del reporte',
-            'SI'
-        ])
-        
-        # Guardar en memoria
-        excel_file = io.BytesIO()
-        wb.save(excel_file)
-        excel_file.seek(0)
-        
-        filename = f"Plantilla_Importacion.xlsx"
-        
-        return send_file(
-            excel_file,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+        return enviar_plantilla('carga_masiva', 'Plantilla_Importacion.xlsx')
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error al generar plantilla: {str(e)}'}), 500
@@ -2403,154 +3552,148 @@ def descargar_plantilla_con_token(token):
 def importar_excel_con_token(token):
     """Importa reportes validando el token"""
     
-    # Validar token
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({{'success': False, 'message': 'Error de conexión'}}), 500
-    
+    # Validar token (el id_user viene en el token firmado o en el mismo SELECT del token)
     try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT celular FROM token_carga 
-            WHERE token = %s AND expiracion > NOW()
-        """, (token,))
-        token_data = cursor.fetchone()
-        
-        if not token_data:
-            cursor.close()
-            conn.close()
-            return jsonify({'success': False, 'message': 'Token inválido o expirado'}), 404
-        
-        celular = token_data['celular']
-        
-        # Obtener id_user
-        cursor.execute("SELECT id_user FROM users WHERE Celular = %s", (celular,))
-        user_result = cursor.fetchone()
-        
-        if not user_result:
-            cursor.close()
-            conn.close()
-            return jsonify({'success': False, 'message': 'Usuario no encontrado'}), 400
-        
-        id_user = user_result['id_user']
-        
-        # Verificar archivo
-        if 'file' not in request.files:
-            cursor.close()
-            conn.close()
-            return jsonify({'success': False, 'message': 'No se envió ningún archivo'}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            cursor.close()
-            conn.close()
-            return jsonify({'success': False, 'message': 'No se seleccionó ningún archivo'}), 400
-        
-        if not file.filename.endswith('.xlsx'):
-            cursor.close()
-            conn.close()
-            return jsonify({'success': False, 'message': 'El archivo debe ser formato .xlsx'}), 400
-        
-        # Leer Excel
-        df = pd.read_excel(file, engine='openpyxl')
-        
-        # Limpiar nombres de columnas (quitar espacios extra)
-        df.columns = df.columns.str.strip()
-        
-        # Mapeo de nombres de columnas (normalizar)
-        columnas_requeridas = [
-            'Documento Conductor', 'Nombre Conductor', 'Apellidos Conductor',
-            'Placa Vehiculo', 'Valor del Reporte', 'Descripcion del Reporte'
-        ]
-        
-        # Verificar columnas - Si falta alguna, mostrar cuáles tiene el archivo
-        columnas_faltantes = [col for col in columnas_requeridas if col not in df.columns]
+        token_data = validar_token_carga(token)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error al procesar el archivo: {str(e)}'}), 500
+    
+    if not token_data:
+        return jsonify({'success': False, 'message': 'Token inválido o expirado'}), 404
+    
+    if token_data['id_user'] is None:
+        return jsonify({'success': False, 'message': 'Usuario no encontrado'}), 400
+    
+    id_user = token_data['id_user']
+    
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        if columnas_faltantes:
-            cursor.close()
-            conn.close()
+        try:
+            # Verificar archivo
+            if 'file' not in request.files:
+                return jsonify({'success': False, 'message': 'No se envió ningún archivo'}), 400
+            
+            file = request.files['file']
+            
+            if file.filename == '':
+                return jsonify({'success': False, 'message': 'No se seleccionó ningún archivo'}), 400
+            
+            if request.content_length and request.content_length > importacion.MAX_BYTES:
+                return jsonify({
+                    'success': False,
+                    'message': f'El archivo supera el máximo de {importacion.MAX_BYTES // (1024 * 1024)} MB'
+                }), 413
+            
+            # El archivo se procesa en segundo plano; la página consulta el progreso
+            modo_duplicados = importacion.modo_duplicados_solicitado(request.form.get('duplicados'))
+            if not modo_duplicados:
+                return jsonify({
+                    'success': False,
+                    'message': f'duplicados debe ser uno de: {", ".join(importacion.MODOS_DUPLICADOS)}'
+                }), 400
+            
+            trabajo = iniciar_importacion(
+                conn, file, 'token', id_user, importacion.TAMANO_LOTE, modo_duplicados,
+                esperar=solicita_esperar()
+            )
+            
+            if trabajo.estado not in (trabajos.COMPLETADO, trabajos.FALLIDO):
+                return respuesta_trabajo_encolado(trabajo)
+            
+            if trabajo.estado == trabajos.FALLIDO:
+                codigo = 400 if isinstance(trabajo.excepcion, importacion.ErrorImportacion) else 500
+                return jsonify({'success': False, 'message': trabajo.mensaje}), codigo
+            
+            resultado = trabajo.resultado
+            return jsonify({
+                'success': True,
+                'message': (
+                    'Archivo ya importado anteriormente' if trabajo.reutilizado
+                    else f'Importación completada: {trabajo.insertados} exitosos, {resultado["errores"]} errores'
+                ),
+                'trabajo_id': trabajo.id,
+                'reutilizado': trabajo.reutilizado,
+                'total_filas': resultado['total_filas'],
+                'importados': trabajo.insertados,
+                'errores': resultado['errores'],
+                'detalles': resultado['detalles'],
+                'detalles_truncados': resultado['detalles_truncados'],
+                'errores_por_motivo': resultado['errores_por_motivo'],
+                'lotes': resultado['lotes'],
+                'duplicados': resultado['duplicados']
+            }), 200
+            
+        except importacion.ErrorImportacion as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        except Exception as e:
             return jsonify({
                 'success': False,
-                'message': f'Columnas faltantes: {", ".join(columnas_faltantes)}. Columnas encontradas: {", ".join(df.columns.tolist())}'
-            }), 400
-        
-        # Procesar filas
-        total_filas = len(df)
-        importados = 0
-        errores = 0
-        detalles = []
+                'message': f'Error al procesar el archivo: {str(e)}'
+            }), 500
+
+# ==================== ENDPOINT: ESTADO DE IMPORTACIÓN ====================
+@app.route('/api/importaciones/<trabajo_id>', methods=['GET'])
+def estado_importacion(trabajo_id):
+    """
+    Consultar el progreso de una importación en segundo plano
+    ---
+    tags:
+      - Reportes
+    parameters:
+      - name: trabajo_id
+        in: path
+        type: string
+        required: true
+        description: Identificador devuelto al subir el archivo (no adivinable, sirve como credencial)
+    responses:
+      200:
+        description: Estado del trabajo
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            estado:
+              type: string
+              enum: [en_cola, procesando, completado, fallido, interrumpido]
+            total_filas:
+              type: integer
+            procesadas:
+              type: integer
+            porcentaje:
+              type: number
+            insertados:
+              type: integer
+            errores:
+              type: integer
+            eta_segundos:
+              type: number
+            mensaje:
+              type: string
+            resultado:
+              type: object
+              description: Resumen final al completar (detalles de errores, errores por motivo, lotes, formato, segundos y filas_por_segundo)
+      404:
+        description: Trabajo no encontrado
+      500:
+        description: Error del servidor
+    """
+    with conexion_bd() as conn:
+        if not conn:
+            return jsonify({'success': False, 'message': 'Error de conexión'}), 500
         
-        for index, row in df.iterrows():
-            fila_num = index + 2
+        try:
+            estado = trabajos_importacion.consultar(conn, trabajo_id)
+            if not estado:
+                return jsonify({'success': False, 'message': 'Trabajo no encontrado'}), 404
             
-            try:
-                # Validar campos
-                if pd.isna(row['Documento Conductor']) or pd.isna(row['Nombre Conductor']) or pd.isna(row['Apellidos Conductor']):
-                    detalles.append({
-                        'fila': fila_num,
-                        'status': 'error',
-                        'mensaje': 'Campos obligatorios vacíos'
-                    })
-                    errores += 1
-                    continue
-                
-                # Extraer datos
-                numero_doc = str(row['Documento Conductor']).strip()
-                nombres = str(row['Nombre Conductor']).strip()
-                apellidos = str(row['Apellidos Conductor']).strip()
-                placa = str(row['Placa Vehiculo']).strip() if not pd.isna(row['Placa Vehiculo']) else ''
-                valor = str(row['Valor del Reporte']).strip() if not pd.isna(row['Valor del Reporte']) else '0'
-                descripcion = str(row['Descripcion del Reporte']).strip() if not pd.isna(row['Descripcion del Reporte']) else ''
-                vehiculo_afiliado = str(row['Vehiculo Afiliado']).strip().upper() if not pd.isna(row['Vehiculo Afiliado']) else 'No'
-                
-                # Insertar
-                query = """
-                    INSERT INTO personas 
-                    (Fecha_Reporte, Numero_Documento, Nombres, Apellidos, 
-                     Placa, Valor_Reporte, Descripcion_Reporte, 
-                     Vehiculo_afiliado, Estado, Reportante_Nombres)
-                    VALUES (NOW(), %s, %s, %s, %s, %s, %s, %s, 'Activo', %s)
-                """
-                
-                cursor.execute(query, (
-                    numero_doc, nombres, apellidos, 
-                    placa, valor, descripcion, vehiculo_afiliado, id_user
-                ))
-                
-                importados += 1
-                detalles.append({
-                    'fila': fila_num,
-                    'status': 'success',
-                    'mensaje': f'Reporte importado: {nombres} {apellidos}'
-                })
-                
-            except Exception as e:
-                errores += 1
-                detalles.append({
-                    'fila': fila_num,
-                    'status': 'error',
-                    'mensaje': f'Error: {str(e)}'
-                })
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'message': f'Importación completada: {importados} exitosos, {errores} errores',
-            'total_filas': total_filas,
-            'importados': importados,
-            'errores': errores,
-            'detalles': detalles
-        }), 200
-        
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'message': f'Error al procesar el archivo: {str(e)}'
-        }), 500
+            return jsonify({'success': True, **estado}), 200
+            
+        except Error as e:
+            print(f"[ERROR] Error al consultar trabajo {trabajo_id}: {str(e)}")
+            return jsonify({'success': False, 'message': 'Error al consultar el trabajo'}), 500
 
 # ==================== ENDPOINT: DESCARGAR PLANTILLA EXCEL (ORIGINAL) ====================
 @app.route('/api/plantilla-excel', methods=['GET', 'OPTIONS'])
@@ -2571,6 +3714,8 @@ def descargar_plantilla_excel():
         description: Archivo Excel descargado exitosamente
         schema:
           type: file
+      304:
+        description: La plantilla no cambió (If-None-Match / If-Modified-Since)
       500:
         description: Error al generar la plantilla
         schema:
@@ -2589,66 +3734,10 @@ def descargar_plantilla_excel():
         return response
     
     try:
-        # Crear un nuevo workbook con openpyxl
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Plantilla Reportes"
-        
-        # Definir los headers
-        headers = [
-            'Numero_Documento',
-            'Nombres', 
-            'Apellidos',
-            'Placa',
-            'Valor_Reporte',
-            'Descripcion_Reporte'
-        ]
-        
-        # Estilo para el header
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(color="FFFFFF", bold=True, size=12)
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Escribir headers en la primera fila
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num)
-            cell.value = header
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = header_alignment
-        
-        # Ajustar ancho de columnas
-        ws.column_dimensions['A'].width = 18  # Numero_Documento
-        ws.column_dimensions['B'].width = 25  # Nombres
-        ws.column_dimensions['C'].width = 25  # Apellidos
-        ws.column_dimensions['D'].width = 12  # Placa
-        ws.column_dimensions['E'].width = 15  # Valor_Reporte
-        ws.column_dimensions['F'].width = 50  # Descripcion_Reporte
-        
-        # Agregar una fila de ejemplo
-        ws.append([
-            '1234567890',
-            'Juan Carlos',
-            'Pérez García',
-            'ABC123',
-            '50000',
-            'Servicio mal prestado, conductor grosero'
-        ])
-        
-        # Guardar el archivo en memoria
-        excel_file = io.BytesIO()
-        wb.save(excel_file)
-        excel_file.seek(0)
-        
         # Nombre del archivo con fecha
         filename = f"plantilla_reportes_{datetime.now().strftime('%Y%m%d')}.xlsx"
         
-        response = send_file(
-            excel_file,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+        response = enviar_plantilla('reportes_original', filename)
         
         response.headers.add('Access-Control-Allow-Origin', '*')
         return response
@@ -2690,6 +3779,56 @@ def index():
         }
     }), 200
 
+# ==================== MIGRACIONES DE ESQUEMA ====================
+def ejecutar_migraciones():
+    """Aplicar migraciones pendientes (ver migraciones.py). Retorna False si alguna falla"""
+    with conexion_bd() as conn:
+        if not conn:
+            print("[MIGRACIONES] Error de conexión a la base de datos")
+            return False
+        try:
+            aplicadas = migraciones.aplicar_migraciones(conn)
+            print(f"[MIGRACIONES] Aplicadas: {aplicadas or 'ninguna (esquema al día)'}")
+            return True
+        except Error as e:
+            print(f"[MIGRACIONES ERROR] {e}")
+            return False
+
+@app.cli.command('migrar')
+def comando_migrar():
+    """Aplicar migraciones de esquema pendientes: flask --app infotaxi_api migrar"""
+    if not ejecutar_migraciones():
+        raise SystemExit(1)
+
+# Con MIGRAR_AL_INICIAR=true cada worker intenta migrar al cargar la app;
+# el lock de MariaDB en aplicar_migraciones() deja migrar a uno solo a la vez
+if os.getenv('MIGRAR_AL_INICIAR', 'false').lower() == 'true':
+    ejecutar_migraciones()
+
+def verificar_esquema():
+    """Reportar tablas e índices faltantes (migraciones.ESQUEMA_REQUERIDO). Retorna la lista de faltantes"""
+    with conexion_bd() as conn:
+        if not conn:
+            print("[ESQUEMA] Error de conexión a la base de datos, no se verificó el esquema")
+            return None
+        try:
+            faltantes = migraciones.verificar_esquema(conn)
+        except Error as e:
+            print(f"[ESQUEMA ERROR] {e}")
+            return None
+
+    if faltantes:
+        print(f"[ESQUEMA] Faltan {len(faltantes)} tablas/índices: {', '.join(faltantes)}")
+        print("[ESQUEMA] Aplicar migraciones: flask --app infotaxi_api migrar")
+    else:
+        print("[ESQUEMA] Tablas e índices requeridos presentes")
+    return faltantes
+
+# Revisión única al cargar la app (después de migrar si MIGRAR_AL_INICIAR=true); solo lee information_schema.
+# Apagada por defecto para que importar el módulo (scripts, pruebas) no abra conexiones; el contenedor la activa.
+if os.getenv('VERIFICAR_ESQUEMA_AL_INICIAR', 'false').lower() == 'true':
+    verificar_esquema()
+
 # ==================== INICIAR SERVIDOR ====================
 if __name__ == '__main__':
     import os
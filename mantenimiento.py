@@ -0,0 +1,124 @@
+"""
+Limpieza periódica de la BD para InfoTaxi
+Un hilo por worker despierta cada `intervalo` segundos; solo el worker que obtiene el lock de MariaDB
+hace la ronda. Cada tarea borra por lotes pequeños para no bloquear las tablas.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+from mysql.connector import Error
+
+SEGUNDOS_ENTRE_RONDAS = float(os.getenv('MANTENIMIENTO_SEGUNDOS', 300))
+TAMANO_LOTE = int(os.getenv('MANTENIMIENTO_LOTE', 500))
+# Lotes máximos por tarea y ronda; lo que quede se borra en la siguiente
+MAX_LOTES_POR_RONDA = 20
+# Lock de MariaDB para que una sola réplica/worker limpie a la vez
+LOCK_MANTENIMIENTO = 'infotaxi_mantenimiento'
+
+
+class Tarea:
+    """`sql` es un DELETE ... LIMIT %s; `parametros()` da los valores anteriores al LIMIT en cada ronda"""
+
+    def __init__(self, nombre, sql, parametros=tuple):
+        self.nombre = nombre
+        self.sql = sql
+        self.parametros = parametros
+
+
+class Barredor:
+    def __init__(self, conexion_bd, tareas, intervalo=SEGUNDOS_ENTRE_RONDAS, tamano_lote=TAMANO_LOTE):
+        self._conexion_bd = conexion_bd
+        self.tareas = tareas
+        self.intervalo = intervalo
+        self.tamano_lote = tamano_lote
+        self._lock = threading.Lock()
+        self._hilo_pid = None
+        self._metricas = {
+            'rondas': 0,
+            'rondas_omitidas': 0,
+            'ultima_ronda': None,
+            'eliminadas': {tarea.nombre: 0 for tarea in tareas},
+            'errores': {tarea.nombre: 0 for tarea in tareas}
+        }
+
+    def iniciar(self):
+        """Arrancar el hilo de este proceso si aún no existe (barato: se llama en cada petición)"""
+        pid = os.getpid()
+        if self._hilo_pid == pid:
+            return
+        with self._lock:
+            if self._hilo_pid == pid:
+                return
+            self._hilo_pid = pid
+        threading.Thread(target=self._bucle, name='mantenimiento', daemon=True).start()
+
+    def _bucle(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.ronda()
+            except Exception as e:
+                print(f"[MANTENIMIENTO] Error en la ronda: {e}")
+
+    def ronda(self):
+        """Ejecutar todas las tareas una vez. Retorna {tarea: filas borradas} o None si otro worker tiene el lock"""
+        with self._conexion_bd() as conn:
+            if not conn:
+                return None
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT GET_LOCK(%s, 0)", (LOCK_MANTENIMIENTO,))
+                if cursor.fetchone()[0] != 1:
+                    with self._lock:
+                        self._metricas['rondas_omitidas'] += 1
+                    return None
+                try:
+                    return self._ejecutar_tareas(conn, cursor)
+                finally:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_MANTENIMIENTO,))
+                    cursor.fetchone()
+            finally:
+                cursor.close()
+
+    def _ejecutar_tareas(self, conn, cursor):
+        borradas = {}
+        for tarea in self.tareas:
+            total = 0
+            try:
+                parametros = tuple(tarea.parametros())
+                for _ in range(MAX_LOTES_POR_RONDA):
+                    cursor.execute(tarea.sql, parametros + (self.tamano_lote,))
+                    filas = cursor.rowcount
+                    conn.commit()
+                    total += filas
+                    if filas < self.tamano_lote:
+                        break
+            except Error as e:
+                conn.rollback()
+                print(f"[MANTENIMIENTO] Error en {tarea.nombre}: {e}")
+                with self._lock:
+                    self._metricas['errores'][tarea.nombre] += 1
+            borradas[tarea.nombre] = total
+            if total:
+                print(f"[MANTENIMIENTO] {tarea.nombre}: {total} filas eliminadas")
+
+        with self._lock:
+            self._metricas['rondas'] += 1
+            self._metricas['ultima_ronda'] = datetime.now().isoformat()
+            for nombre, total in borradas.items():
+                self._metricas['eliminadas'][nombre] += total
+        return borradas
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'intervalo': self.intervalo,
+                'tamano_lote': self.tamano_lote,
+                'rondas': self._metricas['rondas'],
+                'rondas_omitidas': self._metricas['rondas_omitidas'],
+                'ultima_ronda': self._metricas['ultima_ronda'],
+                'eliminadas': dict(self._metricas['eliminadas']),
+                'errores': dict(self._metricas['errores'])
+            }
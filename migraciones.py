@@ -0,0 +1,342 @@
+"""
+Migraciones de esquema para la base de datos de InfoTaxi
+Cada migración tiene una versión única; las aplicadas se registran en schema_migraciones
+"""
+
+import sys
+from datetime import datetime
+from mysql.connector import Error
+
+# Nombre del lock de MariaDB que serializa a los workers que migran al iniciar
+LOCK_MIGRACIONES = 'infotaxi_migraciones'
+
+
+def _celular_unico(cursor):
+    """Índice único en users.Celular; falla con detalle si hay celulares repetidos"""
+    cursor.execute("""
+        SELECT Celular, COUNT(*) AS total
+        FROM users
+        GROUP BY Celular
+        HAVING COUNT(*) > 1
+    """)
+    duplicados = cursor.fetchall()
+    if duplicados:
+        detalle = ', '.join(f"'{fila[0]}' ({fila[1]})" for fila in duplicados)
+        raise Error(msg=f'Celulares repetidos en users, corregirlos antes de migrar: {detalle}')
+    cursor.execute("ALTER TABLE users ADD UNIQUE INDEX IF NOT EXISTS uq_users_celular (Celular)")
+
+
+def _rellenar_id_reportante_v4(cursor):
+    """Relleno original de la versión 4 (sin TRIM), congelado: la versión 10 corrige lo que este deja"""
+    while True:
+        cursor.execute("""
+            UPDATE personas
+            SET id_reportante = CAST(Reportante_Nombres AS UNSIGNED)
+            WHERE id_reportante IS NULL AND Reportante_Nombres REGEXP '^[0-9]+$'
+            LIMIT 5000
+        """)
+        if cursor.rowcount == 0:
+            break
+
+
+# Filas de personas por UPDATE al rellenar id_reportante
+LOTE_RELLENO = 5000
+
+
+def _rellenar_id_reportante(cursor):
+    """
+    Copiar personas.Reportante_Nombres (id de usuario guardado como texto, con o sin espacios) a
+    id_reportante, por rangos de llave primaria con commit por rango para no bloquear la tabla
+    en una sola transacción. Informa cuántas filas quedan sin id_reportante.
+    """
+    cursor.execute("SELECT MIN(id), MAX(id) FROM personas")
+    minimo, maximo = cursor.fetchone()
+    if minimo is None:
+        return
+
+    for desde in range(minimo, maximo + 1, LOTE_RELLENO):
+        cursor.execute("""
+            UPDATE personas
+            SET id_reportante = CAST(TRIM(Reportante_Nombres) AS UNSIGNED)
+            WHERE id BETWEEN %s AND %s
+            AND id_reportante IS NULL AND TRIM(Reportante_Nombres) REGEXP '^[0-9]+$'
+        """, (desde, desde + LOTE_RELLENO - 1))
+        cursor.execute("COMMIT")
+
+    cursor.execute("SELECT COUNT(*) FROM personas WHERE id_reportante IS NULL")
+    sin_id = cursor.fetchone()[0]
+    if sin_id:
+        print(f"[MIGRACIONES] Filas de personas sin id_reportante (Reportante_Nombres vacío o no numérico): {sin_id}")
+
+
+def _consultas_una_fila_por_usuario(cursor):
+    """Dejar solo la fila más reciente de cada usuario (la que mostraba el contador) para el índice único"""
+    cursor.execute("""
+        DELETE c FROM consultas c
+        INNER JOIN consultas d ON d.user_id = c.user_id AND d.id > c.id
+    """)
+    if cursor.rowcount:
+        print(f"[MIGRACIONES] Filas repetidas eliminadas de consultas: {cursor.rowcount}")
+
+
+# (versión, descripción, pasos). Un paso es una sentencia SQL o una función que recibe el cursor.
+# Las versiones ya publicadas no se editan: los cambios nuevos van en una versión nueva.
+MIGRACIONES = [
+    (1, 'Índices de personas para búsquedas por cédula y reportante', [
+        "ALTER TABLE personas ADD INDEX IF NOT EXISTS idx_personas_documento_fecha (Numero_Documento, Fecha_Reporte)",
+        "ALTER TABLE personas ADD INDEX IF NOT EXISTS idx_personas_reportante (Reportante_Nombres(20))",
+    ]),
+    (2, 'Índice único de users por celular', [
+        _celular_unico,
+    ]),
+    (3, 'Índice de consultas por usuario', [
+        "ALTER TABLE consultas ADD INDEX IF NOT EXISTS idx_consultas_user (user_id)",
+    ]),
+    (4, 'Columna entera personas.id_reportante para unir con users.id_user', [
+        "ALTER TABLE personas ADD COLUMN IF NOT EXISTS id_reportante INT NULL AFTER Reportante_Nombres",
+        "ALTER TABLE personas ADD INDEX IF NOT EXISTS idx_personas_id_reportante (id_reportante)",
+        _rellenar_id_reportante_v4,
+        # Mantener la columna al día cuando otros sistemas solo escriben Reportante_Nombres
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_personas_reportante_ins BEFORE INSERT ON personas
+        FOR EACH ROW SET NEW.id_reportante = COALESCE(
+            NEW.id_reportante,
+            IF(NEW.Reportante_Nombres REGEXP '^[0-9]+$', CAST(NEW.Reportante_Nombres AS UNSIGNED), NULL)
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_personas_reportante_upd BEFORE UPDATE ON personas
+        FOR EACH ROW SET NEW.id_reportante = IF(
+            NEW.Reportante_Nombres <=> OLD.Reportante_Nombres,
+            NEW.id_reportante,
+            IF(NEW.Reportante_Nombres REGEXP '^[0-9]+$', CAST(NEW.Reportante_Nombres AS UNSIGNED), NULL)
+        )
+        """,
+    ]),
+    (5, 'Tabla de trabajos de importación en segundo plano', [
+        """
+        CREATE TABLE IF NOT EXISTS importacion_trabajos (
+            id VARCHAR(40) PRIMARY KEY,
+            tipo VARCHAR(20) NOT NULL,
+            id_user INT NOT NULL,
+            estado VARCHAR(20) NOT NULL,
+            total_filas INT NULL,
+            procesadas INT NOT NULL DEFAULT 0,
+            insertados INT NOT NULL DEFAULT 0,
+            errores INT NOT NULL DEFAULT 0,
+            mensaje VARCHAR(500) NULL,
+            resultado MEDIUMTEXT NULL,
+            creado_en DATETIME NOT NULL,
+            iniciado_en DATETIME NULL,
+            actualizado_en DATETIME NOT NULL,
+            terminado_en DATETIME NULL,
+            INDEX idx_trabajos_user (id_user, creado_en)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """,
+    ]),
+    (6, 'Idempotencia de importaciones (hash del archivo) y de peticiones POST (Idempotency-Key)', [
+        "ALTER TABLE importacion_trabajos ADD COLUMN IF NOT EXISTS hash_archivo CHAR(64) NULL AFTER id_user",
+        "ALTER TABLE importacion_trabajos ADD INDEX IF NOT EXISTS idx_trabajos_hash (id_user, hash_archivo)",
+        """
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            ambito VARCHAR(150) NOT NULL,
+            clave VARCHAR(100) NOT NULL,
+            huella CHAR(64) NOT NULL,
+            codigo SMALLINT NULL,
+            cuerpo MEDIUMTEXT NULL,
+            creado_en DATETIME NOT NULL,
+            PRIMARY KEY (ambito, clave),
+            INDEX idx_idempotencia_creado (creado_en)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """,
+    ]),
+    (7, 'Una fila de consultas por usuario para el contador atómico', [
+        _consultas_una_fila_por_usuario,
+        "ALTER TABLE consultas ADD UNIQUE INDEX IF NOT EXISTS uq_consultas_user (user_id)",
+        "ALTER TABLE consultas DROP INDEX IF EXISTS idx_consultas_user",
+    ]),
+    (8, 'Historial de consultas por cédula y consultas en InnoDB', [
+        """
+        CREATE TABLE IF NOT EXISTS consultas_historial (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            cedula VARCHAR(20) NOT NULL,
+            reportes INT NOT NULL,
+            consultado_en DATETIME NOT NULL,
+            INDEX idx_historial_cedula (cedula, consultado_en),
+            INDEX idx_historial_user (user_id, consultado_en)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """,
+        # MyISAM bloquea la tabla completa en cada escritura del contador
+        "ALTER TABLE consultas ENGINE=InnoDB",
+    ]),
+    (9, 'Tabla token_carga (antes se creaba en cada token) e índice de vencimiento de user_state', [
+        """
+        CREATE TABLE IF NOT EXISTS token_carga (
+            token VARCHAR(100) PRIMARY KEY,
+            celular VARCHAR(20) NOT NULL,
+            expiracion DATETIME NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_celular (celular),
+            INDEX idx_expiracion (expiracion)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """,
+        # Para el borrado por lotes de estados vencidos (mantenimiento.py)
+        "ALTER TABLE user_state ADD INDEX IF NOT EXISTS idx_user_state_updated (updated_at)",
+    ]),
+    (10, 'id_reportante también para Reportante_Nombres con espacios (relleno y triggers con TRIM)', [
+        _rellenar_id_reportante,
+        "DROP TRIGGER IF EXISTS trg_personas_reportante_ins",
+        """
+        CREATE TRIGGER trg_personas_reportante_ins BEFORE INSERT ON personas
+        FOR EACH ROW SET NEW.id_reportante = COALESCE(
+            NEW.id_reportante,
+            IF(TRIM(NEW.Reportante_Nombres) REGEXP '^[0-9]+$', CAST(TRIM(NEW.Reportante_Nombres) AS UNSIGNED), NULL)
+        )
+        """,
+        "DROP TRIGGER IF EXISTS trg_personas_reportante_upd",
+        """
+        CREATE TRIGGER trg_personas_reportante_upd BEFORE UPDATE ON personas
+        FOR EACH ROW SET NEW.id_reportante = IF(
+            NEW.Reportante_Nombres <=> OLD.Reportante_Nombres,
+            NEW.id_reportante,
+            IF(TRIM(NEW.Reportante_Nombres) REGEXP '^[0-9]+$', CAST(TRIM(NEW.Reportante_Nombres) AS UNSIGNED), NULL)
+        )
+        """,
+    ]),
+]
+
+# Tablas e índices de los que depende la API: {tabla: [índices]}. Se revisa al iniciar (verificar_esquema)
+ESQUEMA_REQUERIDO = {
+    'users': ['PRIMARY', 'uq_users_celular'],
+    'personas': ['PRIMARY', 'idx_personas_documento_fecha', 'idx_personas_id_reportante'],
+    'consultas': ['PRIMARY', 'uq_consultas_user'],
+    'consultas_historial': ['PRIMARY', 'idx_historial_cedula', 'idx_historial_user'],
+    'user_state': ['PRIMARY', 'idx_user_state_updated'],
+    'token_carga': ['PRIMARY', 'idx_celular', 'idx_expiracion'],
+    'importacion_trabajos': ['PRIMARY', 'idx_trabajos_user', 'idx_trabajos_hash'],
+    'idempotencia': ['PRIMARY', 'idx_idempotencia_creado'],
+}
+
+
+def _crear_tabla_versiones(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migraciones (
+            version INT PRIMARY KEY,
+            descripcion VARCHAR(200) NOT NULL,
+            aplicada_en DATETIME NOT NULL
+        ) ENGINE=InnoDB
+    """)
+
+
+def versiones_aplicadas(conn):
+    """Conjunto de versiones ya registradas en schema_migraciones"""
+    cursor = conn.cursor()
+    try:
+        _crear_tabla_versiones(cursor)
+        cursor.execute("SELECT version FROM schema_migraciones")
+        return {fila[0] for fila in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def pendientes(conn):
+    """Migraciones que faltan por aplicar, en orden de versión"""
+    aplicadas = versiones_aplicadas(conn)
+    return [m for m in sorted(MIGRACIONES, key=lambda m: m[0]) if m[0] not in aplicadas]
+
+
+def verificar_esquema(conn):
+    """
+    Comparar la BD actual con ESQUEMA_REQUERIDO (solo lectura de information_schema).
+    Retorna una lista de faltantes como 'tabla' o 'tabla.indice'; vacía si está todo.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT TABLE_NAME FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE()
+        """)
+        tablas = {fila[0].lower() for fila in cursor.fetchall()}
+        cursor.execute("""
+            SELECT DISTINCT TABLE_NAME, INDEX_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE()
+        """)
+        indices = {(fila[0].lower(), fila[1]) for fila in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+    faltantes = []
+    for tabla, requeridos in ESQUEMA_REQUERIDO.items():
+        if tabla not in tablas:
+            faltantes.append(tabla)
+            continue
+        faltantes.extend(f'{tabla}.{indice}' for indice in requeridos if (tabla, indice) not in indices)
+    return faltantes
+
+
+def aplicar_migraciones(conn, timeout_lock=60):
+    """
+    Aplicar las migraciones pendientes en orden.
+    Se detiene en la primera que falle; las anteriores quedan registradas.
+    Retorna la lista de versiones aplicadas en esta ejecución.
+    """
+    cursor = conn.cursor()
+    aplicadas = []
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_MIGRACIONES, timeout_lock))
+        if cursor.fetchone()[0] != 1:
+            raise Error(msg='No se obtuvo el lock de migraciones (otro proceso está migrando)')
+
+        try:
+            for version, descripcion, pasos in pendientes(conn):
+                print(f"[MIGRACIONES] Aplicando {version}: {descripcion}")
+                for paso in pasos:
+                    if callable(paso):
+                        paso(cursor)
+                    else:
+                        cursor.execute(paso)
+                cursor.execute("""
+                    INSERT INTO schema_migraciones (version, descripcion, aplicada_en)
+                    VALUES (%s, %s, %s)
+                """, (version, descripcion, datetime.now()))
+                conn.commit()
+                aplicadas.append(version)
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_MIGRACIONES,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+
+    return aplicadas
+
+
+def main():
+    """Uso: python migraciones.py [estado]  (estado: versiones pendientes y tablas/índices faltantes)"""
+    from infotaxi_api import conexion_bd
+
+    with conexion_bd() as conn:
+        if not conn:
+            print("[MIGRACIONES] Error de conexión a la base de datos")
+            return 1
+
+        try:
+            if len(sys.argv) > 1 and sys.argv[1] == 'estado':
+                faltantes = pendientes(conn)
+                print(f"[MIGRACIONES] Aplicadas: {sorted(versiones_aplicadas(conn))}")
+                for version, descripcion, _ in faltantes:
+                    print(f"[MIGRACIONES] Pendiente {version}: {descripcion}")
+                for faltante in verificar_esquema(conn):
+                    print(f"[MIGRACIONES] Falta en la BD: {faltante}")
+                return 0
+
+            aplicadas = aplicar_migraciones(conn)
+            print(f"[MIGRACIONES] Completado. Aplicadas: {aplicadas or 'ninguna (esquema al día)'}")
+            return 0
+        except Error as e:
+            print(f"[MIGRACIONES ERROR] {e}")
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+Plantillas Excel de InfoTaxi
+Cada variante se genera una sola vez por proceso y se sirve desde memoria con ETag y Last-Modified
+"""
+
+import hashlib
+import io
+import os
+import threading
+from datetime import datetime, timezone
+from openpyxl import Workbook
+from openpyxl.styles import Font, PatternFill, Alignment
+
+MIMETYPE_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Definición de cada variante. `anchos` None = ancho automático por contenido.
+DEFINICIONES = {
+    # /api/plantilla-excel (importación con X-User-Celular)
+    'reportes': {
+        'encabezados': [
+            'Fecha_Reporte', 'Numero_Documento', 'Nombres', 'Apellidos',
+            'Fecha_cierre', 'Placa', 'Valor_Reporte', 'Descripcion_Reporte',
+            'Vehiculo_afiliado', 'Estado'
+        ],
+        'ejemplo': [
+            '2024-01-15', '1234567890', 'JUAN', 'PEREZ GOMEZ',
+            '', 'ABC123', '50000', 'REPORTE NEGATIVO POR TARIFAS',
+            'ADMICARS', 'ACTIVA'
+        ],
+        'color': '4472C4',
+        'tamano_fuente': None,
+        'alineacion_vertical': None,
+        'anchos': None
+    },
+    # /api/plantilla-excel-token/<token> (página de carga masiva)
+    'carga_masiva': {
+        'encabezados': [
+            'Documento Conductor', 'Nombre Conductor', 'Apellidos Conductor', 'Fecha Inicio Reporte',
+            'Placa Vehiculo', 'Valor del Reporte', 'Descripcion del Reporte', 'Vehiculo Afiliado'
+        ],
+        'ejemplo': [
+            '123456789', 'Juan', 'Pérez', '2026-01-15',
+            'ABC123', '50000', 'Descripción del reporte', 'SI'
+        ],
+        'color': '5B9BD5',
+        'tamano_fuente': 11,
+        'alineacion_vertical': 'center',
+        'anchos': [20, 20, 22, 20, 15, 18, 40, 18]
+    },
+    # Variante original de /api/plantilla-excel (sin autenticación, con CORS abierto)
+    'reportes_original': {
+        'encabezados': [
+            'Numero_Documento', 'Nombres', 'Apellidos', 'Placa', 'Valor_Reporte', 'Descripcion_Reporte'
+        ],
+        'ejemplo': [
+            '1234567890', 'Juan Carlos', 'Pérez García', 'ABC123', '50000',
+            'Servicio mal prestado, conductor grosero'
+        ],
+        'color': '366092',
+        'tamano_fuente': 12,
+        'alineacion_vertical': 'center',
+        'anchos': [18, 25, 25, 12, 15, 50]
+    }
+}
+
+# Las plantillas solo cambian al desplegar una versión nueva de este archivo
+_MODIFICADA = datetime.fromtimestamp(int(os.path.getmtime(__file__)), tz=timezone.utc)
+
+
+class Plantilla:
+    """Bytes de una plantilla ya generada con sus validadores HTTP"""
+
+    def __init__(self, nombre, definicion):
+        self.nombre = nombre
+        self.contenido = _generar(definicion)
+        # openpyxl guarda la hora de escritura en el archivo, así que los bytes difieren entre workers.
+        # El ETag se calcula sobre la definición y se envía débil (W/"..."): sirve para 304 en
+        # cualquier worker pero no promete bytes idénticos (sin rangos, ver enviar_plantilla)
+        self.etag = hashlib.sha256(repr(sorted(definicion.items())).encode('utf-8')).hexdigest()[:32]
+        self.modificada = _MODIFICADA
+
+    def archivo(self):
+        return io.BytesIO(self.contenido)
+
+
+def _generar(definicion):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Plantilla Reportes"
+
+    header_fill = PatternFill(start_color=definicion['color'], end_color=definicion['color'], fill_type='solid')
+    header_font = Font(color='FFFFFF', bold=True, size=definicion['tamano_fuente'])
+    header_alignment = Alignment(horizontal='center', vertical=definicion['alineacion_vertical'])
+
+    for col, header in enumerate(definicion['encabezados'], 1):
+        cell = ws.cell(row=1, column=col, value=header)
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = header_alignment
+
+    ws.append(definicion['ejemplo'])
+
+    for col in ws.columns:
+        letra = col[0].column_letter
+        if definicion['anchos']:
+            ws.column_dimensions[letra].width = definicion['anchos'][col[0].column - 1]
+        else:
+            ws.column_dimensions[letra].width = max(len(str(cell.value)) for cell in col if cell.value) + 2
+
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+_plantillas = {}
+_lock = threading.Lock()
+
+
+def obtener(nombre):
+    """Plantilla `nombre` (se genera la primera vez que se pide)"""
+    plantilla = _plantillas.get(nombre)
+    if plantilla is None:
+        with _lock:
+            plantilla = _plantillas.get(nombre)
+            if plantilla is None:
+                plantilla = Plantilla(nombre, DEFINICIONES[nombre])
+                _plantillas[nombre] = plantilla
+    return plantilla
+
+
+def precargar():
+    """Generar todas las variantes (al iniciar, para que la primera descarga tampoco cueste CPU)"""
+    for nombre in DEFINICIONES:
+        obtener(nombre)
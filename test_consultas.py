@@ -0,0 +1,53 @@
+"""Pruebas de consultas.py y escritura_diferida.py (BD falsa, ver conftest.py)"""
+
+import pytest
+from mysql.connector import Error
+
+import consultas
+from escritura_diferida import EscrituraDiferida
+
+
+def test_escritura_diferida_exige_flush(conexion_bd):
+    class SinFlush(EscrituraDiferida):
+        pass
+
+    with pytest.raises(TypeError):
+        SinFlush(conexion_bd, 1)
+
+
+def test_historial_por_lotes(conexion, conexion_bd):
+    historial = consultas.HistorialConsultas(conexion_bd, intervalo=60, tamano_lote=2)
+    for cedula in ('1001', '1002', '1003'):
+        assert historial.registrar(7, cedula, 1)
+
+    assert historial.flush() == 3
+    assert [len(lista) for _, lista in conexion.ejecutadas('INSERT INTO consultas_historial')] == [2, 1]
+    assert historial.metricas()['en_cola'] == 0
+
+
+def test_historial_reencola_si_falla_la_bd(conexion, conexion_bd):
+    conexion.responder_lote = lambda sentencia, lista: Error(msg='BD caída')
+    historial = consultas.HistorialConsultas(conexion_bd, intervalo=60, capacidad=3)
+    for cedula in ('1001', '1002', '1003'):
+        historial.registrar(7, cedula, 0)
+
+    assert historial.flush() == 0
+    assert historial.metricas()['en_cola'] == 3
+    # Cola llena: los eventos nuevos se descartan
+    assert not historial.registrar(7, '1004', 0)
+    assert historial.metricas()['descartados'] == 1
+    # La BD vuelve: el flush final (atexit) escribe la cola
+    conexion.responder_lote = lambda sentencia, lista: None
+
+
+def test_contador_acumula_en_memoria(conexion, conexion_bd):
+    conexion.responder = lambda sentencia, parametros: 2
+    contador = consultas.ContadorConsultas(conexion_bd, intervalo=60)
+    cursor = conexion.cursor()
+    cursor.lastrowid = 10
+
+    # La primera va a la BD; la segunda del mismo intervalo solo suma en memoria
+    primera = contador.registrar(cursor, 7)
+    segunda = contador.registrar(cursor, 7)
+    assert (primera, segunda) == (10, 11)
+    assert len(conexion.ejecutadas('INSERT INTO consultas')) == 1
@@ -0,0 +1,83 @@
+"""Pruebas de convertir_innodb.py (BD falsa, ver conftest.py)"""
+
+import pytest
+from mysql.connector import Error
+
+import convertir_innodb
+
+IDS = list(range(1, 13))
+
+
+def _responder(checksums=None, motor='MyISAM'):
+    """Tabla con ids 1..12; `checksums(tabla, parametros)` da el checksum de cada rango"""
+    def responder(sentencia, parametros):
+        if 'information_schema.KEY_COLUMN_USAGE' in sentencia:
+            return [('id',)]
+        if 'information_schema.COLUMNS' in sentencia:
+            return [('id',), ('Nombres',)]
+        if 'information_schema.TABLES' in sentencia:
+            return [(motor, 13)]
+        if 'information_schema.TRIGGERS' in sentencia:
+            return []
+        if 'LIMIT 1 OFFSET' in sentencia:
+            desde, offset = (None, parametros[0]) if len(parametros) == 1 else parametros
+            restantes = [i for i in IDS if desde is None or i > desde]
+            return [(restantes[offset],)] if offset < len(restantes) else []
+        if sentencia.startswith('SELECT COUNT(*), COALESCE'):
+            tabla = sentencia.split('FROM `')[1].split('`')[0]
+            return [checksums(tabla, parametros) if checksums else (len(IDS), 0)]
+        if sentencia.startswith('SELECT COUNT(*) FROM'):
+            return [(len(IDS),)]
+        return []
+    return responder
+
+
+def test_limites_por_llave_primaria(conexion):
+    conexion.responder = _responder()
+    conversor = convertir_innodb.ConversorInnoDB(conexion, 'personas', lote=5)
+    assert list(conversor._limites()) == [(None, 5), (5, 10), (10, None)]
+
+
+def test_resincroniza_solo_rangos_distintos(conexion):
+    # El rango (5, 10] cambió en la tabla original durante la copia
+    def checksums(tabla, parametros):
+        return (5, 1) if tabla == 'personas' and parametros == (5, 10) else (5, 0)
+    conexion.responder = _responder(checksums)
+    conversor = convertir_innodb.ConversorInnoDB(conexion, 'personas', lote=5)
+
+    assert conversor.resincronizar() == 1
+    assert conexion.ejecutadas('DELETE FROM `personas__innodb`') == [
+        ('DELETE FROM `personas__innodb` WHERE `id` > %s AND `id` <= %s', (5, 10))
+    ]
+
+
+def test_no_intercambia_si_el_checksum_no_coincide(conexion):
+    def checksums(tabla, parametros):
+        return (12, 1) if tabla == 'personas' else (11, 1)
+    conexion.responder = _responder(checksums)
+    conversor = convertir_innodb.ConversorInnoDB(conexion, 'personas', lote=5)
+
+    with pytest.raises(Error):
+        conversor.intercambiar()
+    assert not conexion.ejecutadas('RENAME TO')
+    assert conexion.ejecutadas('UNLOCK TABLES')
+
+
+def test_convierte_e_intercambia(conexion):
+    conexion.responder = _responder()
+    conversor = convertir_innodb.ConversorInnoDB(conexion, 'personas', lote=5)
+
+    assert conversor.convertir()
+    renombres = [sentencia for sentencia, _ in conexion.ejecutadas('RENAME TO')]
+    assert renombres == [
+        'ALTER TABLE `personas` RENAME TO `personas__myisam`',
+        'ALTER TABLE `personas__innodb` RENAME TO `personas`'
+    ]
+    assert conexion.ejecutadas('ALTER TABLE `personas__innodb` AUTO_INCREMENT = 13')
+
+
+def test_omite_tablas_innodb(conexion):
+    conexion.responder = _responder(motor='InnoDB')
+    conversor = convertir_innodb.ConversorInnoDB(conexion, 'personas')
+    assert not conversor.convertir()
+    assert not conexion.ejecutadas('CREATE TABLE')
@@ -0,0 +1,132 @@
+"""Pruebas de estados.py y de /api/contexto-usuario (BD falsa, ver conftest.py)"""
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import estados
+
+
+@pytest.fixture(params=['memoria', 'sqlite'])
+def almacen(request, tmp_path):
+    if request.param == 'memoria':
+        return estados.AlmacenMemoria()
+    return estados.AlmacenSqlite(str(tmp_path / 'estados.sqlite'))
+
+
+def _estados(conexion_bd, almacen, ttl=3600):
+    # Intervalo largo: el hilo de flush no corre durante la prueba, se llama flush() a mano
+    return estados.EstadosConversacion(conexion_bd, almacen, ttl=ttl, intervalo=3600)
+
+
+def _user_state(filas):
+    """Responder que simula user_state con {celular: (estado, opcion, updated_at)}"""
+    def responder(sentencia, parametros):
+        if 'FROM user_state' in sentencia and parametros[0] in filas:
+            estado, opcion, updated_at = filas[parametros[0]]
+            return [{'celular': parametros[0], 'estado': estado, 'opcion': opcion, 'updated_at': updated_at}]
+        return []
+    return responder
+
+
+def test_transicion_condicionada(conexion, conexion_bd, almacen):
+    gestor = _estados(conexion_bd, almacen)
+
+    aplicada, estado = gestor.transicion('300', 'menu_principal', esperado=None)
+    assert aplicada and estado['estado'] == 'menu_principal'
+
+    # Segundo mensaje con la misma condición: ya hay estado, no se aplica
+    aplicada, estado = gestor.transicion('300', 'menu_principal', esperado=None)
+    assert not aplicada and estado['estado'] == 'menu_principal'
+
+    aplicada, estado = gestor.transicion('300', 'esperando_cedula', 2, esperado='menu_principal')
+    assert aplicada and (estado['estado'], estado['opcion']) == ('esperando_cedula', 2)
+
+    aplicada, estado = gestor.transicion('300', None, esperado='esperando_cedula')
+    assert aplicada and estado is None
+
+    # user_state se leyó una sola vez; lo demás salió del almacén
+    assert len(conexion.ejecutadas('FROM user_state')) == 1
+
+
+def test_transicion_sin_condicion(conexion_bd, almacen):
+    gestor = _estados(conexion_bd, almacen)
+    gestor.guardar('300', 'menu_principal')
+
+    aplicada, estado = gestor.transicion('300', 'esperando_placa', esperado=estados.CUALQUIERA)
+    assert aplicada and estado['estado'] == 'esperando_placa'
+
+
+def test_estado_vencido_cuenta_como_sin_estado(conexion, conexion_bd, almacen):
+    conexion.responder = _user_state({'300': ('esperando_cedula', 1, datetime.now() - timedelta(hours=2))})
+    gestor = _estados(conexion_bd, almacen, ttl=3600)
+
+    assert gestor.obtener('300') is None
+    aplicada, estado = gestor.transicion('300', 'menu_principal', esperado=None)
+    assert aplicada and estado['estado'] == 'menu_principal'
+
+
+def test_flush_escribe_y_borra_en_user_state(conexion, conexion_bd, almacen):
+    gestor = _estados(conexion_bd, almacen)
+    gestor.guardar('300', 'menu_principal', 1)
+    gestor.guardar('301', 'menu_principal')
+    gestor.eliminar('301')
+
+    assert gestor.flush() == 2
+    (_, guardados), = conexion.ejecutadas('INSERT INTO user_state')
+    assert [fila[:3] for fila in guardados] == [('300', 'menu_principal', 1)]
+    (_, eliminados), = conexion.ejecutadas('DELETE FROM user_state')
+    assert list(eliminados) == ['301']
+
+    # Confirmados: la siguiente ronda no tiene nada que escribir
+    assert almacen.pendientes(10) == []
+    assert gestor.flush() == 0
+
+
+def test_cambio_durante_el_flush_queda_pendiente(almacen):
+    almacen.escribir('300', 'menu_principal', None, time.time())
+    (celular, _, _, _, version), = almacen.pendientes(10)
+    almacen.escribir('300', 'esperando_cedula', None, time.time())
+
+    almacen.confirmar([(celular, version)])
+    assert [fila[1] for fila in almacen.pendientes(10)] == ['esperando_cedula']
+
+
+def test_transicion_directa_en_bd_respeta_condicion(conexion, conexion_bd):
+    conexion.responder = _user_state({'300': ('menu_principal', None, datetime.now())})
+    gestor = _estados(conexion_bd, None)
+
+    aplicada, estado = gestor.transicion('300', 'esperando_cedula', esperado=None)
+    assert not aplicada and estado['estado'] == 'menu_principal'
+    assert not conexion.ejecutadas('INSERT INTO user_state')
+    assert conexion.rollbacks == 1
+
+
+# ==================== /api/contexto-usuario ====================
+def test_contexto_usuario_con_transicion(api, conexion_bd, monkeypatch):
+    monkeypatch.setattr(api, 'estados_conversacion', _estados(conexion_bd, estados.AlmacenMemoria()))
+    cliente = api.app.test_client()
+    cuerpo = {'celular': '300', 'transicion': {'estado': 'menu_principal', 'si_estado': None}}
+
+    primera = cliente.post('/api/contexto-usuario', json=cuerpo).get_json()
+    assert primera['transicion'] == {'aplicada': True}
+    assert primera['estado']['estado'] == 'menu_principal'
+    assert primera['exists'] is False
+
+    repetida = cliente.post('/api/contexto-usuario', json=cuerpo).get_json()
+    assert repetida['transicion'] == {'aplicada': False}
+
+    invalida = cliente.post('/api/contexto-usuario', json={'celular': '300', 'transicion': {'opcion': 1}})
+    assert invalida.status_code == 400
+
+
+def test_estado_vencido_no_coincide_con_si_estado(conexion, conexion_bd, almacen):
+    conexion.responder = _user_state({'300': ('menu_principal', 1, datetime.now() - timedelta(hours=2))})
+    gestor = _estados(conexion_bd, almacen, ttl=3600)
+
+    aplicada, estado = gestor.transicion('300', 'esperando_cedula', esperado='menu_principal')
+    assert not aplicada and estado is None
+    # El estado vencido sigue ahí sin cambios (solo lo reemplaza una transición desde "sin estado")
+    assert almacen.obtener('300')['estado'] == 'menu_principal'
+    assert almacen.pendientes(10) == []
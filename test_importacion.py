@@ -0,0 +1,266 @@
+"""Pruebas de importacion.py (BD falsa, ver conftest.py)"""
+
+from datetime import date
+
+import pandas as pd
+import pytest
+from mysql.connector import Error
+from openpyxl import Workbook
+from openpyxl.styles import Font
+
+import importacion
+import trabajos
+
+SQL = 'INSERT INTO personas (Numero_Documento) VALUES (%s)'
+
+
+def _filas(cantidad):
+    return [(numero + 2, (str(1000 + numero),)) for numero in range(cantidad)]
+
+
+# ==================== INSERCIÓN POR LOTES ====================
+def test_lotes_multi_fila(conexion):
+    insertados, errores, lotes = importacion.insertar_por_lotes(conexion, _filas(5), 2, SQL)
+
+    assert (insertados, errores) == (5, [])
+    assert [lote['modo'] for lote in lotes] == ['multi_fila'] * 3
+    assert [len(lista) for _, lista in conexion.ejecutadas('INSERT')] == [2, 2, 1]
+
+
+def test_lote_fallido_se_reintenta_fila_por_fila(conexion):
+    conexion.responder_lote = lambda sentencia, lista: Error(msg='Data too long')
+    conexion.responder = lambda sentencia, parametros: Error(msg='Data too long') if parametros == ('1001',) else []
+
+    insertados, errores, lotes = importacion.insertar_por_lotes(conexion, _filas(3), 10, SQL)
+
+    assert insertados == 2
+    assert errores == [(3, 'Data too long')]
+    assert lotes[0]['modo'] == 'fila_a_fila' and lotes[0]['errores'] == 1
+
+
+def test_tabla_no_transaccional_no_usa_multi_fila(conexion):
+    # En MyISAM el reintento de un lote fallido duplicaría las filas ya escritas
+    conexion.responder_lote = lambda sentencia, lista: AssertionError('no debe usar executemany')
+
+    insertados, errores, lotes = importacion.insertar_por_lotes(conexion, _filas(3), 2, SQL, transaccional=False)
+
+    assert (insertados, errores) == (3, [])
+    assert [lote['modo'] for lote in lotes] == ['fila_a_fila'] * 2
+    assert len(conexion.ejecutadas('INSERT')) == 3
+
+
+def test_tabla_transaccional_segun_motor(conexion):
+    conexion.responder = lambda sentencia, parametros: [('InnoDB',)]
+    assert importacion.tabla_transaccional(conexion)
+    conexion.responder = lambda sentencia, parametros: [('MyISAM',)]
+    assert not importacion.tabla_transaccional(conexion)
+    conexion.responder = lambda sentencia, parametros: []
+    assert not importacion.tabla_transaccional(conexion)
+
+
+# ==================== VALIDACIÓN POR ESQUEMA ====================
+def _bloque(**columnas):
+    base = {
+        'Numero_Documento': ['1001', '1002'],
+        'Nombres': ['JUAN', 'ANA'],
+        'Apellidos': ['PEREZ', 'GOMEZ'],
+        'Placa': ['ABC123', 'XYZ789'],
+        'Valor_Reporte': [50000, 20000],
+    }
+    base.update(columnas)
+    return pd.DataFrame(base)
+
+
+def _preparar(df, tipo='excel'):
+    esquema = importacion.ESQUEMAS[tipo]
+    return esquema.preparar(df, esquema.resolver_columnas(list(df.columns)), 7)
+
+
+def test_valor_fuera_de_rango_es_error_de_fila():
+    filas, errores = _preparar(_bloque(Valor_Reporte=[1e30, 20000.0]))
+
+    assert [numero for numero, _ in filas] == [3]
+    assert errores == [(2, 'Valor_Reporte está fuera de rango')]
+
+
+def test_documento_fuera_de_rango_es_error_de_fila():
+    filas, errores = _preparar(_bloque(Numero_Documento=[1e20, 1002.0]))
+
+    assert [numero for numero, _ in filas] == [3]
+    assert errores == [(2, 'Numero_Documento es un número fuera de rango')]
+    # El documento válido leído como float vuelve a texto sin '.0'
+    assert filas[0][1][1] == '1002'
+
+
+def test_valor_no_numerico_y_obligatorio_vacio():
+    filas, errores = _preparar(_bloque(Valor_Reporte=['mucho', 1], Nombres=['JUAN', None]))
+
+    assert filas == []
+    assert errores == [
+        (2, 'Valor_Reporte no es numérico'),
+        (3, 'Campos obligatorios vacíos (Numero_Documento, Nombres, Apellidos, Placa)')
+    ]
+
+
+# ==================== DUPLICADOS ====================
+def _bloque_token():
+    return pd.DataFrame({
+        'Documento Conductor': ['1001'],
+        'Nombre Conductor': ['JUAN'],
+        'Apellidos Conductor': ['PEREZ'],
+        'Placa Vehiculo': ['abc123 '],
+        'Valor del Reporte': [50000],
+        'Descripcion del Reporte': ['Tarifa'],
+    })
+
+
+def test_carga_repetida_otro_dia_es_duplicado(conexion):
+    # El mismo archivo ya se cargó ayer: en la BD quedó con la fecha de ese día
+    conexion.responder = lambda sentencia, parametros: [(40, '1001', 'ABC123', 7)]
+    filas, errores = _preparar(_bloque_token(), 'token')
+    detector = importacion.DetectorDuplicados(importacion.ESQUEMAS['token'], 'fallar')
+
+    nuevas, actualizaciones, rechazadas = detector.filtrar(conexion, filas)
+
+    assert (errores, nuevas, actualizaciones) == ([], [], [])
+    assert rechazadas == [(2, 'Reporte duplicado (ya existe en la base de datos)')]
+    assert conexion.sentencias[0][0].startswith('SELECT id, Numero_Documento, Placa, id_reportante FROM personas')
+
+
+def test_excel_distingue_reportes_por_fecha(conexion):
+    conexion.responder = lambda sentencia, parametros: [(40, '1001', 'ABC123', date(2024, 1, 1), 7)]
+    filas, _ = _preparar(_bloque(Fecha_Reporte=['2024-02-01', '2024-02-01']))
+    detector = importacion.DetectorDuplicados(importacion.ESQUEMAS['excel'], 'fallar')
+
+    nuevas, _, rechazadas = detector.filtrar(conexion, filas)
+
+    assert len(nuevas) == 2 and rechazadas == []
+
+
+def test_repetido_dentro_del_archivo_se_omite(conexion):
+    filas, _ = _preparar(_bloque(Numero_Documento=['1001', '1001'], Placa=['ABC123', 'abc123']))
+    detector = importacion.DetectorDuplicados(importacion.ESQUEMAS['excel'], 'omitir')
+
+    nuevas, _, _ = detector.filtrar(conexion, filas)
+
+    assert [numero for numero, _ in nuevas] == [2]
+    assert detector.resumen()['omitidos'] == 1
+
+
+# ==================== LECTURA DE ARCHIVOS ====================
+ENCABEZADO = ['Numero_Documento', 'Nombres', 'Apellidos', 'Placa', 'Valor_Reporte']
+
+
+def _importar(conexion, ruta, tamano_lote=100):
+    conexion.responder = lambda sentencia, parametros: [('InnoDB',)] if 'information_schema' in sentencia else []
+    trabajo = trabajos.Trabajo('excel', 7)
+    importacion.importar_archivo(conexion, trabajo, str(ruta), 'excel', 7, tamano_lote)
+    return trabajo
+
+
+def test_xlsx_con_filas_vacias_con_formato_no_supera_el_maximo(conexion, tmp_path, monkeypatch):
+    monkeypatch.setattr(importacion, 'MAX_FILAS', 100)
+    libro = Workbook()
+    hoja = libro.active
+    hoja.append(ENCABEZADO)
+    hoja.append(['1001', 'JUAN', 'PEREZ', 'ABC123', 50000])
+    # Una celda vacía con formato lejos de los datos: la dimensión de la hoja dice 200000 filas
+    hoja.cell(row=200000, column=1).font = Font(bold=True)
+    libro.save(tmp_path / 'reportes.xlsx')
+
+    trabajo = _importar(conexion, tmp_path / 'reportes.xlsx')
+
+    assert (trabajo.procesadas, trabajo.insertados, trabajo.total_filas) == (1, 1, 1)
+
+
+def test_xlsx_con_mas_filas_que_el_maximo_se_corta(conexion, tmp_path, monkeypatch):
+    monkeypatch.setattr(importacion, 'MAX_FILAS', 2)
+    libro = Workbook()
+    libro.active.append(ENCABEZADO)
+    for numero in range(3):
+        libro.active.append([str(1001 + numero), 'JUAN', 'PEREZ', 'ABC123', 50000])
+    libro.save(tmp_path / 'reportes.xlsx')
+
+    with pytest.raises(importacion.ErrorImportacion, match='se importaron las primeras 2'):
+        _importar(conexion, tmp_path / 'reportes.xlsx', tamano_lote=1)
+
+
+def _csv(ruta, filas, separador=',', encoding='utf-8'):
+    lineas = [separador.join(ENCABEZADO)] + [separador.join(fila) for fila in filas]
+    ruta.write_bytes(('\n'.join(lineas) + '\n').encode(encoding))
+    return str(ruta)
+
+
+def test_detectar_formato_por_contenido(tmp_path):
+    libro = Workbook()
+    libro.save(tmp_path / 'datos.csv')  # la extensión no cuenta
+    pd.DataFrame({'a': [1]}).to_parquet(tmp_path / 'datos.xlsx')
+    (tmp_path / 'vieja.bin').write_bytes(b'\xd0\xcf\x11\xe0' + b'\x00' * 60)
+    (tmp_path / 'binario.bin').write_bytes(b'\x89PNG\r\n\x1a\n\x00\x00')
+    (tmp_path / 'vacio.bin').write_bytes(b'')
+
+    assert importacion.detectar_formato(str(tmp_path / 'datos.csv')) == 'xlsx'
+    assert importacion.detectar_formato(str(tmp_path / 'datos.xlsx')) == 'parquet'
+    assert importacion.detectar_formato(str(tmp_path / 'vieja.bin')) == 'xls'
+    assert importacion.detectar_formato(_csv(tmp_path / 'datos.txt', [])) == 'csv'
+    for nombre in ('binario.bin', 'vacio.bin'):
+        with pytest.raises(importacion.ErrorImportacion, match='Formato no reconocido'):
+            importacion.detectar_formato(str(tmp_path / nombre))
+
+
+def test_csv_punto_y_coma_latin1_por_bloques(tmp_path):
+    filas = [[f'{numero:05d}', 'JOSÉ', 'MUÑOZ', 'ABC123', '50000'] for numero in range(5)]
+    ruta = _csv(tmp_path / 'reportes.csv', filas, separador=';', encoding='latin-1')
+
+    lector = importacion.abrir_lector(ruta, 2)
+    try:
+        assert (lector.separador, lector.encoding) == (';', 'latin-1')
+        assert lector.columnas == ENCABEZADO
+        assert not lector.filas_conocidas and lector.filas_estimadas == 5
+        bloques = list(lector)
+    finally:
+        lector.cerrar()
+
+    assert [len(df) for df in bloques] == [2, 2, 1]
+    # Índices continuos entre bloques (número de fila de los errores) y todo como texto
+    assert list(bloques[2].index) == [4]
+    assert bloques[0].iloc[0].tolist() == ['00000', 'JOSÉ', 'MUÑOZ', 'ABC123', '50000']
+
+
+def test_csv_coma_utf8(tmp_path):
+    ruta = _csv(tmp_path / 'reportes.csv', [['1001', 'JOSÉ', 'PEREZ', 'ABC123', '50000']])
+
+    lector = importacion.abrir_lector(ruta, 10)
+    try:
+        assert (lector.separador, lector.encoding) == (',', 'utf-8-sig')
+        assert next(iter(lector)).iloc[0]['Nombres'] == 'JOSÉ'
+    finally:
+        lector.cerrar()
+
+
+def test_csv_importado_como_el_excel(conexion, tmp_path):
+    ruta = _csv(tmp_path / 'reportes.csv', [['1001', 'JUAN', 'PEREZ', 'ABC123', '50000'], ['', 'ANA', 'GOMEZ', 'X', '1']])
+
+    trabajo = _importar(conexion, ruta)
+
+    assert trabajo.insertados == 1
+    assert trabajo.errores == [(3, 'Campos obligatorios vacíos (Numero_Documento, Nombres, Apellidos, Placa)')]
+    assert trabajo.resultado['formato'] == 'csv'
+
+
+def test_parquet_por_grupos_con_filas_de_los_metadatos(tmp_path):
+    ruta = tmp_path / 'reportes.parquet'
+    pd.DataFrame({
+        'Numero_Documento': [str(1001 + numero) for numero in range(5)],
+        'Nombres': ['JUAN'] * 5, 'Apellidos': ['PEREZ'] * 5, 'Placa': ['ABC123'] * 5, 'Valor_Reporte': [50000] * 5
+    }).to_parquet(ruta)
+
+    lector = importacion.abrir_lector(str(ruta), 2)
+    try:
+        assert lector.filas_conocidas and lector.filas_estimadas == 5
+        bloques = list(lector)
+    finally:
+        lector.cerrar()
+
+    assert [len(df) for df in bloques] == [2, 2, 1]
+    assert [list(df.index) for df in bloques] == [[0, 1], [2, 3], [4]]
@@ -0,0 +1,517 @@
+"""Pruebas de los endpoints y utilidades de infotaxi_api (BD falsa, ver conftest.py)"""
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import consultas
+from conftest import ConexionFalsa, usuario_bd
+
+
+def _responder_usuario(rol):
+    def responder(sentencia, parametros):
+        if sentencia.startswith('SELECT id_user, username, nombres, rol FROM users'):
+            return [usuario_bd(rol)]
+        return []
+    return responder
+
+
+# ==================== POOL DE CONEXIONES ====================
+def test_pool_cuenta_hilos_de_segundo_plano(api, monkeypatch):
+    monkeypatch.setattr(api, '_pool', None)
+    monkeypatch.setattr(api, 'DB_MAX_CONEXIONES', 1000)
+    monkeypatch.setitem(api.DB_POOL_CONFIG, 'tamano', 0)
+
+    esperado = api.WEB_THREADS + api.trabajos.HILOS_IMPORTACION + api.HILOS_SEGUNDO_PLANO
+    assert api.get_pool().tamano == esperado
+
+
+def test_pool_respeta_presupuesto_de_conexiones(api, monkeypatch):
+    monkeypatch.setattr(api, '_pool', None)
+    monkeypatch.setattr(api, 'DB_MAX_CONEXIONES', 8)
+    monkeypatch.setattr(api, 'WEB_WORKERS', 4)
+    monkeypatch.setitem(api.DB_POOL_CONFIG, 'tamano', 0)
+
+    assert api.get_pool().tamano == 2
+
+
+@pytest.fixture
+def pool_de_una_conexion(monkeypatch):
+    """infotaxi_api con un pool real de tamaño 1 sobre conexiones falsas: un segundo préstamo
+    en la misma petición agotaría el pool"""
+    import infotaxi_api
+    conexiones = []
+
+    def conectar(**config):
+        conexiones.append(ConexionFalsa(_responder_reportes(1)))
+        return conexiones[-1]
+    monkeypatch.setattr(infotaxi_api.mysql.connector, 'connect', conectar)
+    pool = infotaxi_api.PoolConexiones({}, 1, 0.1, 60, 600, 3600)
+    monkeypatch.setattr(infotaxi_api, '_pool', pool)
+    monkeypatch.setattr(infotaxi_api, '_pool_pid', os.getpid())
+    monkeypatch.setitem(infotaxi_api.app.config, 'TESTING', True)
+    infotaxi_api.usuarios_cache._datos.clear()
+    return infotaxi_api, pool, conexiones
+
+
+def test_peticion_usa_una_conexion_y_la_devuelve(pool_de_una_conexion):
+    api, pool, conexiones = pool_de_una_conexion
+
+    respuesta = api.app.test_client().get('/api/mis-reportes/123', headers={'X-User-Celular': '3001112233'})
+
+    # verificar_usuario y el endpoint compartieron la conexión de la petición
+    assert respuesta.status_code == 200 and respuesta.get_json()['total_reportes'] == 1
+    metricas = pool.metricas()
+    assert (metricas['checkouts'], metricas['en_uso'], metricas['libres']) == (1, 0, 1)
+    assert len(conexiones) == 1
+
+
+def test_teardown_devuelve_la_conexion_tras_una_excepcion(pool_de_una_conexion):
+    api, pool, conexiones = pool_de_una_conexion
+
+    with pytest.raises(RuntimeError):
+        with api.app.test_request_context('/api/prueba'):
+            conn = api.sesion_bd()
+            with api.conexion_bd() as prestada:
+                assert prestada is conn
+            conn.cursor().execute('UPDATE personas SET Placa = %s WHERE id = %s', ('ABC123', 1))
+            raise RuntimeError('fallo en el endpoint')
+
+    # La transacción abierta se deshizo y la conexión quedó libre para la siguiente petición
+    assert conexiones[0].rollbacks == 1 and conexiones[0].commits == 0
+    assert (pool.metricas()['en_uso'], pool.metricas()['libres']) == (0, 1)
+    assert api.app.test_client().get(
+        '/api/mis-reportes/123', headers={'X-User-Celular': '3001112233'}
+    ).status_code == 200
+    assert len(conexiones) == 1
+
+
+# ==================== CACHÉ EN MEMORIA ====================
+def _dos_workers(api, monkeypatch, tmp_path):
+    """Dos copias de la misma caché, como las de dos workers de gunicorn"""
+    monkeypatch.setattr(api, 'CACHE_DIR', str(tmp_path))
+    return api.CacheTTL('prueba', 10, 60), api.CacheTTL('prueba', 10, 60)
+
+
+def test_cache_invalidaciones_seguidas_llegan_a_otro_worker(api, monkeypatch, tmp_path):
+    uno, otro = _dos_workers(api, monkeypatch, tmp_path)
+    for valor in range(3):
+        assert uno.obtener('300') is None
+        uno.guardar('300', valor)
+        assert uno.obtener('300') == valor
+        # Varias invalidaciones en el mismo instante: el contador cambia aunque el mtime no
+        otro.invalidar('300')
+        assert uno.obtener('300') is None
+
+
+def test_cache_descarta_valor_leido_antes_de_invalidar(api, monkeypatch, tmp_path):
+    uno, otro = _dos_workers(api, monkeypatch, tmp_path)
+    assert uno.obtener('300') is None
+    # Mientras `uno` consulta la BD, otro worker bloquea al usuario
+    otro.invalidar('300')
+    uno.guardar('300', {'rol': 'usuario'})
+
+    assert uno.obtener('300') is None
+    assert uno.metricas()['descartados'] == 1
+
+
+def test_cache_invalidacion_concurrente_vacia_copia_local(api, monkeypatch, tmp_path):
+    uno, otro = _dos_workers(api, monkeypatch, tmp_path)
+    uno.obtener('a')
+    uno.guardar('a', 1)
+    otro.invalidar('a')
+    # `uno` invalida otra clave sin haber leído la invalidación de `a`
+    uno.invalidar('b')
+    assert uno.obtener('a') is None
+
+
+# ==================== MÉTRICAS ====================
+def test_metricas_sin_credenciales(api):
+    respuesta = api.app.test_client().get('/api/metricas')
+    assert respuesta.status_code == 401
+
+
+def test_metricas_usuario_no_admin(api, conexion):
+    conexion.responder = _responder_usuario('usuario')
+    respuesta = api.app.test_client().get('/api/metricas', headers={'X-User-Celular': '3001112233'})
+    assert respuesta.status_code == 403
+
+
+def test_metricas_admin(api, conexion):
+    conexion.responder = _responder_usuario('admin')
+    respuesta = api.app.test_client().get('/api/metricas', headers={'X-User-Celular': '3001112233'})
+    assert respuesta.status_code == 200
+    assert 'pool' in respuesta.get_json()
+
+
+def test_metricas_con_token(api, monkeypatch):
+    monkeypatch.setattr(api, 'METRICAS_TOKEN', 'monitoreo')
+    cliente = api.app.test_client()
+    assert cliente.get('/api/metricas', headers={'X-Metricas-Token': 'monitoreo'}).status_code == 200
+    assert cliente.get('/api/metricas', headers={'X-Metricas-Token': 'otro'}).status_code == 401
+
+
+# ==================== PLANTILLAS EXCEL ====================
+def test_plantilla_etag_debil_y_sin_rangos(api, conexion):
+    conexion.responder = _responder_usuario('usuario')
+    cliente = api.app.test_client()
+    encabezados = {'X-User-Celular': '3001112233'}
+
+    respuesta = cliente.get('/api/plantilla-excel', headers=encabezados)
+    assert respuesta.status_code == 200
+    etag = respuesta.headers['ETag']
+    assert etag.startswith('W/')
+    assert 'Accept-Ranges' not in respuesta.headers
+
+    assert cliente.get('/api/plantilla-excel', headers={**encabezados, 'If-None-Match': etag}).status_code == 304
+    parcial = cliente.get('/api/plantilla-excel', headers={**encabezados, 'Range': 'bytes=0-9', 'If-Range': etag})
+    assert parcial.status_code == 200
+    assert len(parcial.data) > 10
+
+
+# ==================== IDEMPOTENCIA ====================
+class TablaIdempotencia:
+    """Responde como la tabla idempotencia y los SELECT de usuario de generar_token_carga"""
+
+    def __init__(self):
+        self.filas = {}
+
+    def __call__(self, sentencia, parametros):
+        if sentencia.startswith('INSERT IGNORE INTO idempotencia'):
+            ambito, clave, huella, creado_en = parametros
+            if (ambito, clave) in self.filas:
+                return 0
+            self.filas[(ambito, clave)] = {'huella': huella, 'codigo': None, 'cuerpo': None, 'creado_en': creado_en}
+            return 1
+        if sentencia.startswith('SELECT huella, codigo, cuerpo, creado_en FROM idempotencia'):
+            return [dict(self.filas[parametros])]
+        if sentencia.startswith('UPDATE idempotencia SET creado_en'):
+            creado_en, ambito, clave, anterior = parametros
+            fila = self.filas[(ambito, clave)]
+            if fila['codigo'] is not None or fila['creado_en'] != anterior:
+                return 0
+            fila['creado_en'] = creado_en
+            return 1
+        if sentencia.startswith('UPDATE idempotencia'):
+            codigo, cuerpo, ambito, clave = parametros
+            self.filas[(ambito, clave)].update(codigo=codigo, cuerpo=cuerpo)
+            return 1
+        if sentencia.startswith('SELECT id_user, nombres FROM users'):
+            return [{'id_user': 7, 'nombres': 'Juan'}]
+        return []
+
+
+def _contar_conexiones(api, monkeypatch, conexion):
+    prestadas = []
+
+    def prestar():
+        prestadas.append(conexion)
+        return conexion
+    monkeypatch.setattr(api, 'get_db_connection', prestar)
+    return prestadas
+
+
+def test_idempotencia_repite_respuesta_con_una_conexion(api, conexion, monkeypatch):
+    conexion.responder = TablaIdempotencia()
+    prestadas = _contar_conexiones(api, monkeypatch, conexion)
+    cliente = api.app.test_client()
+    encabezados = {'X-User-Celular': '3001112233', 'Idempotency-Key': 'clave-1'}
+
+    primera = cliente.post('/api/generar-token-carga', headers=encabezados)
+    # Decorador y endpoint comparten la conexión de la petición
+    assert len(prestadas) == 1
+    segunda = cliente.post('/api/generar-token-carga', headers=encabezados)
+
+    assert primera.status_code == segunda.status_code == 200
+    assert segunda.headers['Idempotent-Replayed'] == 'true'
+    assert segunda.get_json()['token'] == primera.get_json()['token']
+    assert len(conexion.ejecutadas('INSERT INTO token_carga')) <= 1
+
+
+def test_idempotencia_otro_cuerpo_y_en_curso(api, conexion):
+    tabla = TablaIdempotencia()
+    conexion.responder = tabla
+    cliente = api.app.test_client()
+    encabezados = {'X-User-Celular': '3001112233', 'Idempotency-Key': 'clave-2'}
+
+    assert cliente.post('/api/generar-token-carga', headers=encabezados).status_code == 200
+    assert cliente.post('/api/generar-token-carga', headers=encabezados, data='{}').status_code == 422
+
+    # Primera petición todavía sin respuesta guardada
+    ambito, _ = next(iter(tabla.filas))
+    tabla.filas[(ambito, 'clave-3')] = dict(tabla.filas[(ambito, 'clave-2')], codigo=None, cuerpo=None)
+    repetida = cliente.post('/api/generar-token-carga', headers={**encabezados, 'Idempotency-Key': 'clave-3'})
+    assert repetida.status_code == 409
+
+
+def test_idempotencia_reserva_abandonada_la_toma_el_reintento(api, conexion):
+    tabla = TablaIdempotencia()
+    conexion.responder = tabla
+    cliente = api.app.test_client()
+    encabezados = {'X-User-Celular': '3001112233', 'Idempotency-Key': 'clave-5'}
+    assert cliente.post('/api/generar-token-carga', headers=encabezados).status_code == 200
+
+    # El worker que reservó la clave murió antes de guardar la respuesta
+    fila, = tabla.filas.values()
+    vencida = datetime.now() - timedelta(seconds=api.IDEMPOTENCIA_RESERVA_SEGUNDOS + 1)
+    fila.update(codigo=None, cuerpo=None, creado_en=vencida)
+
+    reintento = cliente.post('/api/generar-token-carga', headers=encabezados)
+    assert reintento.status_code == 200
+    assert 'Idempotent-Replayed' not in reintento.headers
+    assert fila['codigo'] == 200 and fila['creado_en'] > vencida
+
+
+def test_cors_permite_idempotency_key(api):
+    respuesta = api.app.test_client().options('/api/personas', headers={
+        'Origin': 'https://ejemplo.co',
+        'Access-Control-Request-Method': 'POST',
+        'Access-Control-Request-Headers': 'Idempotency-Key'
+    })
+    assert 'idempotency-key' in respuesta.headers['Access-Control-Allow-Headers'].lower()
+
+
+def test_idempotencia_no_confirma_lo_pendiente_del_endpoint(api, conexion):
+    conexion.responder = TablaIdempotencia()
+
+    @api.idempotente
+    def endpoint():
+        # El endpoint escribe y responde 4xx sin commit: no debe quedar confirmado
+        conexion.cursor().execute('INSERT INTO personas (id) VALUES (%s)', (1,))
+        return api.jsonify({'success': False}), 400
+
+    with api.app.test_request_context('/api/prueba', method='POST', headers={'Idempotency-Key': 'clave-4'}):
+        respuesta = endpoint()
+
+    assert respuesta.status_code == 400
+    sentencias = [sentencia.split(' ')[0] for sentencia, _ in conexion.sentencias]
+    insercion = sentencias.index('INSERT', sentencias.index('<commit>'))
+    assert sentencias[insercion + 1:insercion + 3] == ['<rollback>', 'UPDATE']
+
+
+# ==================== PAGINACIÓN DE REPORTES ====================
+def _reportes(n):
+    return [{'id': 100 - i, 'fecha_reporte': f'2024-01-{20 - i:02d}'} for i in range(n)]
+
+
+def test_paginar_en_memoria_sin_limite_devuelve_todo(api):
+    assert api.paginar_en_memoria(_reportes(60), None, None) == (_reportes(60), None)
+
+
+def test_paginar_en_memoria_recorre_con_cursor(api):
+    reportes = _reportes(5)
+    pagina, siguiente = api.paginar_en_memoria(reportes, 2, None)
+    assert [r['id'] for r in pagina] == [100, 99]
+
+    pagina, siguiente = api.paginar_en_memoria(reportes, 2, api.decodificar_cursor(siguiente))
+    assert [r['id'] for r in pagina] == [98, 97]
+
+    pagina, siguiente = api.paginar_en_memoria(reportes, 2, api.decodificar_cursor(siguiente))
+    assert [r['id'] for r in pagina] == [96] and siguiente is None
+
+
+def test_cursor_invalido(api):
+    assert api.decodificar_cursor(api.codificar_cursor(None, 5)) == (None, 5)
+    for valor in ('xyz', api.codificar_cursor('2024-01-01', '5')):
+        try:
+            api.decodificar_cursor(valor)
+        except ValueError:
+            continue
+        raise AssertionError(valor)
+
+
+def _responder_reportes(n):
+    usuario = _responder_usuario('usuario')
+
+    def responder(sentencia, parametros):
+        if 'FROM personas p' in sentencia and 'COUNT(*)' in sentencia:
+            return [{'total': n}]
+        if 'FROM personas p' in sentencia:
+            filas = [{
+                'id': 100 - i, 'Fecha_Reporte': None, 'Numero_Documento': '123', 'Nombres': 'A',
+                'Apellidos': 'B', 'Placa': 'ABC123', 'Valor_Reporte': 1000, 'Descripcion_Reporte': '',
+                'Estado': 'abierto', 'Reportante_Nombres': 'Juan'
+            } for i in range(n)]
+            if 'LIMIT' in sentencia:
+                filas = filas[:parametros[-1]]
+            return filas
+        return usuario(sentencia, parametros)
+    return responder
+
+
+def test_listado_sin_limite_trae_todos_los_reportes(api, conexion):
+    conexion.responder = _responder_reportes(60)
+    respuesta = api.app.test_client().get('/api/reportes-por-cedula/123', headers={'X-User-Celular': '3001112233'})
+
+    datos = respuesta.get_json()
+    assert len(datos['reportes']) == 60 and datos['siguiente_cursor'] is None
+    assert not conexion.ejecutadas('LIMIT')
+
+
+def test_listado_pagina_con_limite(api, conexion):
+    conexion.responder = _responder_reportes(5)
+    respuesta = api.app.test_client().get('/api/reportes-por-cedula/123?limite=2', headers={'X-User-Celular': '3001112233'})
+
+    datos = respuesta.get_json()
+    assert [r['id'] for r in datos['reportes']] == [100, 99]
+    assert datos['total_reportes'] == 5
+    assert api.decodificar_cursor(datos['siguiente_cursor']) == (None, 99)
+    (_, parametros), = conexion.ejecutadas('LIMIT')
+    assert parametros[-1] == 3
+
+
+# ==================== CONSULTA DE VARIAS CÉDULAS ====================
+def _fila_persona(cedula, id_reporte):
+    return {
+        'id': id_reporte, 'Fecha_Reporte': datetime(2024, 1, 10), 'Numero_Documento': cedula,
+        'Nombres': 'JUAN', 'Apellidos': 'PEREZ', 'Fecha_cierre': '', 'Placa': 'ABC123',
+        'Valor_Reporte': 50000, 'Descripcion_Reporte': '', 'Vehiculo_afiliado': 'ADMICARS',
+        'Estado': 'ACTIVA', 'Reportante_Nombres': 'Juan'
+    }
+
+
+@pytest.fixture
+def consultas_locales(api, conexion_bd, monkeypatch):
+    """Contador e historial propios de la prueba: sus hilos no escriben con la BD real al terminar"""
+    monkeypatch.setattr(api, 'contador_consultas', consultas.ContadorConsultas(conexion_bd, intervalo=3600))
+    monkeypatch.setattr(api, 'historial_consultas', consultas.HistorialConsultas(conexion_bd, intervalo=3600))
+
+
+def _responder_lote(reportes):
+    """reportes: {cédula: [ids]} para el SELECT ... IN de buscar_reportes_personas"""
+    usuario = _responder_usuario('usuario')
+
+    def responder(sentencia, parametros):
+        if 'FROM personas p' in sentencia:
+            return [_fila_persona(cedula, id_reporte)
+                    for cedula in parametros for id_reporte in reportes.get(cedula, [])]
+        if sentencia.startswith('INSERT INTO consultas'):
+            return 1
+        return usuario(sentencia, parametros)
+    return responder
+
+
+def _consultar_lote(api, cedulas, consulta=''):
+    return api.app.test_client().post(
+        f'/api/personas/lote{consulta}', json={'cedulas': cedulas}, headers={'X-User-Celular': '3001112233'}
+    )
+
+
+def test_lote_resultado_por_cedula(api, conexion, consultas_locales):
+    conexion.responder = _responder_lote({'1001': [11, 10]})
+
+    datos = _consultar_lote(api, ['1001', ' 1002 ', '1001', ''], '?fields=id,placa').get_json()
+
+    assert (datos['total_cedulas'], datos['encontradas'], datos['total_consultas']) == (2, 1, 1)
+    assert datos['resultados'] == {
+        '1001': {'found': True, 'total_reportes': 2, 'reportes': [{'id': 11, 'placa': 'ABC123'}, {'id': 10, 'placa': 'ABC123'}]},
+        '1002': {'found': False, 'total_reportes': 0, 'reportes': []}
+    }
+    # Un solo IN para todas las cédulas
+    (_, parametros), = conexion.ejecutadas('FROM personas p')
+    assert parametros == ['1001', '1002']
+
+
+def test_lote_usa_la_cache(api, conexion, consultas_locales):
+    conexion.responder = _responder_lote({'1001': [11]})
+    _consultar_lote(api, ['1001'])
+
+    datos = _consultar_lote(api, ['1001', '1002']).get_json()
+
+    assert datos['resultados']['1001']['total_reportes'] == 1
+    assert [p for _, p in conexion.ejecutadas('FROM personas p')] == [['1001'], ['1002']]
+
+
+def test_lote_parametros_incorrectos(api, conexion, consultas_locales, monkeypatch):
+    conexion.responder = _responder_lote({})
+    monkeypatch.setattr(api, 'CEDULAS_POR_LOTE_MAX', 2)
+
+    assert _consultar_lote(api, []).status_code == 400
+    assert _consultar_lote(api, '1001').status_code == 400
+    assert _consultar_lote(api, ['1', '2', '3']).status_code == 400
+    assert _consultar_lote(api, ['1'], '?fields=clave').status_code == 400
+    assert not conexion.ejecutadas('FROM personas p')
+
+
+def test_lote_grande_se_envia_por_partes(api, conexion, consultas_locales, monkeypatch):
+    conexion.responder = _responder_lote({'1001': [11], '1003': [12]})
+    cedulas = ['1001', '1002', '1003']
+    completa = _consultar_lote(api, cedulas).get_json()
+
+    monkeypatch.setattr(api, 'CEDULAS_STREAMING_DESDE', 2)
+    por_partes = _consultar_lote(api, cedulas)
+
+    assert por_partes.is_streamed
+    # Mismo JSON salvo el contador, que sumó las consultas de la primera petición
+    assert json.loads(por_partes.get_data()) == dict(completa, total_consultas=4)
+
+
+# ==================== INVALIDACIÓN DE LA CACHÉ DE PERSONAS ====================
+class TablaPersonas:
+    """Responde como la tabla personas para consultar, crear y editar reportes"""
+
+    def __init__(self, *filas):
+        self.filas = list(filas)
+        self.responder_otros = _responder_lote({})
+
+    def __call__(self, sentencia, parametros):
+        if sentencia.startswith('SELECT p.id') and 'FROM personas p' in sentencia:
+            return [dict(f) for f in self.filas if f['Numero_Documento'] in parametros]
+        if sentencia.startswith('INSERT INTO personas'):
+            fila = _fila_persona(parametros[0], len(self.filas) + 1)
+            fila['Placa'] = parametros[3]
+            self.filas.append(fila)
+            return 1
+        if sentencia.startswith('SELECT id_reportante, Numero_Documento FROM personas'):
+            fila = next(f for f in self.filas if f['id'] == parametros[0])
+            return [{'id_reportante': 7, 'Numero_Documento': fila['Numero_Documento']}]
+        if sentencia.startswith('UPDATE personas SET Placa = %s WHERE id = %s'):
+            next(f for f in self.filas if f['id'] == parametros[1])['Placa'] = parametros[0]
+            return 1
+        return self.responder_otros(sentencia, parametros)
+
+
+def _placas(cliente, cedula):
+    datos = cliente.get(f'/api/personas/{cedula}', headers={'X-User-Celular': '3001112233'}).get_json()
+    return [reporte['placa'] for reporte in datos.get('reportes', [])]
+
+
+def test_crear_y_editar_reporte_invalidan_la_cache(api, conexion, consultas_locales):
+    conexion.responder = TablaPersonas(_fila_persona('1001', 1))
+    cliente = api.app.test_client()
+    encabezados = {'X-User-Celular': '3001112233'}
+
+    def lecturas():
+        return len(conexion.ejecutadas('FROM personas p'))
+
+    assert _placas(cliente, '1001') == ['ABC123']
+    assert _placas(cliente, '1001') == ['ABC123'] and lecturas() == 1
+
+    nuevo = {'numero_documento': '1001', 'nombres': 'Juan', 'apellidos': 'Perez', 'placa': 'xyz789'}
+    assert cliente.post('/api/personas', json=nuevo, headers=encabezados).status_code == 201
+    assert _placas(cliente, '1001') == ['ABC123', 'XYZ789'] and lecturas() == 2
+
+    assert cliente.put('/api/personas/1', json={'placa': 'QWE456'}, headers=encabezados).status_code == 200
+    assert _placas(cliente, '1001') == ['QWE456', 'XYZ789'] and lecturas() == 3
+
+
+def test_importacion_vacia_la_cache_aunque_falle(api, conexion, consultas_locales, monkeypatch, tmp_path):
+    conexion.responder = TablaPersonas(_fila_persona('1001', 1))
+    cliente = api.app.test_client()
+    assert _placas(cliente, '1001') == ['ABC123']
+
+    def importar_a_medias(conn, trabajo, ruta, *args, **kwargs):
+        # El primer bloque quedó confirmado antes del error
+        conexion.responder.filas.append(_fila_persona('1001', 2))
+        raise api.importacion.ErrorImportacion('El archivo supera el máximo de filas')
+    monkeypatch.setattr(api.importacion, 'importar_archivo', importar_a_medias)
+    archivo = tmp_path / 'subido.xlsx'
+    archivo.write_bytes(b'')
+
+    with pytest.raises(api.importacion.ErrorImportacion):
+        api._procesar_importacion(conexion, None, str(archivo), 'excel', 7, 100, 'omitir')
+
+    assert _placas(cliente, '1001') == ['ABC123', 'ABC123']
+    assert not archivo.exists()
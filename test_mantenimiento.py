@@ -0,0 +1,55 @@
+"""Pruebas de mantenimiento.py (BD falsa, ver conftest.py)"""
+
+from mysql.connector import Error
+
+import mantenimiento
+
+
+def _responder(lock, pendientes):
+    """GET_LOCK responde `lock`; cada DELETE borra hasta LIMIT filas de `pendientes` {tabla: filas}"""
+    def responder(sentencia, parametros):
+        if sentencia.startswith('SELECT GET_LOCK') or sentencia.startswith('SELECT RELEASE_LOCK'):
+            return [(lock,)]
+        tabla = sentencia.split()[2]
+        if isinstance(pendientes[tabla], Exception):
+            return pendientes[tabla]
+        borradas = min(pendientes[tabla], parametros[-1])
+        pendientes[tabla] -= borradas
+        return borradas
+    return responder
+
+
+def _barredor(conexion_bd):
+    tareas = [
+        mantenimiento.Tarea('tokens', "DELETE FROM token_carga WHERE expiracion < %s LIMIT %s", lambda: ('2024-01-01',)),
+        mantenimiento.Tarea('idempotencia', "DELETE FROM idempotencia LIMIT %s")
+    ]
+    return mantenimiento.Barredor(conexion_bd, tareas, intervalo=3600, tamano_lote=2)
+
+
+def test_ronda_borra_por_lotes(conexion, conexion_bd):
+    conexion.responder = _responder(1, {'token_carga': 5, 'idempotencia': 0})
+    barredor = _barredor(conexion_bd)
+
+    assert barredor.ronda() == {'tokens': 5, 'idempotencia': 0}
+    assert [p for _, p in conexion.ejecutadas('DELETE FROM token_carga')] == [('2024-01-01', 2)] * 3
+    assert conexion.commits == 4
+    assert conexion.ejecutadas('RELEASE_LOCK')
+
+
+def test_ronda_omitida_sin_lock(conexion, conexion_bd):
+    conexion.responder = _responder(0, {})
+    barredor = _barredor(conexion_bd)
+
+    assert barredor.ronda() is None
+    assert not conexion.ejecutadas('DELETE')
+    assert barredor.metricas()['rondas_omitidas'] == 1
+
+
+def test_error_en_una_tarea_no_detiene_las_demas(conexion, conexion_bd):
+    conexion.responder = _responder(1, {'token_carga': Error(msg='tabla bloqueada'), 'idempotencia': 1})
+    barredor = _barredor(conexion_bd)
+
+    assert barredor.ronda() == {'tokens': 0, 'idempotencia': 1}
+    assert conexion.rollbacks == 1
+    assert barredor.metricas()['errores'] == {'tokens': 1, 'idempotencia': 0}
@@ -0,0 +1,81 @@
+"""Pruebas de migraciones.py (BD falsa, ver conftest.py)"""
+
+import migraciones
+
+
+def test_relleno_por_rangos_de_llave_primaria(conexion, capsys):
+    def responder(sentencia, parametros):
+        if sentencia.startswith('SELECT MIN(id), MAX(id)'):
+            return [(1, 12000)]
+        if sentencia.startswith('SELECT COUNT(*)'):
+            return [(3,)]
+        return []
+    conexion.responder = responder
+
+    migraciones._rellenar_id_reportante(conexion.cursor())
+
+    rangos = [parametros for _, parametros in conexion.ejecutadas('UPDATE personas')]
+    assert rangos == [(1, 5000), (5001, 10000), (10001, 15000)]
+    # Commit después de cada rango
+    assert len(conexion.ejecutadas('COMMIT')) == 3
+    assert all('TRIM(Reportante_Nombres)' in sentencia for sentencia, _ in conexion.ejecutadas('UPDATE personas'))
+    assert 'sin id_reportante' in capsys.readouterr().out
+
+
+def test_relleno_tabla_vacia(conexion):
+    conexion.responder = lambda sentencia, parametros: [(None, None)]
+    migraciones._rellenar_id_reportante(conexion.cursor())
+    assert not conexion.ejecutadas('UPDATE personas')
+
+
+def test_versiones_unicas_y_ordenadas():
+    versiones = [version for version, _, _ in migraciones.MIGRACIONES]
+    assert versiones == sorted(set(versiones))
+
+
+def test_aplicar_solo_pendientes(conexion):
+    def responder(sentencia, parametros):
+        if sentencia.startswith('SELECT GET_LOCK') or sentencia.startswith('SELECT RELEASE_LOCK'):
+            return [(1,)]
+        if sentencia == 'SELECT version FROM schema_migraciones':
+            return [(version,) for version, _, _ in migraciones.MIGRACIONES[:-1]]
+        if sentencia.startswith('SELECT MIN(id), MAX(id)'):
+            return [(None, None)]
+        return []
+    conexion.responder = responder
+
+    ultima = migraciones.MIGRACIONES[-1][0]
+    assert migraciones.aplicar_migraciones(conexion) == [ultima]
+    registradas = conexion.ejecutadas('INSERT INTO schema_migraciones')
+    assert [parametros[0] for _, parametros in registradas] == [ultima]
+
+
+def test_verificar_esquema_reporta_tablas_e_indices_faltantes(conexion):
+    def responder(sentencia, parametros):
+        if 'information_schema.TABLES' in sentencia:
+            return [(tabla.upper(),) for tabla in migraciones.ESQUEMA_REQUERIDO if tabla != 'idempotencia']
+        if 'information_schema.STATISTICS' in sentencia:
+            return [
+                (tabla, indice) for tabla, indices in migraciones.ESQUEMA_REQUERIDO.items()
+                for indice in indices if indice != 'idx_personas_id_reportante'
+            ]
+        return []
+    conexion.responder = responder
+
+    assert migraciones.verificar_esquema(conexion) == ['personas.idx_personas_id_reportante', 'idempotencia']
+    assert conexion.commits == 0
+
+
+
+def test_version_4_conserva_su_relleno_original(conexion):
+    pasos = dict((version, pasos) for version, _, pasos in migraciones.MIGRACIONES)
+    assert migraciones._rellenar_id_reportante_v4 in pasos[4]
+    assert migraciones._rellenar_id_reportante in pasos[10]
+
+    restantes = [5000, 120, 0]
+    conexion.responder = lambda sentencia, parametros: restantes.pop(0)
+    migraciones._rellenar_id_reportante_v4(conexion.cursor())
+
+    actualizaciones = conexion.ejecutadas('UPDATE personas')
+    assert len(actualizaciones) == 3
+    assert all('TRIM' not in sentencia and 'LIMIT 5000' in sentencia for sentencia, _ in actualizaciones)
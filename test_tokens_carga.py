@@ -0,0 +1,82 @@
+"""Pruebas de tokens_carga.py y de los endpoints de carga masiva con tokens firmados"""
+
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import tokens_carga
+
+
+@pytest.fixture
+def secreto(monkeypatch):
+    monkeypatch.setattr(tokens_carga, 'SECRETO', 'secreto-de-prueba')
+    monkeypatch.setattr(tokens_carga, 'REVOCADOS', set())
+
+
+def _token(celular='3001112233', id_user=7, horas=24):
+    return tokens_carga.firmar(celular, id_user, datetime.now() + timedelta(hours=horas))
+
+
+def test_firmar_y_verificar(secreto):
+    datos = tokens_carga.verificar(_token())
+    assert datos['celular'] == '3001112233' and datos['id_user'] == 7
+    assert datos['expiracion'] > datetime.now()
+
+
+def test_token_alterado_no_valida(secreto):
+    carga, firma = _token().split('.')
+    otra_carga, _ = _token(celular='3009999999').split('.')
+
+    assert tokens_carga.verificar(f'{otra_carga}.{firma}') is None
+    assert tokens_carga.verificar(f'{carga}.{firma[:-1]}') is None
+    assert tokens_carga.verificar(f'{carga}.ñandú') is None
+    assert tokens_carga.verificar(f'{carga}.{firma}.x') is None
+
+
+def test_token_vencido_no_valida(secreto):
+    assert tokens_carga.verificar(_token(horas=-1)) is None
+
+
+def test_token_revocado_por_id_o_celular(secreto, monkeypatch):
+    token = _token()
+    jti = json.loads(tokens_carga._desde_b64(token.split('.')[0]))['jti']
+
+    monkeypatch.setattr(tokens_carga, 'REVOCADOS', {jti})
+    assert tokens_carga.verificar(token) is None
+    monkeypatch.setattr(tokens_carga, 'REVOCADOS', {'3001112233'})
+    assert tokens_carga.verificar(token) is None
+
+
+def test_otro_secreto_invalida_los_links(secreto, monkeypatch):
+    token = _token()
+    monkeypatch.setattr(tokens_carga, 'SECRETO', 'secreto-nuevo')
+    assert tokens_carga.verificar(token) is None
+    monkeypatch.setattr(tokens_carga, 'SECRETO', '')
+    assert tokens_carga.verificar(token) is None
+
+
+def test_tokens_de_bd_no_son_firmados():
+    assert not tokens_carga.es_firmado(tokens_carga.secrets.token_urlsafe(32))
+
+
+# ==================== ENDPOINTS ====================
+def test_plantilla_con_token_firmado_no_usa_bd(api, conexion, secreto):
+    cliente = api.app.test_client()
+
+    assert cliente.get(f'/api/plantilla-excel-token/{_token()}').status_code == 200
+    assert cliente.get(f'/api/plantilla-excel-token/{_token(horas=-1)}').status_code == 404
+    assert conexion.sentencias == []
+
+
+def test_generar_token_firmado_no_guarda_en_bd(api, conexion, secreto, monkeypatch):
+    monkeypatch.setattr(tokens_carga, 'FIRMADOS', True)
+    conexion.responder = lambda sentencia, parametros: (
+        [{'id_user': 7, 'nombres': 'Juan'}] if sentencia.startswith('SELECT id_user, nombres FROM users') else []
+    )
+
+    respuesta = api.app.test_client().post('/api/generar-token-carga', headers={'X-User-Celular': '3001112233'})
+
+    assert respuesta.status_code == 200
+    assert tokens_carga.verificar(respuesta.get_json()['token'])['id_user'] == 7
+    assert not conexion.ejecutadas('token_carga')
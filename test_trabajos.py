@@ -0,0 +1,114 @@
+"""Pruebas de trabajos.py (BD falsa, ver conftest.py)"""
+
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+
+import trabajos
+
+
+@pytest.fixture
+def gestor(conexion_bd):
+    gestor = trabajos.GestorTrabajos(conexion_bd, hilos=1)
+    yield gestor
+    gestor.cerrar()
+
+
+def _estados_guardados(conexion):
+    """Columna estado de cada INSERT en importacion_trabajos, en orden"""
+    return [parametros[4] for _, parametros in conexion.ejecutadas('INSERT INTO importacion_trabajos')]
+
+
+def test_encolar_procesa_y_guarda_el_avance(conexion, gestor):
+    def importar(conn, trabajo, filas):
+        trabajo.total_filas = trabajo.procesadas = trabajo.insertados = filas
+
+    trabajo = gestor.encolar(conexion, 'excel', 7, importar, 3)
+    gestor.cerrar()
+
+    assert trabajo.estado == trabajos.COMPLETADO
+    assert _estados_guardados(conexion) == [trabajos.EN_COLA, trabajos.PROCESANDO, trabajos.COMPLETADO]
+    estado = gestor.consultar(conexion, trabajo.id)
+    assert (estado['estado'], estado['porcentaje'], estado['insertados']) == (trabajos.COMPLETADO, 100.0, 3)
+
+
+def test_trabajo_fallido_queda_registrado(conexion, gestor):
+    def importar(conn, trabajo):
+        conn.cursor().execute('INSERT INTO personas (id) VALUES (%s)', (1,))
+        raise ValueError('Columnas faltantes: Placa')
+
+    trabajo = gestor.encolar(conexion, 'excel', 7, importar)
+    gestor.cerrar()
+
+    assert trabajo.estado == trabajos.FALLIDO
+    assert trabajo.mensaje == 'Columnas faltantes: Placa'
+    # Lo que la importación dejó sin confirmar se deshace antes de guardar el estado final
+    sentencias = [sentencia.split(' ')[0] for sentencia, _ in conexion.sentencias]
+    assert sentencias[-4:] == ['INSERT', '<rollback>', 'INSERT', '<commit>']
+    (_, parametros), = conexion.ejecutadas('INSERT INTO importacion_trabajos')[-1:]
+    assert (parametros[4], parametros[9]) == (trabajos.FALLIDO, 'Columnas faltantes: Placa')
+
+
+def test_sin_conexion_el_trabajo_falla():
+    @contextmanager
+    def sin_conexion():
+        yield None
+
+    gestor = trabajos.GestorTrabajos(sin_conexion)
+    trabajo = gestor.ejecutar_ahora('excel', 7, lambda conn, trabajo: None)
+
+    assert trabajo.estado == trabajos.FALLIDO
+    assert trabajo.mensaje == 'Error de conexión a la base de datos'
+
+
+def test_consultar_trabajo_de_otro_worker(conexion, gestor):
+    hace_rato = datetime.now() - timedelta(seconds=trabajos.SEGUNDOS_SIN_AVANCE + 1)
+    fila = {
+        'id': 'abc', 'tipo': 'excel', 'estado': trabajos.PROCESANDO, 'total_filas': 200, 'procesadas': 50,
+        'insertados': 50, 'errores': 0, 'mensaje': None, 'resultado': None, 'creado_en': hace_rato,
+        'iniciado_en': hace_rato, 'actualizado_en': hace_rato, 'terminado_en': None
+    }
+    conexion.responder = lambda sentencia, parametros: [dict(fila)] if parametros == ('abc',) else []
+
+    estado = gestor.consultar(conexion, 'abc')
+    # Sin avances hace más de SEGUNDOS_SIN_AVANCE: el worker que lo procesaba ya no está
+    assert (estado['estado'], estado['porcentaje'], estado['eta_segundos']) == (trabajos.INTERRUMPIDO, 25.0, None)
+    assert gestor.consultar(conexion, 'no-existe') is None
+
+
+def test_archivo_repetido_reutiliza_el_trabajo(conexion, gestor):
+    trabajo = gestor.encolar(conexion, 'excel', 7, lambda conn, trabajo: None, hash_archivo='h1')
+    gestor.cerrar()
+
+    repetido = gestor.buscar_repetido(conexion, 'excel', 7, 'h1')
+    assert repetido.id == trabajo.id and repetido is not trabajo
+    repetido.reutilizado = True
+    assert not trabajo.reutilizado
+
+
+def test_cerrar_no_procesa_los_trabajos_en_cola(conexion, gestor):
+    empezo, liberar = threading.Event(), threading.Event()
+    procesados = []
+
+    def importar(conn, trabajo):
+        empezo.set()
+        liberar.wait(5)
+        procesados.append(trabajo.id)
+
+    primero = gestor.encolar(conexion, 'excel', 7, importar)
+    segundo = gestor.encolar(conexion, 'excel', 7, importar)
+    executor = gestor._get_executor()
+    assert empezo.wait(5)
+    gestor.cerrar(esperar=False)
+    liberar.set()
+    executor.shutdown(wait=True)
+
+    assert procesados == [primero.id]
+    assert segundo.estado == trabajos.EN_COLA
+
+    # Un trabajo nuevo usa un executor nuevo
+    tercero = gestor.encolar(conexion, 'excel', 7, lambda conn, trabajo: None)
+    gestor.cerrar()
+    assert tercero.estado == trabajos.COMPLETADO
@@ -0,0 +1,77 @@
+"""
+Tokens firmados (HMAC) para los links de carga masiva de InfoTaxi
+El link lleva celular, id_user y vencimiento firmados con TOKEN_CARGA_SECRETO: validarlo no usa la BD.
+Modos (TOKEN_CARGA_MODO):
+- bd: token aleatorio guardado en token_carga (comportamiento anterior)
+- firmado: token autocontenido; requiere TOKEN_CARGA_SECRETO igual en todos los workers y réplicas
+Con secreto configurado los tokens firmados se aceptan en cualquier modo (los de BD no llevan '.').
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+from datetime import datetime
+
+MODO = os.getenv('TOKEN_CARGA_MODO', 'bd').lower()
+SECRETO = os.getenv('TOKEN_CARGA_SECRETO', '')
+HORAS_VIGENCIA = int(os.getenv('TOKEN_CARGA_HORAS', 24))
+
+# Emitir tokens firmados (solo si hay secreto)
+FIRMADOS = MODO == 'firmado' and bool(SECRETO)
+if MODO == 'firmado' and not SECRETO:
+    print("[TOKENS] TOKEN_CARGA_MODO=firmado sin TOKEN_CARGA_SECRETO; se usan tokens en BD")
+
+# Revocación de emergencia sin BD: ids de token (campo 'jti') o celulares separados por coma.
+# Se lee al iniciar; para revocar todos los links basta con cambiar TOKEN_CARGA_SECRETO.
+REVOCADOS = {valor.strip() for valor in os.getenv('TOKEN_CARGA_REVOCADOS', '').split(',') if valor.strip()}
+
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).decode('ascii').rstrip('=')
+
+
+def _desde_b64(texto):
+    return base64.urlsafe_b64decode(texto + '=' * (-len(texto) % 4))
+
+
+def _firma(carga):
+    return _b64(hmac.new(SECRETO.encode('utf-8'), carga.encode('utf-8'), hashlib.sha256).digest())
+
+
+def firmar(celular, id_user, expiracion):
+    """Token '<carga>.<firma>' para `celular` válido hasta `expiracion` (datetime)"""
+    datos = {
+        'cel': celular,
+        'uid': id_user,
+        'exp': int(expiracion.timestamp()),
+        'jti': secrets.token_urlsafe(8)
+    }
+    carga = _b64(json.dumps(datos, separators=(',', ':')).encode('utf-8'))
+    return f'{carga}.{_firma(carga)}'
+
+
+def es_firmado(token):
+    return '.' in token
+
+
+def verificar(token):
+    """{'celular', 'id_user', 'expiracion'} si el token es auténtico, vigente y no revocado; None si no"""
+    if not SECRETO or token.count('.') != 1:
+        return None
+    carga, firma = token.split('.')
+    try:
+        # En bytes: compare_digest no acepta texto con caracteres no ASCII
+        if not hmac.compare_digest(firma.encode('utf-8'), _firma(carga).encode('ascii')):
+            return None
+        datos = json.loads(_desde_b64(carga))
+        expiracion = datetime.fromtimestamp(datos['exp'])
+        celular, id_user, jti = datos['cel'], datos['uid'], datos['jti']
+    except (TypeError, ValueError, KeyError):
+        return None
+
+    if expiracion <= datetime.now() or jti in REVOCADOS or celular in REVOCADOS:
+        return None
+    return {'celular': celular, 'id_user': id_user, 'expiracion': expiracion}
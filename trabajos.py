@@ -0,0 +1,303 @@
+"""
+Trabajos de importación en segundo plano para InfoTaxi
+La petición encola el trabajo y responde de inmediato; un pool de hilos lo procesa.
+El progreso se guarda en importacion_trabajos para que cualquier worker de gunicorn pueda consultarlo.
+"""
+
+import copy
+import json
+import os
+import secrets
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from mysql.connector import Error
+
+# Hilos de importación por worker de gunicorn
+HILOS_IMPORTACION = int(os.getenv('IMPORTAR_HILOS', 1))
+# Trabajos terminados que se conservan en memoria (el resto se lee de la BD)
+MAX_TRABAJOS_EN_MEMORIA = 200
+# Un trabajo sin avances por más de estos segundos se reporta como interrumpido (p.ej. worker reiniciado)
+SEGUNDOS_SIN_AVANCE = int(os.getenv('IMPORTAR_SEGUNDOS_SIN_AVANCE', 600))
+# Un mismo archivo subido de nuevo por el mismo usuario dentro de esta ventana reutiliza el trabajo anterior
+HORAS_IDEMPOTENCIA = int(os.getenv('IMPORTAR_IDEMPOTENCIA_HORAS', 24))
+
+EN_COLA = 'en_cola'
+PROCESANDO = 'procesando'
+COMPLETADO = 'completado'
+FALLIDO = 'fallido'
+INTERRUMPIDO = 'interrumpido'
+
+
+def _eta(estado, iniciado_en, procesadas, total_filas, ahora):
+    """Segundos estimados para terminar según el ritmo observado"""
+    if estado != PROCESANDO or not iniciado_en or not procesadas or not total_filas:
+        return None
+    transcurrido = (ahora - iniciado_en).total_seconds()
+    return round(transcurrido / procesadas * (total_filas - procesadas), 1)
+
+
+def _iso(fecha):
+    return fecha.isoformat() if fecha else None
+
+
+class Trabajo:
+    """Estado de una importación"""
+
+    def __init__(self, tipo, id_user, hash_archivo=None):
+        self.id = secrets.token_hex(16)
+        self.tipo = tipo
+        self.id_user = id_user
+        self.hash_archivo = hash_archivo
+        # True cuando se devuelve un trabajo anterior para el mismo archivo en lugar de procesarlo
+        self.reutilizado = False
+        self.estado = EN_COLA
+        self.total_filas = None
+        self.procesadas = 0
+        self.insertados = 0
+        self.errores = []  # [(numero_fila, mensaje)]
+        self.mensaje = None
+        self.excepcion = None
+        self.resultado = {}
+        self.creado_en = datetime.now()
+        self.iniciado_en = None
+        self.actualizado_en = self.creado_en
+        self.terminado_en = None
+
+    @classmethod
+    def desde_fila(cls, fila):
+        """Trabajo guardado en importacion_trabajos (el detalle de errores queda solo en `resultado`)"""
+        trabajo = cls(fila['tipo'], fila['id_user'], fila['hash_archivo'])
+        trabajo.id = fila['id']
+        trabajo.estado = fila['estado']
+        trabajo.total_filas = fila['total_filas']
+        trabajo.procesadas = fila['procesadas']
+        trabajo.insertados = fila['insertados']
+        trabajo.mensaje = fila['mensaje']
+        trabajo.resultado = json.loads(fila['resultado']) if fila['resultado'] else {}
+        trabajo.creado_en = fila['creado_en']
+        trabajo.iniciado_en = fila['iniciado_en']
+        trabajo.actualizado_en = fila['actualizado_en']
+        trabajo.terminado_en = fila['terminado_en']
+        return trabajo
+
+    def como_dict(self):
+        ahora = datetime.now()
+        return {
+            'trabajo_id': self.id,
+            'tipo': self.tipo,
+            'estado': self.estado,
+            'total_filas': self.total_filas,
+            'procesadas': self.procesadas,
+            'porcentaje': round(100.0 * self.procesadas / self.total_filas, 1) if self.total_filas else None,
+            'insertados': self.insertados,
+            'errores': len(self.errores),
+            'eta_segundos': _eta(self.estado, self.iniciado_en, self.procesadas, self.total_filas, ahora),
+            'mensaje': self.mensaje,
+            'creado_en': _iso(self.creado_en),
+            'iniciado_en': _iso(self.iniciado_en),
+            'terminado_en': _iso(self.terminado_en),
+            'resultado': self.resultado
+        }
+
+
+class GestorTrabajos:
+    """Cola de trabajos por proceso con hilos propios y estado persistido en la BD"""
+
+    def __init__(self, conexion_bd, hilos=HILOS_IMPORTACION):
+        self._conexion_bd = conexion_bd
+        self._hilos = hilos
+        self._executor = None
+        self._executor_pid = None
+        self._trabajos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Igual que el pool de conexiones: un executor por proceso (tras el fork de gunicorn)
+        pid = os.getpid()
+        with self._lock:
+            if self._executor is None or self._executor_pid != pid:
+                self._executor = ThreadPoolExecutor(max_workers=self._hilos, thread_name_prefix='importacion')
+                self._executor_pid = pid
+            return self._executor
+
+    def cerrar(self, esperar=True):
+        """
+        Detener el executor de este proceso: los trabajos en curso terminan (si `esperar`, se espera
+        por ellos) y los que seguían en cola no se procesan; en la BD quedan como interrumpidos al
+        pasar SEGUNDOS_SIN_AVANCE, igual que si el worker se reiniciara. Un encolar() posterior crea
+        un executor nuevo.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=esperar, cancel_futures=True)
+
+    def _recordar(self, trabajo):
+        with self._lock:
+            self._trabajos[trabajo.id] = trabajo
+            while len(self._trabajos) > MAX_TRABAJOS_EN_MEMORIA:
+                antiguo = next(iter(self._trabajos.values()))
+                if antiguo.estado in (EN_COLA, PROCESANDO):
+                    break
+                self._trabajos.popitem(last=False)
+
+    def persistir(self, conn, trabajo):
+        """Guardar el estado del trabajo (sin commit: lo hace quien llama)"""
+        cursor = conn.cursor()
+        try:
+            trabajo.actualizado_en = datetime.now()
+            cursor.execute("""
+                INSERT INTO importacion_trabajos (
+                    id, tipo, id_user, hash_archivo, estado, total_filas, procesadas, insertados, errores,
+                    mensaje, resultado, creado_en, iniciado_en, actualizado_en, terminado_en
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    estado = VALUES(estado),
+                    total_filas = VALUES(total_filas),
+                    procesadas = VALUES(procesadas),
+                    insertados = VALUES(insertados),
+                    errores = VALUES(errores),
+                    mensaje = VALUES(mensaje),
+                    resultado = VALUES(resultado),
+                    iniciado_en = VALUES(iniciado_en),
+                    actualizado_en = VALUES(actualizado_en),
+                    terminado_en = VALUES(terminado_en)
+            """, (
+                trabajo.id, trabajo.tipo, trabajo.id_user, trabajo.hash_archivo, trabajo.estado, trabajo.total_filas,
+                trabajo.procesadas, trabajo.insertados, len(trabajo.errores),
+                (trabajo.mensaje or '')[:500] or None,
+                json.dumps(trabajo.resultado, default=str) if trabajo.resultado else None,
+                trabajo.creado_en, trabajo.iniciado_en, trabajo.actualizado_en, trabajo.terminado_en
+            ))
+        finally:
+            cursor.close()
+
+    def _ejecutar(self, trabajo, funcion, args):
+        """Correr `funcion(conn, trabajo, *args)` marcando el trabajo como completado o fallido"""
+        with self._conexion_bd() as conn:
+            if not conn:
+                trabajo.estado = FALLIDO
+                trabajo.mensaje = 'Error de conexión a la base de datos'
+                trabajo.terminado_en = datetime.now()
+                return trabajo
+
+            try:
+                trabajo.estado = PROCESANDO
+                trabajo.iniciado_en = datetime.now()
+                self.persistir(conn, trabajo)
+                conn.commit()
+
+                funcion(conn, trabajo, *args)
+
+                trabajo.estado = COMPLETADO
+            except Exception as e:
+                print(f"[IMPORTACION ERROR] Trabajo {trabajo.id}: {str(e)}")
+                traceback.print_exc()
+                conn.rollback()
+                trabajo.estado = FALLIDO
+                trabajo.mensaje = str(e)
+                trabajo.excepcion = e
+
+            trabajo.terminado_en = datetime.now()
+            try:
+                self.persistir(conn, trabajo)
+                conn.commit()
+            except Error as e:
+                print(f"[IMPORTACION ERROR] No se pudo guardar el estado del trabajo {trabajo.id}: {e}")
+        return trabajo
+
+    def encolar(self, conn, tipo, id_user, funcion, *args, hash_archivo=None):
+        """Registrar el trabajo y enviarlo al pool de hilos. `conn` se usa solo para persistir el alta"""
+        trabajo = Trabajo(tipo, id_user, hash_archivo)
+        self.persistir(conn, trabajo)
+        conn.commit()
+        self._recordar(trabajo)
+        self._get_executor().submit(self._ejecutar, trabajo, funcion, args)
+        return trabajo
+
+    def ejecutar_ahora(self, tipo, id_user, funcion, *args, hash_archivo=None):
+        """Correr el trabajo en el hilo actual (modo síncrono para clientes que esperan el resultado)"""
+        trabajo = Trabajo(tipo, id_user, hash_archivo)
+        self._recordar(trabajo)
+        return self._ejecutar(trabajo, funcion, args)
+
+    def buscar_repetido(self, conn, tipo, id_user, hash_archivo):
+        """
+        Trabajo reciente del mismo usuario para el mismo archivo que terminó bien o sigue avanzando.
+        Los fallidos e interrumpidos no cuentan: el reintento se procesa de nuevo.
+        """
+        ahora = datetime.now()
+        with self._lock:
+            for trabajo in reversed(self._trabajos.values()):
+                if (trabajo.tipo, trabajo.id_user, trabajo.hash_archivo) == (tipo, id_user, hash_archivo) \
+                        and trabajo.estado in (EN_COLA, PROCESANDO, COMPLETADO) \
+                        and ahora - trabajo.creado_en < timedelta(hours=HORAS_IDEMPOTENCIA):
+                    # Copia: quien lo reutiliza marca `reutilizado` sin tocar el trabajo original
+                    return copy.copy(trabajo)
+
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("""
+                SELECT id, tipo, id_user, hash_archivo, estado, total_filas, procesadas, insertados,
+                       mensaje, resultado, creado_en, iniciado_en, actualizado_en, terminado_en
+                FROM importacion_trabajos
+                WHERE id_user = %s AND hash_archivo = %s AND tipo = %s
+                AND creado_en > %s
+                AND (estado = %s OR (estado IN (%s, %s) AND actualizado_en > %s))
+                ORDER BY creado_en DESC
+                LIMIT 1
+            """, (
+                id_user, hash_archivo, tipo,
+                ahora - timedelta(hours=HORAS_IDEMPOTENCIA),
+                COMPLETADO, EN_COLA, PROCESANDO,
+                ahora - timedelta(seconds=SEGUNDOS_SIN_AVANCE)
+            ))
+            fila = cursor.fetchone()
+        finally:
+            cursor.close()
+        return Trabajo.desde_fila(fila) if fila else None
+
+    def consultar(self, conn, trabajo_id):
+        """Estado del trabajo: de memoria si lo procesa este worker, si no de la BD. None si no existe"""
+        with self._lock:
+            trabajo = self._trabajos.get(trabajo_id)
+        if trabajo:
+            return trabajo.como_dict()
+
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("""
+                SELECT id, tipo, estado, total_filas, procesadas, insertados, errores, mensaje,
+                       resultado, creado_en, iniciado_en, actualizado_en, terminado_en
+                FROM importacion_trabajos
+                WHERE id = %s
+            """, (trabajo_id,))
+            fila = cursor.fetchone()
+        finally:
+            cursor.close()
+        if not fila:
+            return None
+
+        ahora = datetime.now()
+        estado = fila['estado']
+        if estado in (EN_COLA, PROCESANDO) and (ahora - fila['actualizado_en']).total_seconds() > SEGUNDOS_SIN_AVANCE:
+            estado = INTERRUMPIDO
+        return {
+            'trabajo_id': fila['id'],
+            'tipo': fila['tipo'],
+            'estado': estado,
+            'total_filas': fila['total_filas'],
+            'procesadas': fila['procesadas'],
+            'porcentaje': round(100.0 * fila['procesadas'] / fila['total_filas'], 1) if fila['total_filas'] else None,
+            'insertados': fila['insertados'],
+            'errores': fila['errores'],
+            'eta_segundos': _eta(estado, fila['iniciado_en'], fila['procesadas'], fila['total_filas'], ahora),
+            'mensaje': fila['mensaje'],
+            'creado_en': _iso(fila['creado_en']),
+            'iniciado_en': _iso(fila['iniciado_en']),
+            'terminado_en': _iso(fila['terminado_en']),
+            'resultado': json.loads(fila['resultado']) if fila['resultado'] else {}
+        }